@@ -0,0 +1,245 @@
+"""Accuracy analytics across every estimation run.
+
+Each estimation_results/estimation_openai_<ts>.csv is ingested once into a
+small columnar store (one .npz of float columns per run plus a manifest),
+and later calls only pick up runs that are new or changed. Metrics are
+computed for all runs or configurations at once with grouped bincounts,
+and bootstrap confidence intervals resample per group in vectorized
+chunks, so tens of thousands of rows per run take seconds.
+
+A run's configuration (model, prompt, response mode, image settings) comes
+from the <run>.meta.json that main() writes next to its journal; runs from
+before that file existed are grouped as 'unknown'.
+
+    python analytics.py --by model prompt --bootstrap 1000
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+RUN_PATTERN = 'estimation_openai_*.csv'
+# Nutrients with their estimated/actual column names in a run CSV
+NUTRIENTS = {
+    'calories': ('estimated_calories', 'actual_calories'),
+    'carbohydrates': ('estimated_carbs', 'actual_carbs'),
+    'protein': ('estimated_protein', 'actual_protein'),
+    'fat': ('estimated_fat', 'actual_fat'),
+    'fiber': ('estimated_fiber', 'actual_fiber'),
+}
+CONFIG_FIELDS = ('model', 'prompt', 'response_mode', 'max_size', 'quality', 'mode')
+METRICS = ('n', 'mae', 'mape', 'bias', 'rmse')
+
+
+def metadata_path(run_path: str) -> str:
+    return f"{os.path.splitext(run_path)[0]}.meta.json"
+
+
+def write_run_metadata(run_path: str, metadata: Dict[str, Any]):
+    """Record the configuration a run was made with, next to its journal/CSV."""
+    with open(metadata_path(run_path), 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=2)
+
+
+def read_run_metadata(run_path: str) -> Dict[str, Any]:
+    path = metadata_path(run_path)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class RunStore:
+    """Columnar store of every run in results_dir, refreshed incrementally."""
+
+    def __init__(self, results_dir: str, store_dir: Optional[str] = None):
+        self.results_dir = results_dir
+        self.store_dir = store_dir or os.path.join(results_dir, '.analytics')
+        self.manifest_path = os.path.join(self.store_dir, 'manifest.json')
+        self.manifest: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        self._columns: Optional[Dict[str, np.ndarray]] = None
+
+    def _ingest(self, csv_path: str) -> Dict[str, Any]:
+        header = pd.read_csv(csv_path, nrows=0).columns
+        wanted = [c for pair in NUTRIENTS.values() for c in pair if c in header]
+        frame = pd.read_csv(csv_path, usecols=wanted + (['success'] if 'success' in header else []))
+        if 'success' in frame:
+            frame = frame[frame['success'].astype(str).str.lower().isin(['true', '1'])]
+        columns = {c: pd.to_numeric(frame[c], errors='coerce').to_numpy(dtype=np.float64) if c in frame
+                   else np.full(len(frame), np.nan) for pair in NUTRIENTS.values() for c in pair}
+        run = os.path.splitext(os.path.basename(csv_path))[0]
+        np.savez(os.path.join(self.store_dir, f"{run}.npz"), **columns)
+        stat = os.stat(csv_path)
+        meta = read_run_metadata(csv_path)
+        return {'rows': len(frame), 'mtime': stat.st_mtime, 'size': stat.st_size,
+                'config': {field: str(meta.get(field, 'unknown')) for field in CONFIG_FIELDS}}
+
+    def refresh(self) -> List[str]:
+        """Ingest runs that are new or changed since the last refresh; returns their names."""
+        os.makedirs(self.store_dir, exist_ok=True)
+        updated = []
+        for csv_path in sorted(glob.glob(os.path.join(self.results_dir, RUN_PATTERN))):
+            run = os.path.splitext(os.path.basename(csv_path))[0]
+            stat = os.stat(csv_path)
+            entry = self.manifest.get(run)
+            if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                continue
+            try:
+                self.manifest[run] = self._ingest(csv_path)
+                updated.append(run)
+            except Exception as e:
+                logging.error(f"Error ingesting {csv_path}: {str(e)}")
+        if updated:
+            tmp_path = f"{self.manifest_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.manifest, f)
+            os.replace(tmp_path, self.manifest_path)
+            self._columns = None
+        return updated
+
+    @property
+    def runs(self) -> pd.DataFrame:
+        """One row per run: its row count and configuration."""
+        return pd.DataFrame([dict(entry['config'], run=run, rows=entry['rows'])
+                             for run, entry in sorted(self.manifest.items())],
+                            columns=['run', 'rows'] + list(CONFIG_FIELDS))
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        """All runs concatenated: every nutrient column plus 'run_code' (index into self.runs)."""
+        if self._columns is None:
+            runs = self.runs['run'].tolist()
+            parts = [np.load(os.path.join(self.store_dir, f"{run}.npz")) for run in runs]
+            names = [c for pair in NUTRIENTS.values() for c in pair]
+            self._columns = {c: np.concatenate([p[c] for p in parts]) if parts else np.empty(0) for c in names}
+            self._columns['run_code'] = np.repeat(np.arange(len(runs)), [len(p[names[0]]) for p in parts]) \
+                if parts else np.empty(0, dtype=np.int64)
+        return self._columns
+
+
+def grouped_metrics(estimated: np.ndarray, actual: np.ndarray, groups: np.ndarray,
+                    n_groups: int) -> Dict[str, np.ndarray]:
+    """n, MAE, MAPE (%), bias and RMSE of estimated vs actual for every group at once."""
+    valid = ~(np.isnan(estimated) | np.isnan(actual))
+    error = (estimated - actual)[valid]
+    g = groups[valid]
+    nonzero = actual[valid] != 0
+    n = np.bincount(g, minlength=n_groups).astype(np.float64)
+    n_pct = np.bincount(g[nonzero], minlength=n_groups)
+    pct = np.abs(error[nonzero] / actual[valid][nonzero]) * 100
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {
+            'n': n,
+            'mae': np.bincount(g, weights=np.abs(error), minlength=n_groups) / n,
+            'mape': np.bincount(g[nonzero], weights=pct, minlength=n_groups) / n_pct,
+            'bias': np.bincount(g, weights=error, minlength=n_groups) / n,
+            'rmse': np.sqrt(np.bincount(g, weights=error ** 2, minlength=n_groups) / n),
+        }
+
+
+def bootstrap_ci(estimated: np.ndarray, actual: np.ndarray, groups: np.ndarray, n_groups: int,
+                 metric: str = 'mae', n_boot: int = 1000, alpha: float = 0.05, seed: int = 0,
+                 max_cells: int = 4_000_000) -> Tuple[np.ndarray, np.ndarray]:
+    """Percentile bootstrap CI of mae/bias/rmse per group; returns (low, high) arrays.
+
+    Resample indices are drawn as one (replicates, n) matrix per group,
+    chunked so a chunk never holds more than max_cells indices.
+    """
+    valid = ~(np.isnan(estimated) | np.isnan(actual))
+    error = (estimated - actual)[valid]
+    g = groups[valid]
+    if metric == 'mae':
+        values = np.abs(error)
+    elif metric == 'rmse':
+        values = error ** 2
+    elif metric == 'bias':
+        values = error
+    else:
+        raise ValueError(f"No bootstrap for metric {metric}")
+    rng = np.random.default_rng(seed)
+    low = np.full(n_groups, np.nan)
+    high = np.full(n_groups, np.nan)
+    order = np.argsort(g, kind='stable')
+    bounds = np.searchsorted(g[order], np.arange(n_groups + 1))
+    for group in range(n_groups):
+        sample = values[order[bounds[group]:bounds[group + 1]]]
+        if len(sample) < 2:
+            continue
+        per_chunk = max(1, max_cells // len(sample))
+        stats = []
+        for start in range(0, n_boot, per_chunk):
+            draws = rng.integers(0, len(sample), size=(min(per_chunk, n_boot - start), len(sample)))
+            stats.append(sample[draws].mean(axis=1))
+        stats = np.concatenate(stats)
+        if metric == 'rmse':
+            stats = np.sqrt(stats)
+        low[group], high[group] = np.quantile(stats, [alpha / 2, 1 - alpha / 2])
+    return low, high
+
+
+def summarize(store: RunStore, by: Sequence[str] = ('run',), nutrients: Sequence[str] = tuple(NUTRIENTS),
+              n_boot: int = 0, alpha: float = 0.05, seed: int = 0) -> pd.DataFrame:
+    """Metrics per run (by=('run',)) or per configuration (any of CONFIG_FIELDS), per nutrient.
+
+    Nutrients without actual values anywhere are left out, with a warning.
+    """
+    runs = store.runs
+    columns = store.columns()
+    if runs.empty:
+        return pd.DataFrame()
+    # Map every run to its group, then rows to groups through their run code
+    keys = runs[list(by)].astype(str).agg(' | '.join, axis=1)
+    codes, labels = pd.factorize(keys)
+    groups = codes[columns['run_code']]
+    frames = []
+    for nutrient in nutrients:
+        estimated_column, actual_column = NUTRIENTS[nutrient]
+        estimated, actual = columns[estimated_column], columns[actual_column]
+        if not np.isfinite(actual).any():
+            logging.warning(f"No run has {actual_column} values; {nutrient} is not scored")
+            continue
+        metrics = grouped_metrics(estimated, actual, groups, len(labels))
+        frame = pd.DataFrame(metrics)
+        if n_boot:
+            frame['mae_low'], frame['mae_high'] = bootstrap_ci(estimated, actual, groups, len(labels),
+                                                               'mae', n_boot, alpha, seed)
+            frame['bias_low'], frame['bias_high'] = bootstrap_ci(estimated, actual, groups, len(labels),
+                                                                 'bias', n_boot, alpha, seed)
+        frame.insert(0, 'nutrient', nutrient)
+        first = runs.groupby(codes, sort=True)[list(by)].first().reset_index(drop=True)
+        frames.append(pd.concat([first, frame], axis=1))
+    if not frames:
+        return pd.DataFrame()
+    result = pd.concat(frames, ignore_index=True)
+    result['n'] = result['n'].astype(int)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy metrics across estimation runs")
+    parser.add_argument('--results-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             'estimation_results'))
+    parser.add_argument('--by', nargs='+', default=['run'], choices=['run'] + list(CONFIG_FIELDS),
+                        help="group by run (default) or by configuration fields")
+    parser.add_argument('--bootstrap', type=int, default=0, metavar='N',
+                        help="add percentile bootstrap CIs for MAE and bias with N replicates")
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--csv', help="also write the table to this CSV")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    run_store = RunStore(args.results_dir)
+    new_runs = run_store.refresh()
+    if new_runs:
+        logging.info(f"Ingested {len(new_runs)} new or changed runs")
+    table = summarize(run_store, by=args.by, n_boot=args.bootstrap, alpha=args.alpha)
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(table.round(3).to_string(index=False))
+    if args.csv:
+        table.to_csv(args.csv, index=False)
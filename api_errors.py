@@ -0,0 +1,72 @@
+import asyncio
+import json
+import ssl
+from typing import Optional
+
+import aiohttp
+
+# Statuses worth another attempt; any other 4xx will fail the same way again
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# Statuses that say nothing about the image: every request to the endpoint fails alike
+ENDPOINT_STATUSES = {401, 403, 404, 410}
+# OpenAI error codes that are terminal even when the status alone looks transient
+ENDPOINT_CODES = {'invalid_api_key', 'model_not_found', 'insufficient_quota', 'account_deactivated',
+                  'billing_hard_limit_reached', 'unsupported_country_region_territory'}
+
+
+class ApiError(Exception):
+    """A failed API call, classified for the retry loop and the circuit breaker.
+
+    retryable: another attempt may succeed (timeouts, resets, 429, 5xx).
+    endpoint_wide: not retryable, and every other request to the endpoint
+    will fail the same way (bad key, retired model, TLS trust failure).
+    """
+
+    def __init__(self, message: str, retryable: bool, endpoint_wide: bool = False,
+                 status: Optional[int] = None, code: Optional[str] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.endpoint_wide = endpoint_wide
+        self.status = status
+        self.code = code
+
+
+def _error_details(body: str):
+    """(code, message) from an OpenAI error body, tolerating non-JSON bodies."""
+    try:
+        error = json.loads(body).get('error') or {}
+    except (ValueError, AttributeError):
+        return None, body[:200]
+    if not isinstance(error, dict):
+        return None, str(error)[:200]
+    return error.get('code') or error.get('type'), error.get('message') or body[:200]
+
+
+def classify_response(status: int, body: str) -> ApiError:
+    """Classify an HTTP error response (or a 200 whose body is an error object)."""
+    code, message = _error_details(body)
+    if code in ENDPOINT_CODES:
+        return ApiError(f"{status} {code}: {message}", retryable=False, endpoint_wide=True, status=status, code=code)
+    if status in ENDPOINT_STATUSES:
+        return ApiError(f"{status}: {message}", retryable=False, endpoint_wide=True, status=status, code=code)
+    retryable = status in RETRYABLE_STATUSES or status >= 500 or (status == 200 and code == 'rate_limit_exceeded')
+    return ApiError(f"{status}: {message}", retryable=retryable, status=status, code=code)
+
+
+def classify_exception(error: BaseException) -> ApiError:
+    """Classify a client-side failure: TLS trust and bad URLs are terminal, the network is not."""
+    if isinstance(error, ApiError):
+        return error
+    if isinstance(error, (aiohttp.ClientConnectorCertificateError, ssl.SSLCertVerificationError)):
+        return ApiError(f"TLS certificate verification failed: {error}", retryable=False, endpoint_wide=True)
+    if isinstance(error, aiohttp.InvalidURL):
+        return ApiError(f"Invalid API URL: {error}", retryable=False, endpoint_wide=True)
+    if isinstance(error, aiohttp.ContentTypeError):
+        # Usually a proxy or load balancer answering with an HTML error page
+        return ApiError(f"Unexpected response body: {error}", retryable=True)
+    if isinstance(error, aiohttp.ClientResponseError):
+        return classify_response(error.status, error.message or '')
+    if isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, ssl.SSLError, ConnectionError, ValueError)):
+        # Connection resets, timeouts, truncated bodies, proxies answering with HTML
+        return ApiError(str(error) or type(error).__name__, retryable=True)
+    return ApiError(str(error) or type(error).__name__, retryable=False)
@@ -1,18 +1,23 @@
 import os
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, request, jsonify, render_template, send_from_directory, Response
 from werkzeug.utils import secure_filename
-import asyncio
-from dietgpt_start import CalorieEstimator, extract_nutrition
-from nutrition_matcher import enhance_nutrition_estimate
-import re
+from dietgpt_start import load_api_key
+from response_parser import parse_response
+from estimator_service import EstimatorService
+from jobs import JobManager, QueueFullError
+from nutrition_matcher import enhance_nutrition_estimate_async
 from sheets_manager import SheetsManager
-import streamlit as st
-import openai
+import metrics
+from structured_logging import log_payload
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
+# Async /estimate jobs: worker count, how many may wait, and how long results are kept
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 4))
+app.config['JOB_QUEUE_SIZE'] = int(os.environ.get('JOB_QUEUE_SIZE', 32))
+app.config['JOB_TTL'] = float(os.environ.get('JOB_TTL', 600))
 
 # Initialize Sheets Manager
 sheets_manager = SheetsManager()
@@ -23,45 +28,71 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_food_items(response: str) -> list:
-    # Find the "Food Items:" section and extract all items
-    food_section = re.search(r'Food Items:\s*((?:- [^\n]+\n?)+)', response)
-    if not food_section:
-        return []
-    
-    # Extract individual items
-    items = re.findall(r'- ([^\n]+)', food_section.group(1))
-    return items
-
 # Load API key once at startup
-api_key = st.secrets['OPENAI_API_KEY']
+api_key = load_api_key()
 if not api_key:
     raise ValueError("OPENAI_API_KEY not found in environment variables")
 
-async def analyze_food_image(image_path):
-    async with CalorieEstimator(api_key=api_key) as estimator:
-        result = await estimator.estimate_calories(image_path)
-        if result['success']:
-            nutrition = extract_nutrition(result['response'])
-            food_items = extract_food_items(result['response'])
-            
-            # Enhance nutrition estimates with database values
-            enhanced_result = enhance_nutrition_estimate(nutrition, food_items)
-            
-            return {
-                'success': True,
-                'llm_estimate': enhanced_result['llm_estimate'],
-                'db_estimate': enhanced_result['db_estimate'],
-                'food_items': food_items,
-                'food_matches': enhanced_result['food_matches'],
-                'unmatched_items': enhanced_result['unmatched_items'],
-                'confidence_score': enhanced_result['confidence_score'],
-                'details': result['response']
-            }
+# One estimator (and its keep-alive connection pool) shared by every request
+estimator_service = EstimatorService(api_key=api_key)
+job_manager = JobManager(
+    estimator_service,
+    workers=app.config['JOB_WORKERS'],
+    max_queue=app.config['JOB_QUEUE_SIZE'],
+    ttl=app.config['JOB_TTL']
+)
+
+async def analyze_food_image(image, image_name='<upload>'):
+    """image is a path or the uploaded bytes; bytes are decoded in memory."""
+    result = await estimator_service.estimator.estimate_image(image, image_name)
+    if result['success']:
+        with metrics.span('parse'):
+            parsed = parse_response(result['response'])
+            nutrition = parsed.nutrition()
+            food_items = parsed.food_item_texts()
+        
+        # Enhance nutrition estimates with database values
+        with metrics.span('db_match'):
+            enhanced_result = await enhance_nutrition_estimate_async(nutrition, food_items)
+        
         return {
-            'success': False,
-            'error': 'Failed to analyze food image'
+            'success': True,
+            'llm_estimate': enhanced_result['llm_estimate'],
+            'db_estimate': enhanced_result['db_estimate'],
+            'food_items': food_items,
+            'food_matches': enhanced_result['food_matches'],
+            'unmatched_items': enhanced_result['unmatched_items'],
+            'confidence_score': enhanced_result['confidence_score'],
+            'details': result['response']
         }
+    return {
+        'success': False,
+        'error': 'Failed to analyze food image'
+    }
+
+def frontend_result(result, filename):
+    """Shape an analyze_food_image result the way the upload page expects it."""
+    if not result['success']:
+        return {'success': False, 'error': result.get('error', 'Unknown error')}
+    return {
+        'success': True,
+        'llm_estimate': result['llm_estimate'],
+        'db_estimate': result['db_estimate'],
+        'food_items': result['food_items'],
+        'food_matches': result['food_matches'],
+        'unmatched_items': result['unmatched_items'],
+        'confidence_score': result['confidence_score'],
+        'details': result['details'],
+        'image_url': f'/uploads/{filename}'
+    }
+
+async def run_estimate_job(image_data, filename):
+    return frontend_result(await analyze_food_image(image_data, filename), filename)
+
+def save_upload(image_data, filepath):
+    # Only for /uploads/ display; the analysis itself reads from memory
+    with metrics.span('upload_save'), open(filepath, 'wb') as f:
+        f.write(image_data)
 
 @app.route('/')
 def home():
@@ -109,36 +140,67 @@ def estimate():
     try:
         filename = secure_filename(file.filename)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        image_data = file.read()
+        save_upload(image_data, filepath)
+
+        # ?async=1 (or form field mode=async) queues the analysis and returns a job id at once
+        if request.args.get('async') in ('1', 'true') or request.form.get('mode') == 'async':
+            try:
+                job = job_manager.submit(lambda: run_estimate_job(image_data, filename))
+            except QueueFullError as e:
+                response = jsonify({'error': 'Server busy, try again shortly'})
+                response.headers['Retry-After'] = str(int(e.retry_after))
+                return response, 503
+            return jsonify({
+                'job_id': job.id,
+                'status': job.status,
+                'status_url': f'/jobs/{job.id}',
+                'events_url': f'/jobs/{job.id}/events'
+            }), 202
         
         # Run food analysis
-        result = asyncio.run(analyze_food_image(filepath))
+        with metrics.span('analyze'):
+            result = estimator_service.run(analyze_food_image(image_data, filename))
         
-        print("RESULT TO FRONTEND:", result)
+        log_payload('frontend_result', result, always=not result.get('success'), image=filename)
         
-        if result['success']:
-            return jsonify({
-                'success': True,
-                'llm_estimate': result['llm_estimate'],
-                'db_estimate': result['db_estimate'],
-                'food_items': result['food_items'],
-                'food_matches': result['food_matches'],
-                'unmatched_items': result['unmatched_items'],
-                'confidence_score': result['confidence_score'],
-                'details': result['details'],
-                'image_url': f'/uploads/{filename}'
-            })
+        response = frontend_result(result, filename)
+        if response['success']:
+            return jsonify(response)
         else:
-            return jsonify({'error': result.get('error', 'Unknown error')}), 500
+            return jsonify({'error': response['error']}), 500
             
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return Response(job.stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/user-results/<username>')
 def get_user_results(username):
     try:
-        results = sheets_manager.get_user_results(username)
-        return jsonify(results)
+        limit = request.args.get('limit', type=int)
+        offset = request.args.get('offset', default=0, type=int)
+        results = sheets_manager.get_user_results(username, limit=limit, offset=offset)
+        response = jsonify(results)
+        response.headers['X-Total-Count'] = str(sheets_manager.count_user_results(username))
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -0,0 +1,298 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import aiohttp
+
+from checkpoint import ResultJournal
+from image_pipeline import preprocess_into_queue
+from near_duplicates import BKTree
+from scheduler import consume_queue
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+FINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+# Batch API limits per input file, with some headroom on the byte limit
+MAX_REQUESTS_PER_FILE = 50000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+# Submission rounds per run: images a round leaves without a result are sent again
+MAX_ROUNDS = 3
+
+
+class BatchRunner:
+    """Run calorie estimation through the OpenAI Batch API instead of live calls.
+
+    Requests are the exact payloads CalorieEstimator.build_payload sends on the
+    live path, so batch and live results are comparable. Progress (which
+    batches were submitted and which were collected) is kept in a small state
+    file next to the journal, so an interrupted run picks up its batches
+    again instead of resubmitting them. Images that end a round without a
+    successful result in the journal are submitted again in a new round.
+    """
+
+    def __init__(self, estimator, work_dir: str, poll_interval: float = 30.0):
+        self.estimator = estimator
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.state_path = os.path.join(work_dir, 'batch_state.json')
+        os.makedirs(work_dir, exist_ok=True)
+
+    @property
+    def api_base(self) -> str:
+        return self.estimator.api_base
+
+    # --- state ---------------------------------------------------------------
+    def load_state(self) -> Dict[str, Any]:
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {'labels': {}, 'batches': []}
+
+    def save_state(self, state: Dict[str, Any]):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    # --- input files ---------------------------------------------------------
+    async def write_requests(self, rows: Iterable[Tuple[str, str, Any]], journal: ResultJournal,
+                             make_record: Callable, labels: Dict[str, Any], round_number: int = 0) -> List[str]:
+        """Preprocess rows into Batch API JSONL files; returns the file paths.
+
+        Images whose result is already cached, exactly or as a near-duplicate,
+        are journaled straight away and left out of the batch; near-duplicates
+        of an image already in the batch wait for its answer instead of being
+        sent again.
+        """
+        paths: List[str] = []
+        current = {'file': None, 'count': 0, 'bytes': 0}
+        near = self.estimator.near_duplicates
+        variant = self.estimator.cache_variant()
+        in_batch = BKTree()
+
+        def open_next():
+            if current['file']:
+                current['file'].close()
+            path = os.path.join(self.work_dir, f"batch_input_{round_number}_{len(paths):03d}.jsonl")
+            paths.append(path)
+            current.update(file=open(path, 'w', encoding='utf-8'), count=0, bytes=0)
+
+        async def handle(item):
+            (image_path, img_path, actual), prepared = item
+            if isinstance(prepared, Exception):
+                journal.append({'img_path': img_path, 'success': False})
+                return
+            image_bytes, image_hash = prepared
+            cache = self.estimator.cache
+            key = self.estimator.cache_key(image_bytes)
+            cached = cache.get(key) if cache is not None else None
+            if cached is None and near is not None:
+                cached = near.lookup(image_hash, variant)
+            if cached is not None:
+                self.journal_record(journal, make_record, image_path, img_path, actual, cached['response'],
+                                    cached.get('near_duplicate_of'))
+                return
+            if near is not None:
+                matches = in_batch.find(image_hash, near.max_distance)
+                if matches:
+                    labels[img_path] = {'image_path': image_path, 'actual': actual, 'cache_key': key,
+                                        'duplicate_of': matches[0][2]}
+                    return
+                in_batch.add(image_hash, img_path)
+            base64_image = base64.b64encode(image_bytes).decode('utf-8')
+            line = json.dumps({
+                'custom_id': img_path,
+                'method': 'POST',
+                'url': BATCH_ENDPOINT,
+                'body': self.estimator.build_payload(base64_image),
+            }) + '\n'
+            size = len(line.encode('utf-8'))
+            if (current['file'] is None or current['count'] >= MAX_REQUESTS_PER_FILE
+                    or current['bytes'] + size > MAX_BYTES_PER_FILE):
+                open_next()
+            current['file'].write(line)
+            current['count'] += 1
+            current['bytes'] += size
+            labels[img_path] = {'image_path': image_path, 'actual': actual, 'cache_key': key,
+                                'image_hash': image_hash, 'input': paths[-1]}
+
+        queue = asyncio.Queue(maxsize=16)
+        producer = asyncio.create_task(preprocess_into_queue(rows, queue, image_path=lambda row: row[0],
+                                                             hashed=True))
+        try:
+            # One consumer keeps writes to the current file in order
+            await consume_queue(queue, handle, workers=1)
+            await producer
+        finally:
+            if current['file']:
+                current['file'].close()
+        return paths
+
+    # --- API calls -----------------------------------------------------------
+    async def upload(self, path: str) -> str:
+        with open(path, 'rb') as f:
+            form = aiohttp.FormData()
+            form.add_field('purpose', 'batch')
+            form.add_field('file', f, filename=os.path.basename(path), content_type='application/jsonl')
+            async with self.estimator.session.post(f"{self.api_base}/files", headers=self.estimator.headers,
+                                                   data=form) as response:
+                response.raise_for_status()
+                return (await response.json())['id']
+
+    async def create(self, input_file_id: str) -> Dict[str, Any]:
+        payload = {
+            'input_file_id': input_file_id,
+            'endpoint': BATCH_ENDPOINT,
+            'completion_window': '24h',
+        }
+        async with self.estimator.session.post(f"{self.api_base}/batches", headers=self.estimator.headers,
+                                               json=payload) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        async with self.estimator.session.get(f"{self.api_base}/batches/{batch_id}",
+                                              headers=self.estimator.headers) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def wait(self, batch_id: str) -> Dict[str, Any]:
+        while True:
+            batch = await self.retrieve(batch_id)
+            counts = batch.get('request_counts') or {}
+            logging.info(f"Batch {batch_id}: {batch.get('status')} "
+                         f"({counts.get('completed', 0)}/{counts.get('total', '?')} done)")
+            if batch.get('status') in FINAL_STATUSES:
+                return batch
+            await asyncio.sleep(self.poll_interval)
+
+    async def iter_output(self, file_id: str):
+        """Yield parsed output lines without loading the whole file into memory."""
+        async with self.estimator.session.get(f"{self.api_base}/files/{file_id}/content",
+                                              headers=self.estimator.headers) as response:
+            response.raise_for_status()
+            async for line in response.content:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    # --- run -----------------------------------------------------------------
+    @staticmethod
+    def journal_record(journal: ResultJournal, make_record: Callable, image_path: str, img_path: str,
+                       actual, response: Optional[str], duplicate_of: Optional[str] = None) -> bool:
+        record = make_record(image_path, actual, response) if response is not None else None
+        if record and duplicate_of:
+            record['near_duplicate_of'] = os.path.basename(duplicate_of)
+        journal.append(dict(record, img_path=img_path) if record else {'img_path': img_path, 'success': False})
+        return bool(record)
+
+    async def collect(self, batch: Dict[str, Any], journal: ResultJournal,
+                      make_record: Callable, labels: Dict[str, Any], input_path: str) -> int:
+        saved = 0
+        near = self.estimator.near_duplicates
+        followers: Dict[str, List[str]] = {}
+        for follower, label in labels.items():
+            if label.get('duplicate_of'):
+                followers.setdefault(label['duplicate_of'], []).append(follower)
+
+        def journal_with_followers(img_path: str, label: Dict[str, Any], content: Optional[str]) -> int:
+            count = self.journal_record(journal, make_record, label['image_path'], img_path,
+                                        label['actual'], content)
+            # Near-duplicates left out of the batch share this answer
+            for follower in followers.get(img_path, ()):
+                duplicate = labels[follower]
+                count += self.journal_record(journal, make_record, duplicate['image_path'], follower,
+                                             duplicate['actual'], content, label['image_path'])
+            return count
+
+        seen = set()
+        for file_key in ('output_file_id', 'error_file_id'):
+            file_id = batch.get(file_key)
+            if not file_id:
+                continue
+            async for line in self.iter_output(file_id):
+                img_path = line.get('custom_id')
+                label = labels.get(img_path)
+                if label is None:
+                    continue
+                seen.add(img_path)
+                response = line.get('response') or {}
+                content = None
+                choice = (response.get('body') or {}).get('choices', [{}])[0]
+                if response.get('status_code') == 200 and self.estimator.is_truncated(choice):
+                    logging.error(f"Batch response for {img_path} was cut off at max_tokens: "
+                                  f"{choice['message']['content']}")
+                elif response.get('status_code') == 200:
+                    content = self.estimator.normalize_response(choice['message']['content'])
+                    result = {'response': content, 'success': True}
+                    if self.estimator.cache is not None and self.estimator.is_cacheable(result):
+                        await asyncio.to_thread(self.estimator.cache.put, label['cache_key'], result)
+                    if near is not None and label.get('image_hash') is not None:
+                        near.add(label['image_hash'], self.estimator.cache_variant(), result, label['image_path'])
+                else:
+                    logging.error(f"Batch request for {img_path} failed: {line.get('error') or response}")
+                saved += journal_with_followers(img_path, label, content)
+        # Requests the batch never answered (expired, cancelled) fail with their followers
+        for img_path, label in labels.items():
+            if label.get('input') == input_path and img_path not in seen:
+                logging.error(f"Batch {batch.get('id')} returned no result for {img_path}")
+                saved += journal_with_followers(img_path, label, None)
+        return saved
+
+    async def submit(self, rows: Iterable[Tuple[str, str, Any]], journal: ResultJournal,
+                     make_record: Callable, state: Dict[str, Any]) -> int:
+        """Write rows into a new round of batches and submit them; returns the number submitted."""
+        state['round'] = state.get('round', -1) + 1
+        state['labels'] = {}
+        paths = await self.write_requests(rows, journal, make_record, state['labels'], state['round'])
+        for path in paths:
+            file_id = await self.upload(path)
+            batch = await self.create(file_id)
+            state['batches'].append({'id': batch['id'], 'input': path, 'collected': False})
+            self.save_state(state)
+            logging.info(f"Submitted batch {batch['id']} from {path}")
+        return len(paths)
+
+    async def collect_all(self, journal: ResultJournal, make_record: Callable, state: Dict[str, Any]) -> int:
+        """Wait for and collect every batch not collected yet."""
+        saved = 0
+        for entry in state['batches']:
+            if entry['collected']:
+                continue
+            batch = await self.wait(entry['id'])
+            if batch.get('status') != 'completed':
+                logging.error(f"Batch {entry['id']} ended with status {batch.get('status')}: {batch.get('errors')}")
+            saved += await self.collect(batch, journal, make_record, state['labels'], entry['input'])
+            entry['collected'] = True
+            self.save_state(state)
+        return saved
+
+    async def run(self, rows: Iterable[Tuple[str, str, Any]], journal: ResultJournal,
+                  make_record: Callable, max_rounds: int = MAX_ROUNDS) -> int:
+        """Collect batches a previous run submitted, then submit rounds until every row has a result.
+
+        The first round takes the rows not yet completed in the journal; each
+        later one resubmits the images the previous round left without a
+        successful result, up to max_rounds rounds.
+        """
+        state = self.load_state()
+        saved = 0
+        if state['batches']:
+            logging.info(f"Resuming {len(state['batches'])} submitted batches from {self.state_path}")
+            saved += await self.collect_all(journal, make_record, state)
+        for round_number in range(max_rounds):
+            done = journal.completed()
+            if round_number == 0:
+                pending = (row for row in rows if row[1] not in done)
+            else:
+                pending = [(label['image_path'], img_path, label['actual'])
+                           for img_path, label in state['labels'].items() if img_path not in done]
+                if not pending:
+                    break
+                logging.info(f"Resubmitting {len(pending)} images left without a result")
+            if not await self.submit(pending, journal, make_record, state):
+                break
+            saved += await self.collect_all(journal, make_record, state)
+        return saved
@@ -0,0 +1,213 @@
+"""End-to-end throughput/latency benchmark against the local mock OpenAI server.
+
+Starts mock_openai_server in-process (or uses --api-base), generates distinct
+synthetic food photos so no cache tier can short-circuit a request, and
+drives three entry points:
+
+  process_images  CalorieEstimator.process_images over every image
+  main            dietgpt_start.main() over a generated DATASET
+  flask           concurrent POSTs to app.py's /estimate route
+
+For each it reports images/sec, p50/p95/p99 per-image latency and what the
+mock server saw (requests, 429s, 5xx), along with how many images succeeded
+and how many attempts were retried.
+
+    python benchmark.py --images 200 --latency lognormal --latency-mean 1.0 --latency-spread 0.5 --rate-limit 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, List
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+from PIL import Image
+
+import metrics
+from checkpoint import ResultJournal, latest_journal
+
+import mock_openai_server
+
+
+def make_images(directory: str, count: int, size=(1600, 1200), seed: int = 0) -> List[str]:
+    """Write count distinct noise JPEGs; distinct bytes keep every cache lookup a miss."""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(count):
+        pixels = rng.integers(0, 256, size=(size[1] // 8, size[0] // 8, 3), dtype=np.uint8)
+        path = os.path.join(directory, f"bench_{i:05d}.jpg")
+        Image.fromarray(pixels).resize(size).save(path, format='JPEG', quality=90)
+        paths.append(path)
+    return paths
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    if not latencies:
+        return {'p50': float('nan'), 'p95': float('nan'), 'p99': float('nan')}
+    p50, p95, p99 = np.percentile(np.asarray(latencies), [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+
+@contextmanager
+def record_latencies(latencies: List[float]):
+    """Time every CalorieEstimator.estimate_prepared call while the block runs."""
+    from dietgpt_start import CalorieEstimator
+    original = CalorieEstimator.estimate_prepared
+
+    async def timed(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await original(self, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    CalorieEstimator.estimate_prepared = timed
+    try:
+        yield
+    finally:
+        CalorieEstimator.estimate_prepared = original
+
+
+async def mock_stats(api_base: str, reset: bool = False) -> Dict[str, Any]:
+    root = api_base.rsplit('/v1', 1)[0]
+    async with aiohttp.ClientSession() as session:
+        if reset:
+            async with session.post(f"{root}/_mock/reset") as response:
+                return await response.json()
+        async with session.get(f"{root}/_mock/stats") as response:
+            return await response.json()
+
+
+async def bench_process_images(api_base: str, images: List[str]) -> Dict[str, Any]:
+    from dietgpt_start import CalorieEstimator
+    latencies: List[float] = []
+    with record_latencies(latencies):
+        estimator = CalorieEstimator(api_key='sk-benchmark', api_base=api_base, use_cache=False)
+        start = time.perf_counter()
+        df = await estimator.process_images(images)
+        elapsed = time.perf_counter() - start
+    return {'images': len(images), 'succeeded': int(df['success'].sum()), 'elapsed': elapsed,
+            'latencies': latencies}
+
+
+async def bench_main(api_base: str, images: List[str], work_dir: str) -> Dict[str, Any]:
+    import dietgpt_start
+    dataset = os.path.join(work_dir, 'DATASET')
+    os.makedirs(dataset, exist_ok=True)
+    with open(os.path.join(dataset, 'processed_labels.csv'), 'w') as f:
+        f.write('img_path,calories\n')
+        for path in images:
+            f.write(f"{os.path.relpath(path, dataset)},500\n")
+    results_dir = os.path.join(work_dir, 'results')
+    latencies: List[float] = []
+    with record_latencies(latencies):
+        start = time.perf_counter()
+        await dietgpt_start.main(['--dataset', dataset, '--results-dir', results_dir, '--api-base', api_base])
+        elapsed = time.perf_counter() - start
+    # main() journals every image it finished; failures are not in completed()
+    journal = latest_journal(results_dir)
+    succeeded = len(ResultJournal(journal).completed()) if journal else 0
+    return {'images': len(images), 'succeeded': succeeded, 'elapsed': elapsed, 'latencies': latencies}
+
+
+def bench_flask(images: List[str], work_dir: str, concurrency: int) -> Dict[str, Any]:
+    import app as flask_app
+    flask_app.app.config['UPLOAD_FOLDER'] = os.path.join(work_dir, 'uploads')
+    os.makedirs(flask_app.app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    def post(path):
+        client = flask_app.app.test_client()
+        start = time.perf_counter()
+        with open(path, 'rb') as f:
+            response = client.post('/estimate', data={'username': 'benchmark', 'file': (f, os.path.basename(path))},
+                                   content_type='multipart/form-data')
+        return time.perf_counter() - start, response.status_code == 200
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(post, images))
+    elapsed = time.perf_counter() - start
+    return {'images': len(images), 'succeeded': sum(ok for _, ok in outcomes), 'elapsed': elapsed,
+            'latencies': [latency for latency, _ in outcomes]}
+
+
+def report(name: str, result: Dict[str, Any], stats: Dict[str, Any]) -> Dict[str, Any]:
+    row = {
+        'scenario': name,
+        'images': result['images'],
+        'succeeded': result['succeeded'],
+        'elapsed_s': round(result['elapsed'], 3),
+        'images_per_s': round(result['images'] / result['elapsed'], 2) if result['elapsed'] else None,
+        **{k: round(v, 3) for k, v in latency_summary(result['latencies']).items()},
+        'requests': stats.get('requests', 0),
+        'retries': result['retries'],
+        'rate_limited': stats.get('rate_limited', 0),
+        'server_errors': stats.get('server_errors', 0),
+    }
+    print(f"{name:>15}: {row['images_per_s']} img/s  p50={row['p50']}s p95={row['p95']}s p99={row['p99']}s  "
+          f"requests={row['requests']} retries={row['retries']} 429={row['rate_limited']} "
+          f"5xx={row['server_errors']}")
+    return row
+
+
+async def run(args) -> List[Dict[str, Any]]:
+    runner = None
+    api_base = args.api_base
+    if not api_base:
+        mock = mock_openai_server.MockOpenAI(mock_openai_server.config_from_args(args))
+        runner = web.AppRunner(mock_openai_server.create_app(mock))
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', args.port).start()
+        api_base = f"http://127.0.0.1:{args.port}/v1"
+    os.environ['OPENAI_BASE_URL'] = api_base
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-benchmark')
+
+    rows = []
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.environ['DIETGPT_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+            seed = 0
+            for scenario in args.scenarios:
+                # Fresh images per scenario so nothing is answered from the cache
+                image_dir = os.path.join(work_dir, f'images_{scenario}')
+                os.makedirs(image_dir)
+                images = make_images(image_dir, args.images, seed=seed)
+                seed += 1
+                await mock_stats(api_base, reset=True)
+                retries_before = metrics.RETRIES.value()
+                if scenario == 'process_images':
+                    result = await bench_process_images(api_base, images)
+                elif scenario == 'main':
+                    result = await bench_main(api_base, images, work_dir)
+                else:
+                    loop = asyncio.get_running_loop()
+                    result = await loop.run_in_executor(None, bench_flask, images, work_dir, args.concurrency)
+                result['retries'] = int(metrics.RETRIES.value() - retries_before)
+                rows.append(report(scenario, result, await mock_stats(api_base)))
+    finally:
+        if runner:
+            await runner.cleanup()
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark DietGPT against the local mock OpenAI server")
+    parser.add_argument('--images', type=int, default=50, help="images per scenario")
+    parser.add_argument('--scenarios', nargs='+', choices=['process_images', 'main', 'flask'],
+                        default=['process_images', 'main', 'flask'])
+    parser.add_argument('--concurrency', type=int, default=8, help="parallel clients for the flask scenario")
+    parser.add_argument('--api-base', help="use an already running server instead of starting one")
+    parser.add_argument('--port', type=int, default=8089, help="port for the in-process mock server")
+    parser.add_argument('--json', help="also write the results to this JSON file")
+    mock_openai_server.add_config_arguments(parser)
+    args = parser.parse_args()
+    results = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
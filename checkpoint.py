@@ -0,0 +1,96 @@
+import csv
+import glob
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Iterator, Optional, Set
+
+# Column order of the compacted estimation_openai_<timestamp>.csv
+RESULT_FIELDS = [
+    'image', 'img_path', 'actual_calories', 'estimated_calories', 'estimated_carbs',
+    'estimated_protein', 'estimated_fat', 'estimated_fiber', 'calorie_difference',
+    'actual_carbs', 'actual_protein', 'actual_fat', 'actual_fiber',
+    'llm_output', 'success', 'near_duplicate_of'
+]
+
+
+class ResultJournal:
+    """Append-only JSONL journal of per-image results.
+
+    Every record is flushed and fsynced as soon as it is written, so a crash
+    or Ctrl-C loses at most the request that was in flight. A torn last line
+    from a crash is skipped on read.
+    """
+
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._file = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def append(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            self.open()
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logging.warning(f"Skipping unreadable journal line {line_number} in {self.path}")
+
+    def completed(self) -> Set[str]:
+        """img_path of every image that already has a successful result."""
+        return {r['img_path'] for r in self.records() if r.get('success') and 'img_path' in r}
+
+    def compact(self, csv_path: str) -> int:
+        """Stream successful records into csv_path (one row per image); returns the row count."""
+        seen = set()
+        rows = 0
+        tmp_path = f"{csv_path}.tmp"
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            for record in self.records():
+                key = record.get('img_path')
+                if not record.get('success') or key in seen:
+                    continue
+                seen.add(key)
+                writer.writerow(record)
+                rows += 1
+        os.replace(tmp_path, csv_path)
+        return rows
+
+
+def latest_journal(results_dir: str) -> Optional[str]:
+    journals = sorted(glob.glob(os.path.join(results_dir, 'estimation_openai_*.jsonl')))
+    return journals[-1] if journals else None
@@ -1,7 +1,8 @@
 import logging
 import base64
+import hashlib
+import json
 import io
-import re
 import os
 import asyncio
 import aiohttp
@@ -9,46 +10,112 @@ import streamlit as st
 import openai
 
 from datetime import datetime
-from PIL import Image
 import pandas as pd
 from tenacity import (
     retry, wait_exponential, stop_after_attempt, retry_if_exception_type
 )
 from tqdm import tqdm
-from prompt import SYSTEM_PROMPT
+from prompt import SYSTEM_PROMPT, STRUCTURED_SYSTEM_PROMPT, RESPONSE_SCHEMA
+from result_cache import ResultCache, get_default_cache, make_cache_key
+from near_duplicates import NearDuplicateIndex, get_default_index
+from image_pipeline import (JPEG_QUALITY, MAX_IMAGE_SIZE, as_image_source, preprocess_async, preprocess_image,
+                            preprocess_into_queue)
+from shared_rate_limit import SharedRateLimiter, get_shared_rate_limiter
+from scheduler import AdaptiveConcurrency, LatencyTracker, consume_queue, get_circuit_breaker, parse_retry_after
+from api_errors import classify_exception, classify_response
+from checkpoint import ResultJournal, latest_journal
+from batch_runner import BatchRunner
+from response_parser import parse_response, parse_responses_bulk
+from nutrition_matcher import db_estimates_bulk, get_food_database
+from analytics import metadata_path, write_run_metadata
+import metrics
+from structured_logging import configure_logging, log_payload
 import ssl
 import certifi
 import time
 import random
-from typing import List, Dict, Any, Optional
-from io import BytesIO
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('diet_gpt.log'),
-        logging.StreamHandler()
-    ]
-)
+import argparse
+from typing import Awaitable, Callable, List, Dict, Any, Optional
+
+# Configure logging (queued, written by a background thread)
+configure_logging()
 
 # Create SSL context with certifi certificates
 ssl_context = ssl.create_default_context(cafile=certifi.where())
 ssl_context.check_hostname = True
 ssl_context.verify_mode = ssl.CERT_REQUIRED
 
+# Stands in for the base64 image while the request body template is serialized
+_IMAGE_PLACEHOLDER = "__DIETGPT_IMAGE_BASE64__"
+
+# Budget (seconds) for one estimate: limiter waits, every attempt and all backoff
+DEFAULT_DEADLINE = 120.0
+# Within it, each attempt gets this long to connect and to receive the first
+# (and every following) chunk of the response
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 60.0
+# Hedging delay until enough latencies have been seen to use their p95
+DEFAULT_HEDGE_DELAY = 10.0
+# Tokens reserved per request until responses report their actual usage
+DEFAULT_TOKENS_PER_REQUEST = 1500.0
+# Output budget per answer; a structured answer cut off at it is requested
+# again with twice the budget, up to MAX_TOKENS_LIMIT
+MAX_TOKENS = 150
+MAX_TOKENS_LIMIT = 600
+# processed_labels.csv columns carried into the actual_* result fields
+LABEL_FIELDS = {
+    'calories': 'actual_calories',
+    'carbs': 'actual_carbs',
+    'protein': 'actual_protein',
+    'fat': 'actual_fat',
+    'fiber': 'actual_fiber',
+}
+
+
 class CalorieEstimator:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, cache: Optional[ResultCache] = None, use_cache: bool = True,
+                 api_base: Optional[str] = None, response_mode: Optional[str] = None,
+                 near_duplicates: Optional[NearDuplicateIndex] = None, use_near_duplicates: bool = False,
+                 deadline: Optional[float] = None, hedge: bool = False,
+                 rate_limiter: Optional[SharedRateLimiter] = None, wait_on_breaker: bool = True):
         self.api_key = api_key
-        self.system_prompt = SYSTEM_PROMPT
-        self.api_url = "https://api.openai.com/v1/chat/completions"
+        # 'text' asks for the SYSTEM_PROMPT format; 'json' for compact schema-constrained JSON
+        self.set_response_mode(response_mode or os.environ.get('DIETGPT_RESPONSE_MODE', 'text'))
+        # OPENAI_BASE_URL lets every entry point talk to a local stand-in server
+        self.api_base = (api_base or os.environ.get('OPENAI_BASE_URL') or "https://api.openai.com/v1").rstrip('/')
+        self.api_url = f"{self.api_base}/chat/completions"
+        # Shared by every estimator in the process that talks to the same endpoint
+        self.breaker = get_circuit_breaker(self.api_url)
         self.headers = {"Authorization": f"Bearer {self.api_key}"}
+        # For the pre-serialized chat body, which goes out as raw bytes
+        self.json_headers = dict(self.headers, **{"Content-Type": "application/json"})
         self.model = "gpt-4o-mini"
         self.session = None
-        self.semaphore = asyncio.Semaphore(3)  # Limit concurrent requests
+        # RPM/TPM budget shared with every other process on the host using this API and model
+        self.rate_limiter = rate_limiter or get_shared_rate_limiter(f"{self.api_base}|{self.model}")
+        self.estimated_tokens = DEFAULT_TOKENS_PER_REQUEST
+        # Concurrency adapts to 429s and x-ratelimit-* headers (AIMD), starting at 3
+        self.limiter = AdaptiveConcurrency(
+            initial=3, max_limit=int(os.environ.get('DIETGPT_MAX_CONCURRENCY', 16))
+        )
         self.retry_delay = 1.0  # Initial retry delay in seconds
+        self.deadline = deadline or float(os.environ.get('DIETGPT_REQUEST_DEADLINE', DEFAULT_DEADLINE))
+        # Interactive callers send a second copy of a request that outlives the observed p95
+        self.hedge = hedge
+        # Dataset runs wait out an open breaker (transient failures only) instead of failing items
+        self.wait_on_breaker = wait_on_breaker
+        self.latency = LatencyTracker()
+        self.hedges = 0
         self.ssl_context = ssl.create_default_context(cafile=certifi.where())
+        # Results are content-addressed, so repeat uploads never hit the API twice
+        self.cache = (cache or get_default_cache()) if use_cache else None
+        # Opt-in (dataset runs): re-shares and burst shots of the same plate reuse a
+        # perceptually close result instead of getting their own estimate
+        if near_duplicates is None and use_near_duplicates:
+            near_duplicates = get_default_index()
+        self.near_duplicates = near_duplicates if use_cache else None
+        # Serialized request body around the image, per response mode
+        self._body_parts: Dict[str, tuple] = {}
         
     async def __aenter__(self):
         await self.create_session()
@@ -59,174 +126,424 @@ class CalorieEstimator:
         
     async def create_session(self):
         if not self.session:
-            connector = aiohttp.TCPConnector(ssl=self.ssl_context)
-            self.session = aiohttp.ClientSession(connector=connector)
+            # Keep-alive pool sized to the limiter, so long-lived estimators
+            # reuse TLS connections instead of handshaking per request
+            connector = aiohttp.TCPConnector(
+                ssl=self.ssl_context,
+                limit=self.limiter.max_limit * 2,
+                keepalive_timeout=75,
+                ttl_dns_cache=300
+            )
+            # No total here: batch file uploads/downloads may take long; estimates
+            # get their total from the per-call deadline
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
 
     async def close_session(self):
         if self.session:
             await self.session.close()
             self.session = None
 
+    def prepare_image(self, image_path: str) -> bytes:
+        """Return the normalized JPEG bytes that are sent to the API."""
+        return preprocess_image(image_path)
+
     def encode_image(self, image_path: str) -> str:
-        with Image.open(image_path) as img:
-            # Convert to RGB if necessary
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            # Resize if the image is too large
-            max_size = 768
-            if max(img.size) > max_size:
-                ratio = max_size / max(img.size)
-                new_size = tuple(int(dim * ratio) for dim in img.size)
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-            # Convert to JPEG and encode
-            buffer = BytesIO()
-            img.save(buffer, format='JPEG', quality=85)
-            return base64.b64encode(buffer.getvalue()).decode('utf-8')
+        return base64.b64encode(self.prepare_image(image_path)).decode('utf-8')
+
+    def set_response_mode(self, mode: str):
+        if mode not in ('text', 'json'):
+            raise ValueError(f"Unknown response mode: {mode}")
+        self.response_mode = mode
+        self.system_prompt = STRUCTURED_SYSTEM_PROMPT if mode == 'json' else SYSTEM_PROMPT
+
+    def cache_key(self, image_bytes: bytes) -> str:
+        return make_cache_key(image_bytes, self.model, self.system_prompt, self.response_mode)
+
+    def cache_variant(self) -> str:
+        """Identifies model + prompt + response mode, i.e. which answers are interchangeable."""
+        return self.cache_key(b'')
+
+    def is_truncated(self, choice: Dict[str, Any]) -> bool:
+        """A structured answer cut off at max_tokens: the JSON is incomplete."""
+        return self.response_mode == 'json' and choice.get('finish_reason') == 'length'
+
+    @staticmethod
+    def is_cacheable(result: Dict[str, Any]) -> bool:
+        """Only first-hand answers with a calorie total are worth replaying for the same image.
+
+        An answer borrowed from a near-duplicate is not stored under this
+        image's exact key, so a later upload still gets its own estimate.
+        """
+        if result.get('near_duplicate_of'):
+            return False
+        return parse_response(result.get('response') or '').calories is not None
+
+    def normalize_response(self, content: str) -> str:
+        """Render structured answers in the text format every consumer already understands."""
+        if self.response_mode == 'json' and content and content.lstrip().startswith('{'):
+            return parse_response(content).to_text()
+        return content
 
     async def estimate_calories(self, image_path: str, max_retries: int = 5) -> Dict[str, Any]:
+        return await self.estimate_image(image_path, image_path, max_retries)
+
+    async def estimate_image(self, image, image_name: str = '<memory>', max_retries: int = 5) -> Dict[str, Any]:
+        """Estimate from a path, bytes/bytearray/memoryview or a file-like object.
+
+        In-memory inputs are decoded straight from the buffer, so uploads
+        never have to be written to disk and read back.
+        """
         if not self.session:
             await self.create_session()
-            
-        async with self.semaphore:  # Limit concurrent requests
-            retry_count = 0
-            current_delay = self.retry_delay
-
-            while retry_count < max_retries:
-                try:
-                    base64_image = self.encode_image(image_path)
-                    
-                    payload = {
-                        "model": self.model,
-                        "messages": [
-                            {
-                                "role": "system",
-                                "content": self.system_prompt
-                            },
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "text",
-                                        "text": "Please analyze this food image and estimate the total calories."
-                                    },
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {
-                                            "url": f"data:image/jpeg;base64,{base64_image}"
-                                        }
-                                    }
-                                ]
+
+        try:
+            # Decode/resize (and hash, for near-duplicate lookups) once, in the
+            # preprocessing pool, not on every retry
+            image_hash = None
+            if self.near_duplicates is None:
+                image_bytes = await preprocess_async(as_image_source(image))
+            else:
+                image_bytes, image_hash = await preprocess_async(as_image_source(image), hashed=True)
+        except Exception as e:
+            logging.error(f"Error processing {image_name}: {str(e)}")
+            return {
+                'response': f"Could not read image: {str(e)}",
+                'success': False
+            }
+        return await self.estimate_prepared(image_bytes, image_name, max_retries, image_hash)
+
+    async def estimate_prepared(self, image_bytes: bytes, image_path: str = '<memory>',
+                                max_retries: int = 5, image_hash: Optional[int] = None) -> Dict[str, Any]:
+        """Estimate from JPEG bytes already produced by the preprocessing stage.
+
+        Lookups go exact cache, then (given the image's dHash) the
+        near-duplicate index, then the API.
+        """
+        if not self.session:
+            await self.create_session()
+
+        started = time.perf_counter()
+        request = lambda: self._request_estimate(image_bytes, image_path, max_retries)
+        near = self.near_duplicates if image_hash is not None else None
+        compute = request
+        if near is not None:
+            variant = self.cache_variant()
+            compute = lambda: near.get_or_compute(image_hash, variant, image_path, request)
+
+        if self.cache is None:
+            result = await compute()
+        else:
+            result = await self.cache.get_or_compute(self.cache_key(image_bytes), compute, self.is_cacheable)
+            if near is not None and result.get('cached') and result.get('success'):
+                # Exact hits (e.g. from the disk tier after a restart) seed the index too
+                near.add(image_hash, variant, result, image_path)
+        self.record_estimate(result, time.perf_counter() - started, near is not None)
+        return result
+
+    def record_estimate(self, result: Dict[str, Any], seconds: float, used_near_duplicates: bool):
+        metrics.observe_stage('estimate', seconds)
+        metrics.ESTIMATES.inc(outcome='success' if result.get('success') else 'failure')
+        if result.get('cached'):
+            metrics.CACHE_LOOKUPS.inc(tier='exact', result='hit')
+            return
+        if self.cache is not None:
+            metrics.CACHE_LOOKUPS.inc(tier='exact', result='miss')
+        if used_near_duplicates:
+            metrics.CACHE_LOOKUPS.inc(tier='near_duplicate',
+                                      result='hit' if result.get('near_duplicate_of') else 'miss')
+
+    def build_payload(self, base64_image: str, max_tokens: int = MAX_TOKENS) -> Dict[str, Any]:
+        payload = {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": self.system_prompt
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": "Please analyze this food image and estimate the total calories."
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:image/jpeg;base64,{base64_image}"
                             }
-                        ],
-                        "max_tokens": 150
-                    }
+                        }
+                    ]
+                }
+            ],
+            "max_tokens": max_tokens
+        }
+        if self.response_mode == 'json':
+            payload["response_format"] = {"type": "json_schema", "json_schema": RESPONSE_SCHEMA}
+        return payload
+
+    def build_request_body(self, image_bytes: bytes, max_tokens: int = MAX_TOKENS) -> bytes:
+        """The serialized build_payload body, with the base64 image spliced in.
+
+        Everything around the image is serialized once per response mode; a
+        request only base64-encodes the image and joins three byte strings,
+        and the result is reused as-is on every retry.
+        """
+        parts = self._body_parts.get((self.response_mode, max_tokens))
+        if parts is None:
+            template = json.dumps(self.build_payload(_IMAGE_PLACEHOLDER, max_tokens)).encode('utf-8')
+            prefix, suffix = template.split(_IMAGE_PLACEHOLDER.encode('utf-8'))
+            parts = self._body_parts[(self.response_mode, max_tokens)] = (prefix, suffix)
+        return b''.join((parts[0], base64.b64encode(image_bytes), parts[1]))
+
+    def record_usage(self, usage: Optional[Dict[str, Any]], reserved: float):
+        """Settle the tokens reserved for a request against its reported usage."""
+        used = (usage or {}).get('total_tokens')
+        if not used:
+            return
+        self.rate_limiter.settle(used - reserved)
+        # Later reservations follow what requests actually cost
+        self.estimated_tokens += 0.2 * (used - self.estimated_tokens)
+
+    async def _request_estimate(self, image_bytes: bytes, image_path: str, max_retries: int) -> Dict[str, Any]:
+        """Call the API within self.deadline, hedging the request if self.hedge is set."""
+        deadline_at = time.monotonic() + self.deadline
+        attempt = lambda: self._request_with_retries(image_bytes, image_path, max_retries, deadline_at)
+        try:
+            return await asyncio.wait_for(self._hedged(attempt, image_path) if self.hedge else attempt(),
+                                          self.deadline)
+        except asyncio.TimeoutError:
+            logging.error(f"Error processing {image_path}: no answer within {self.deadline:g}s")
+            return {
+                'response': "Deadline exceeded",
+                'success': False
+            }
+
+    async def _hedged(self, attempt: Callable[[], Awaitable[Dict[str, Any]]], image_path: str) -> Dict[str, Any]:
+        """Run attempt(); if it outlives the observed p95, race a second copy and keep the first answer."""
+        tasks = {asyncio.ensure_future(attempt())}
+        try:
+            delay = self.latency.quantile(0.95) or DEFAULT_HEDGE_DELAY
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            # No hedging while rate limited: the copy would only queue behind the pause
+            if not done and self.limiter.paused_until <= time.monotonic():
+                logging.info(f"Hedging request for {image_path} after {delay:.2f}s")
+                self.hedges += 1
+                metrics.HEDGES.inc()
+                tasks.add(asyncio.ensure_future(attempt()))
+            result = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result['success']:
+                        return result
+            return result
+        finally:
+            # The slower copy is cancelled, which also frees its limiter slot
+            for task in tasks:
+                task.cancel()
 
-                    async with self.session.post(self.api_url, headers=self.headers, json=payload) as response:
+    async def _wait_for_breaker(self, deadline_at: float) -> bool:
+        """Sleep until the breaker would let a call through; False if the caller should fail instead.
+
+        Never waits for endpoint-wide failures (bad key, retired model): the
+        probe that follows would fail the same way.
+        """
+        while True:
+            wait = self.breaker.retry_in()
+            if wait <= 0:
+                return True
+            if not self.wait_on_breaker or self.breaker.endpoint_wide or time.monotonic() + wait >= deadline_at:
+                return False
+            # Polled, so waiters go as soon as a probe closes the breaker
+            await asyncio.sleep(min(wait, 1.0))
+
+    async def _request_with_retries(self, image_bytes: bytes, image_path: str, max_retries: int,
+                                    deadline_at: float) -> Dict[str, Any]:
+        retry_count = 0
+        current_delay = self.retry_delay
+        max_tokens = MAX_TOKENS
+        body = self.build_request_body(image_bytes, max_tokens)
+
+        def rejected():
+            metrics.BREAKER_REJECTIONS.inc()
+            return {
+                'response': f"API unavailable: {self.breaker.reason}",
+                'success': False
+            }
+
+        while retry_count < max_retries:
+            if self.breaker.rejects() and not await self._wait_for_breaker(deadline_at):
+                # The endpoint keeps failing: refuse straight away instead of queueing into backoff
+                return rejected()
+            try:
+                reserved = self.estimated_tokens
+                with metrics.span('rate_budget_wait'):
+                    acquired = self.rate_limiter is None or await self.rate_limiter.acquire(
+                        reserved, max_wait=deadline_at - time.monotonic())
+                if not acquired:
+                    logging.error(f"Error processing {image_path}: rate budget exhausted until past the deadline")
+                    return {
+                        'response': "Deadline exceeded",
+                        'success': False
+                    }
+                # Hold a limiter slot only while the request is on the wire
+                queued = time.perf_counter()
+                async with self.limiter:
+                    metrics.observe_stage('concurrency_wait', time.perf_counter() - queued)
+                    # Checked again once a slot is free: the breaker may have opened meanwhile
+                    if not self.breaker.allow():
+                        if self.wait_on_breaker and not self.breaker.endpoint_wide:
+                            # Another call holds the probe: wait for its outcome at the top
+                            continue
+                        return rejected()
+                    started = time.monotonic()
+                    timeout = aiohttp.ClientTimeout(total=max(deadline_at - started, 0.001),
+                                                    sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+                    async with self.session.post(self.api_url, headers=self.json_headers, data=body,
+                                                 timeout=timeout) as response:
                         if response.status == 429:  # Rate limit exceeded
-                            retry_after = float(response.headers.get('Retry-After', current_delay))
-                            await asyncio.sleep(retry_after)
+                            error_text = await response.text()
+                            if 'insufficient_quota' in error_text:
+                                # Out of credit, not out of rate: waiting won't help
+                                raise classify_response(response.status, error_text)
+                            retry_after = parse_retry_after(response.headers, current_delay)
+                            # Pauses every caller until Retry-After, so no sleep of our own
+                            self.limiter.on_rate_limited(retry_after, response.headers)
+                            if self.rate_limiter is not None:
+                                self.rate_limiter.on_rate_limited(retry_after)
+                            metrics.API_REQUESTS.inc(outcome='rate_limited')
+                            metrics.RETRIES.inc()
                             current_delay = min(current_delay * 2, 60)  # Exponential backoff, max 60 seconds
                             retry_count += 1
                             continue
 
-                        response.raise_for_status()
-                        result = await response.json()
-                        
-                        if 'error' in result:
-                            if 'Rate limit' in result['error'].get('message', ''):
-                                await asyncio.sleep(current_delay)
-                                current_delay = min(current_delay * 2, 60)
-                                retry_count += 1
+                        if response.status >= 400:
+                            error_text = await response.text()
+                            if response.status == 400 and self.response_mode == 'json' and (
+                                    'response_format' in error_text or 'json_schema' in error_text):
+                                # Model/endpoint without structured outputs: fall back to text
+                                logging.warning(f"Structured output not supported by {self.model}, using text mode")
+                                self.set_response_mode('text')
+                                body = self.build_request_body(image_bytes, max_tokens)
                                 continue
-                            raise Exception(f"API request failed: {result}")
+                            raise classify_response(response.status, error_text)
 
-                        return {
-                            'response': result['choices'][0]['message']['content'],
-                            'success': True
-                        }
+                        result = await response.json()
+                        headers = response.headers
+                    elapsed = time.monotonic() - started
+                    self.latency.observe(elapsed)
+                    metrics.observe_stage('api_request', elapsed)
 
-                except Exception as e:
-                    logging.error(f"Error processing {image_path}: {str(e)}")
-                    if retry_count < max_retries - 1:
-                        await asyncio.sleep(current_delay)
+                if 'error' in result:
+                    if 'Rate limit' in result['error'].get('message', ''):
+                        metrics.API_REQUESTS.inc(outcome='rate_limited')
+                        metrics.RETRIES.inc()
+                        self.limiter.on_rate_limited(current_delay, headers)
                         current_delay = min(current_delay * 2, 60)
                         retry_count += 1
-                    else:
+                        continue
+                    raise classify_response(200, json.dumps(result))
+
+                self.breaker.record_success()
+                metrics.API_REQUESTS.inc(outcome='ok')
+                for kind in ('prompt', 'completion'):
+                    metrics.TOKENS.inc((result.get('usage') or {}).get(f'{kind}_tokens', 0), kind=kind)
+                self.limiter.on_success(headers)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.apply_headers(headers)
+                    self.record_usage(result.get('usage'), reserved)
+                choice = result['choices'][0]
+                if self.is_truncated(choice):
+                    # Cut-off JSON parses to nothing; never pass it on as a success
+                    if max_tokens < MAX_TOKENS_LIMIT:
+                        max_tokens = min(max_tokens * 2, MAX_TOKENS_LIMIT)
+                        logging.warning(f"Response for {image_path} was cut off, retrying with max_tokens={max_tokens}")
+                        body = self.build_request_body(image_bytes, max_tokens)
+                        continue
+                    return {
+                        'response': f"Truncated response: {choice['message']['content']}",
+                        'success': False
+                    }
+                if choice.get('finish_reason') == 'length':
+                    logging.warning(f"Response for {image_path} was cut off at max_tokens")
+                return {
+                    'response': self.normalize_response(choice['message']['content']),
+                    'success': True
+                }
+
+            except Exception as e:
+                error = classify_exception(e)
+                metrics.API_REQUESTS.inc(outcome='error' if error.retryable else 'terminal')
+                logging.error(f"Error processing {image_path}: {error}")
+                if error.retryable or error.endpoint_wide:
+                    self.breaker.record_failure(str(error), error.endpoint_wide)
+                if not error.retryable:
+                    # Bad key, retired model, rejected image...: another attempt fails the same way
+                    return {
+                        'response': f"Request failed: {error}",
+                        'success': False
+                    }
+                if retry_count < max_retries - 1:
+                    if time.monotonic() + current_delay >= deadline_at:
+                        # Backing off would run past the deadline anyway
                         return {
-                            'response': "Max retries exceeded",
+                            'response': "Deadline exceeded",
                             'success': False
                         }
+                    await asyncio.sleep(current_delay)
+                    current_delay = min(current_delay * 2, 60)
+                    retry_count += 1
+                    metrics.RETRIES.inc()
+                else:
+                    return {
+                        'response': "Max retries exceeded",
+                        'success': False
+                    }
 
-            return {
-                'response': "Max retries exceeded",
-                'success': False
-            }
+        return {
+            'response': "Max retries exceeded",
+            'success': False
+        }
 
     async def process_images(self, image_paths: List[str]) -> pd.DataFrame:
         await self.create_session()
         
-        results = []
-        batch_size = 5  # Process images in small batches
-        
-        for i in range(0, len(image_paths), batch_size):
-            batch = image_paths[i:i + batch_size]
-            tasks = [self.estimate_calories(img_path) for img_path in batch]
-            batch_results = await asyncio.gather(*tasks)
-            
-            for img_path, result in zip(batch, batch_results):
-                print(f"LLM Output: {result['response']}")
-                results.append({
-                    'image_path': img_path,
-                    'response': result['response'],
-                    'success': result['success']
-                })
-            
-            # Add a small delay between batches
-            await asyncio.sleep(2)
-        
+        results = [None] * len(image_paths)
+        # Preprocessing runs ahead in the process pool; the bounded queue keeps
+        # it only a little in front of the network stage
+        queue = asyncio.Queue(maxsize=self.limiter.max_limit * 2)
+        producer = asyncio.create_task(
+            preprocess_into_queue(enumerate(image_paths), queue, image_path=lambda item: item[1],
+                                  consumers=self.limiter.max_limit, hashed=True)
+        )
+
+        async def handle(item):
+            (index, img_path), prepared = item
+            if isinstance(prepared, Exception):
+                result = {'response': f"Could not read image: {str(prepared)}", 'success': False}
+            else:
+                image_bytes, image_hash = prepared
+                result = await self.estimate_prepared(image_bytes, img_path, image_hash=image_hash)
+            log_payload('llm_output', result['response'], always=not result['success'], image=img_path)
+            results[index] = {
+                'image_path': img_path,
+                'response': result['response'],
+                'success': result['success']
+            }
+
+        # Workers stream through the queue; the limiter sets the real concurrency
+        await consume_queue(queue, handle, workers=self.limiter.max_limit)
+        await producer
         await self.close_session()
         return pd.DataFrame(results)
 
 def extract_nutrition(response: str) -> Dict[str, Optional[float]]:
-    print("LLM RAW RESPONSE:\n", response)
+    logging.debug("LLM raw response: %s", response)
     try:
-        nutrition = {
-            'calories': None,
-            'carbohydrates': None,
-            'protein': None,
-            'fat': None,
-            'fiber': None
-        }
-        # Extract calories
-        calories_pattern = r'^CALORIES:\s*(\d+)'
-        match = re.search(calories_pattern, response.strip())
-        if match:
-            nutrition['calories'] = float(match.group(1))
-        else:
-            calories_pattern = r'CALORIES:\s*(\d+)'
-            match = re.search(calories_pattern, response)
-            if match:
-                nutrition['calories'] = float(match.group(1))
-        # Extract macronutrients
-        carbs_pattern = r'Carbohydrates:\s*(\d+)g'
-        protein_pattern = r'Protein:\s*(\d+)g'
-        fat_pattern = r'Fat:\s*(\d+)g'
-        fiber_pattern = r'Fiber[:\s]*([\d\.]+)g|Fibre[:\s]*([\d\.]+)g|Dietary fiber[:\s]*([\d\.]+)g'
-        carbs_match = re.search(carbs_pattern, response)
-        protein_match = re.search(protein_pattern, response)
-        fat_match = re.search(fat_pattern, response)
-        fiber_match = re.search(fiber_pattern, response, re.IGNORECASE)
-        if carbs_match:
-            nutrition['carbohydrates'] = float(carbs_match.group(1))
-        if protein_match:
-            nutrition['protein'] = float(protein_match.group(1))
-        if fat_match:
-            nutrition['fat'] = float(fat_match.group(1))
-        if fiber_match:
-            fiber_val = next((g for g in fiber_match.groups() if g), None)
-            if fiber_val is not None:
-                nutrition['fiber'] = float(fiber_val)
-        return nutrition
+        return parse_response(response).nutrition()
     except Exception as e:
         logging.error(f"Error extracting nutrition: {str(e)}")
         return {
@@ -237,38 +554,149 @@ def extract_nutrition(response: str) -> Dict[str, Optional[float]]:
             'fiber': None
         }
 
-async def process_single_image(estimator, image_path, actual_calories=None):
+def build_result_record(image_path, actual: Optional[Dict[str, Any]], response: str) -> Optional[Dict[str, Any]]:
+    """Turn one LLM response into a results row, or None if it has no calorie total.
+
+    actual holds the image's labels (calories and any macros) as yielded by
+    iter_dataset_rows.
+    """
+    with metrics.span('parse'):
+        nutrition = extract_nutrition(response)
+    if nutrition['calories'] is None:
+        return None
+    actual = actual or {}
+    actual_calories = actual.get('calories')
+    record = {
+        'image': os.path.basename(image_path),
+        'estimated_calories': nutrition['calories'],
+        'estimated_carbs': nutrition['carbohydrates'],
+        'estimated_protein': nutrition['protein'],
+        'estimated_fat': nutrition['fat'],
+        'estimated_fiber': nutrition['fiber'],
+        'calorie_difference': abs(nutrition['calories'] - actual_calories) if actual_calories is not None else None,
+        'llm_output': response or 'N/A',
+        'success': True
+    }
+    for label, field in LABEL_FIELDS.items():
+        record[field] = actual.get(label)
+    return record
+
+async def process_single_image(estimator, image_path, actual=None, image_bytes=None, image_hash=None):
     try:
-        result = await estimator.estimate_calories(image_path)
+        if image_bytes is None:
+            result = await estimator.estimate_calories(image_path)
+        elif isinstance(image_bytes, Exception):
+            result = {'response': f"Could not read image: {str(image_bytes)}", 'success': False}
+        else:
+            result = await estimator.estimate_prepared(image_bytes, image_path, image_hash=image_hash)
         if result.get('success'):
-            nutrition = extract_nutrition(result.get('response', ''))
-            if nutrition['calories'] is not None:
-                return {
-                    'image': os.path.basename(image_path),
-                    'actual_calories': float(actual_calories) if actual_calories else None,
-                    'estimated_calories': nutrition['calories'],
-                    'estimated_carbs': nutrition['carbohydrates'],
-                    'estimated_protein': nutrition['protein'],
-                    'estimated_fat': nutrition['fat'],
-                    'estimated_fiber': nutrition['fiber'],
-                    'calorie_difference': abs(nutrition['calories'] - float(actual_calories)) if actual_calories else None,
-                    'llm_output': result.get('response', 'N/A'),
-                    'success': True
-                }
+            record = build_result_record(image_path, actual, result.get('response', ''))
+            if record:
+                if result.get('near_duplicate_of'):
+                    # Flag reused answers so evaluations can tell them apart
+                    record['near_duplicate_of'] = os.path.basename(result['near_duplicate_of'])
+                return record
         logging.error(f"Error processing {image_path}: {result.get('response', 'Unknown error')}\nLLM Output: {result.get('response', 'No output')}")
         return None
     except Exception as e:
         logging.error(f"Exception processing {image_path}: {str(e)}")
         return None
 
-async def main():
+def load_api_key() -> str:
+    """OPENAI_API_KEY from the environment, falling back to Streamlit secrets."""
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if api_key:
+        return api_key
+    try:
+        return st.secrets['OPENAI_API_KEY']
+    except (KeyError, FileNotFoundError):
+        return None
+
+def _label(value) -> Optional[float]:
+    return None if pd.isna(value) else float(value)
+
+def iter_dataset_rows(dataset_path: str, csv_path: str, skip=frozenset(), chunksize: int = 1000):
+    """Yield (image_path, img_path, actual) for labelled images, reading the CSV in chunks.
+
+    actual maps each LABEL_FIELDS column present in the CSV (calories and
+    optionally carbs, protein, fat, fiber) to its value or None.
+    """
+    for index, chunk in enumerate(pd.read_csv(csv_path, chunksize=chunksize)):
+        chunk = chunk.dropna(subset=['calories'])
+        labels = [label for label in LABEL_FIELDS if label in chunk.columns]
+        if index == 0 and len(labels) < len(LABEL_FIELDS):
+            missing = ', '.join(label for label in LABEL_FIELDS if label not in labels)
+            logging.warning(f"{csv_path} has no {missing} column(s); analytics will not score those nutrients")
+        for img_path, *values in zip(chunk['img_path'], *(chunk[label] for label in labels)):
+            if img_path in skip:
+                continue
+            image_path = os.path.join(dataset_path, img_path)
+            if os.path.exists(image_path):
+                yield image_path, img_path, {label: _label(value) for label, value in zip(labels, values)}
+
+async def run_live(estimator, rows, journal: ResultJournal):
+    """Stream rows through preprocessing and live API calls, journaling each result."""
+    # Images are decoded in the process pool while others wait on the network
+    workers = estimator.limiter.max_limit
+    queue = asyncio.Queue(maxsize=workers * 2)
+    producer = asyncio.create_task(
+        preprocess_into_queue(rows, queue, image_path=lambda row: row[0], consumers=workers, hashed=True)
+    )
+
+    with journal, tqdm(desc="Processing images", unit="img") as pbar:
+        async def handle(item):
+            (image_path, img_path, actual), prepared = item
+            image_bytes, image_hash = (prepared, None) if isinstance(prepared, Exception) else prepared
+            result = await process_single_image(estimator, image_path, actual, image_bytes, image_hash)
+            if result:
+                journal.append(dict(result, img_path=img_path))
+            else:
+                journal.append({'img_path': img_path, 'success': False})
+            pbar.update(1)
+
+        await consume_queue(queue, handle, workers=workers)
+    await producer
+
+def log_db_cross_check(csv_path: str):
+    """Compare the LLM totals of a run with the food-database totals of the same items."""
+    db = get_food_database()
+    if db is None:
+        return
+    run = pd.read_csv(csv_path, usecols=['estimated_calories', 'llm_output'])
+    db_totals = db_estimates_bulk(parse_responses_bulk(run['llm_output'])['food_items'], db)
+    gap = (run['estimated_calories'] - db_totals['db_calories']).abs()
+    logging.info(f"Food database cross-check: {int(gap.notna().sum())}/{len(run)} meals matched, "
+                 f"mean |LLM - DB| calories {gap.mean():.2f}, "
+                 f"mean items matched {db_totals['matched_share'].mean():.0%}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Estimate calories for every image in DATASET/processed_labels.csv")
+    parser.add_argument('--resume', nargs='?', const='latest', metavar='JOURNAL',
+                        help="continue an interrupted run, skipping images already in its journal "
+                             "(defaults to the newest journal in estimation_results)")
+    parser.add_argument('--batch', action='store_true',
+                        help="submit the dataset through the OpenAI Batch API instead of live requests")
+    parser.add_argument('--poll-interval', type=float, default=30.0,
+                        help="seconds between Batch API status checks (default: 30)")
+    parser.add_argument('--api-base', help="OpenAI-compatible base URL, e.g. a local mock server")
+    parser.add_argument('--dataset', help="dataset directory with processed_labels.csv (default: ./DATASET)")
+    parser.add_argument('--results-dir', help="where journals and CSVs go (default: ./estimation_results)")
+    parser.add_argument('--response-mode', choices=['text', 'json'],
+                        help="ask for the text format or compact schema-constrained JSON "
+                             "(default: DIETGPT_RESPONSE_MODE or text)")
+    return parser.parse_args(argv)
+
+async def main(argv=None):
+    args = parse_args(argv)
+
     # Setup paths
     script_dir = os.path.dirname(os.path.abspath(__file__))
-    dataset_path = os.path.join(script_dir, 'DATASET')
-    results_dir = os.path.join(script_dir, "estimation_results")
+    dataset_path = args.dataset or os.path.join(script_dir, 'DATASET')
+    results_dir = args.results_dir or os.path.join(script_dir, "estimation_results")
     
     # Load API key
-    api_key = st.secrets['OPENAI_API_KEY']
+    api_key = load_api_key()
     if not api_key:
         raise ValueError("OPENAI_API_KEY not found in environment variables")
     
@@ -280,63 +708,77 @@ async def main():
 
     # Create results directory
     os.makedirs(results_dir, exist_ok=True)
+
+    # Every result is journaled as soon as it arrives, so an aborted run can be resumed
+    if args.resume:
+        journal_path = latest_journal(results_dir) if args.resume == 'latest' else args.resume
+        if not journal_path or not os.path.exists(journal_path):
+            raise FileNotFoundError(f"No journal to resume at {journal_path or results_dir}")
+    else:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        journal_path = os.path.join(results_dir, f"estimation_openai_{timestamp}.jsonl")
+    journal = ResultJournal(journal_path)
+    done = journal.completed()
+    if done:
+        logging.info(f"Resuming {journal_path}: {len(done)} images already estimated")
     
-    async with CalorieEstimator(api_key=api_key) as estimator:
+    async with CalorieEstimator(api_key=api_key, api_base=args.api_base,
+                                response_mode=args.response_mode, use_near_duplicates=True) as estimator:
         try:
             # Load and process the dataset
             csv_path = os.path.join(dataset_path, 'processed_labels.csv')
             if not os.path.exists(csv_path):
                 raise FileNotFoundError(f"CSV file not found at {csv_path}")
-                
-            df = pd.read_csv(csv_path).dropna(subset=['calories'])
-            
-            # Process images in smaller batches to manage rate limits
-            batch_size = 5
-            results = []
-            
-            for i in range(0, len(df), batch_size):
-                batch_df = df.iloc[i:i + batch_size]
-                tasks = [
-                    process_single_image(
-                        estimator,
-                        os.path.join(dataset_path, row['img_path']),
-                        row['calories']
-                    )
-                    for _, row in batch_df.iterrows()
-                    if os.path.exists(os.path.join(dataset_path, row['img_path']))
-                ]
-                
-                # Process batch with progress bar
-                with tqdm(total=len(tasks), desc=f"Processing batch {i//batch_size + 1}") as pbar:
-                    batch_results = await asyncio.gather(*tasks)
-                    for result in batch_results:
-                        if result:
-                            results.append(result)
-                        pbar.update(1)
-                
-                # Add delay between batches
-                await asyncio.sleep(2)
+
+            if not os.path.exists(metadata_path(journal_path)):
+                write_run_metadata(journal_path, {
+                    'model': estimator.model,
+                    'prompt': hashlib.sha256(estimator.system_prompt.encode('utf-8')).hexdigest()[:12],
+                    'response_mode': estimator.response_mode,
+                    'max_size': MAX_IMAGE_SIZE,
+                    'quality': JPEG_QUALITY,
+                    'mode': 'batch' if args.batch else 'live',
+                })
+
+            # Rows are streamed from the CSV, so memory doesn't grow with the dataset
+            rows = iter_dataset_rows(dataset_path, csv_path, skip=done)
+
+            if args.batch:
+                runner = BatchRunner(estimator, os.path.splitext(journal_path)[0] + '_batch',
+                                     poll_interval=args.poll_interval)
+                with journal:
+                    await runner.run(rows, journal, build_result_record)
+            else:
+                await run_live(estimator, rows, journal)
             
-            if results:
-                # Save results
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                output_file = os.path.join(results_dir, f"estimation_openai_{timestamp}.csv")
-                pd.DataFrame(results).to_csv(output_file, index=False)
+            # Compact the journal into the usual CSV next to it
+            output_file = os.path.splitext(journal_path)[0] + '.csv'
+            saved = journal.compact(output_file)
+            if saved:
                 logging.info(f"Results saved to {output_file}")
                 
                 # Calculate and display statistics
-                df_results = pd.DataFrame(results)
-                if 'calorie_difference' in df_results.columns:
-                    mean_diff = df_results['calorie_difference'].mean()
-                    median_diff = df_results['calorie_difference'].median()
-                    logging.info(f"Average calorie difference: {mean_diff:.2f}")
-                    logging.info(f"Median calorie difference: {median_diff:.2f}")
+                run = pd.read_csv(output_file, usecols=['calorie_difference', 'near_duplicate_of'])
+                differences = run['calorie_difference']
+                mean_diff = differences.mean()
+                median_diff = differences.median()
+                logging.info(f"Average calorie difference: {mean_diff:.2f}")
+                logging.info(f"Median calorie difference: {median_diff:.2f}")
+                reused = int(run['near_duplicate_of'].notna().sum())
+                if reused:
+                    logging.info(f"{reused} near-duplicate images reused an earlier estimate (see near_duplicate_of)")
+                log_db_cross_check(output_file)
             else:
                 logging.warning("No results were generated")
+            metrics.log_summary()
                 
         except Exception as e:
             logging.error(f"Error in main execution: {str(e)}")
+            logging.info(f"Completed results are kept in {journal_path}; rerun with --resume to continue")
             raise
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logging.warning("Interrupted; rerun with --resume to continue from the journal")
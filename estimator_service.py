@@ -0,0 +1,74 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+from typing import Any, Awaitable, Callable, Optional
+
+from dietgpt_start import CalorieEstimator
+from nutrition_matcher import get_food_database
+
+# Per-upload budget (seconds) for interactive callers, who are waiting on the answer
+INTERACTIVE_DEADLINE = 45.0
+
+
+class EstimatorService:
+    """One long-lived CalorieEstimator running on a dedicated background event loop.
+
+    Synchronous front ends (Flask handlers, Streamlit scripts) hand coroutines
+    to run(), so every request shares the same aiohttp session and keep-alive
+    connection pool instead of building an event loop, a session and a TLS
+    connection per upload. Unless told otherwise, its estimator runs with
+    the interactive deadline (DIETGPT_INTERACTIVE_DEADLINE) and hedged
+    requests (DIETGPT_HEDGE=0 turns them off), and fails at once instead of
+    waiting while the circuit breaker is open.
+    """
+
+    def __init__(self, api_key: str, **estimator_kwargs):
+        estimator_kwargs.setdefault('deadline', float(os.environ.get('DIETGPT_INTERACTIVE_DEADLINE',
+                                                                     INTERACTIVE_DEADLINE)))
+        estimator_kwargs.setdefault('hedge', os.environ.get('DIETGPT_HEDGE', '1') != '0')
+        # A user waiting on an upload is better served by an immediate error
+        estimator_kwargs.setdefault('wait_on_breaker', False)
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name='estimator-loop', daemon=True)
+        self._thread.start()
+        self.estimator = CalorieEstimator(api_key=api_key, **estimator_kwargs)
+        self.run(self.estimator.create_session())
+        # Load (or compile) the food database in a worker thread while the first uploads arrive
+        self.submit(asyncio.to_thread(get_food_database))
+        atexit.register(self.close)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro: Awaitable[Any]):
+        """Schedule coro on the service loop; returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+        """Run coro on the service loop and block the calling thread for its result."""
+        return self.submit(coro).result(timeout)
+
+    def call(self, fn: Callable[[CalorieEstimator], Awaitable[Any]], timeout: Optional[float] = None) -> Any:
+        """Run fn(estimator) on the service loop, e.g. service.call(lambda e: e.estimate_calories(path))."""
+        return self.run(fn(self.estimator), timeout)
+
+    async def _cancel_tasks(self):
+        # Long-running tasks (e.g. JobManager workers) must end before the loop stops
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        if not self.loop.is_running():
+            return
+        try:
+            self.run(self.estimator.close_session(), timeout=5)
+            self.run(self._cancel_tasks(), timeout=5)
+        except Exception as e:
+            logging.warning(f"Error closing estimator session: {str(e)}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
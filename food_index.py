@@ -0,0 +1,273 @@
+"""Food database and fuzzy name index, in memory or memory-mapped from a compiled file.
+
+The compiled format is one file of aligned NumPy arrays: nutrients, a
+names offset table over UTF-8 bytes, and the trigram index in CSR form
+(sorted trigram keys, posting offsets, posting row ids). Opening it only
+maps the file, so startup is free and every worker process shares the
+same page-cached copy.
+
+    python food_index.py food_database.csv              # writes food_database.fdb
+    python food_index.py food_database.csv -o /srv/food.fdb
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import re
+import unicodedata
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Per-100g nutrient columns, in the order of FoodDatabase.nutrients
+NUTRIENT_COLUMNS = ('calories', 'carbohydrates', 'protein', 'fat', 'fiber')
+
+# Accepted spellings of each column in the food database CSV
+_COLUMN_ALIASES = {
+    'name': ('name', 'food', 'food_name', 'description', 'item'),
+    'calories': ('calories', 'kcal', 'energy_kcal', 'energy'),
+    'carbohydrates': ('carbohydrates', 'carbs', 'carbohydrate', 'carbohydrate_g'),
+    'protein': ('protein', 'protein_g'),
+    'fat': ('fat', 'total_fat', 'fat_g'),
+    'fiber': ('fiber', 'fibre', 'dietary_fiber', 'fiber_g'),
+}
+
+_NON_WORD_RE = re.compile(r'[^a-z0-9]+')
+_NGRAM = 3
+
+COMPILED_MAGIC = b'DGFOODB1'
+_ALIGN = 64
+
+
+def normalize_name(name: str) -> str:
+    """Lowercase, strip accents and punctuation, collapse whitespace."""
+    text = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii').lower()
+    return _NON_WORD_RE.sub(' ', text).strip()
+
+
+def ngrams(normalized: str) -> List[int]:
+    """Distinct character trigrams of a normalized name as 24-bit keys, padded so word edges count."""
+    padded = f"  {normalized} ".encode('ascii')
+    return list(dict.fromkeys((padded[i] << 16) | (padded[i + 1] << 8) | padded[i + 2]
+                              for i in range(len(padded) - _NGRAM + 1)))
+
+
+class NameTable:
+    """Read-only list of names stored as one UTF-8 byte array plus an offset table."""
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_names(cls, names: Sequence[str]) -> 'NameTable':
+        encoded = [name.encode('utf-8') for name in names]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class FoodIndex:
+    """Character trigram inverted index over normalized food names.
+
+    Postings are kept in CSR form: sorted trigram keys, an offset table and
+    one array of row ids. A lookup only touches the posting lists of the
+    query's own trigrams: one bincount over them gives the shared-trigram
+    count for every name at once, which turns into a Dice score against the
+    precomputed trigram counts. Trigrams that occur in more than `max_df`
+    of all names (" ch", "ed ", ...) are skipped while collecting
+    candidates as long as the query has rarer ones left, which prunes the
+    candidate set without changing the scores.
+    """
+
+    def __init__(self, gram_keys: np.ndarray, posting_offsets: np.ndarray, posting_ids: np.ndarray,
+                 gram_counts: np.ndarray, max_df: float = 0.05):
+        self.gram_keys = gram_keys
+        self.posting_offsets = posting_offsets
+        self.posting_ids = posting_ids
+        self.gram_counts = gram_counts
+        self.max_postings = max(1, int(max_df * len(gram_counts)))
+
+    @classmethod
+    def build(cls, names: Sequence[str], max_df: float = 0.05) -> 'FoodIndex':
+        postings = defaultdict(list)
+        gram_counts = np.zeros(len(names), dtype=np.int32)
+        for i, name in enumerate(names):
+            grams = ngrams(normalize_name(name))
+            gram_counts[i] = len(grams)
+            for gram in grams:
+                postings[gram].append(i)
+        gram_keys = np.array(sorted(postings), dtype=np.int32)
+        lengths = [len(postings[key]) for key in gram_keys.tolist()]
+        posting_offsets = np.zeros(len(gram_keys) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=posting_offsets[1:])
+        posting_ids = np.fromiter((i for key in gram_keys.tolist() for i in postings[key]),
+                                  dtype=np.int32, count=int(posting_offsets[-1]))
+        return cls(gram_keys, posting_offsets, posting_ids, gram_counts, max_df=max_df)
+
+    def __len__(self) -> int:
+        return len(self.gram_counts)
+
+    def _postings(self, grams: List[int]) -> List[np.ndarray]:
+        keys = np.asarray(grams, dtype=np.int32)
+        slots = np.minimum(np.searchsorted(self.gram_keys, keys), len(self.gram_keys) - 1)
+        found = slots[self.gram_keys[slots] == keys]
+        return [self.posting_ids[self.posting_offsets[s]:self.posting_offsets[s + 1]] for s in found.tolist()]
+
+    def search(self, query: str, limit: int = 3, min_score: float = 0.0) -> List[Tuple[int, float]]:
+        """Best (row, score) pairs for query, highest Dice score first."""
+        normalized = normalize_name(query)
+        if not normalized or not len(self):
+            return []
+        query_grams = ngrams(normalized)
+        lists = self._postings(query_grams)
+        if not lists:
+            return []
+        rare = [ids for ids in lists if len(ids) <= self.max_postings]
+        # Shared-trigram counts for every name in one pass over the posting lists
+        shared = np.bincount(np.concatenate(lists), minlength=len(self))
+        candidates = np.unique(np.concatenate(rare)) if rare else np.flatnonzero(shared)
+        shared = shared[candidates]
+        scores = 2.0 * shared / (len(query_grams) + self.gram_counts[candidates])
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit)[:limit]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(candidates[i]), float(scores[i])) for i in top if scores[i] >= min_score]
+
+    def best(self, query: str, min_score: float = 0.0) -> Optional[Tuple[int, float]]:
+        matches = self.search(query, limit=1, min_score=min_score)
+        return matches[0] if matches else None
+
+
+class FoodDatabase:
+    """Food names with their per-100g nutrients (NUTRIENT_COLUMNS) and a FoodIndex over the names."""
+
+    def __init__(self, names: NameTable, nutrients: np.ndarray, index: FoodIndex):
+        self.names = names
+        self.nutrients = nutrients
+        self.index = index
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def from_names(cls, names: Sequence[str], nutrients: np.ndarray) -> 'FoodDatabase':
+        return cls(NameTable.from_names(names), nutrients, FoodIndex.build(names))
+
+    @classmethod
+    def from_csv(cls, path: str) -> 'FoodDatabase':
+        with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            header = {field.strip().lower(): field for field in reader.fieldnames or []}
+            columns = {}
+            for column, aliases in _COLUMN_ALIASES.items():
+                columns[column] = next((header[a] for a in aliases if a in header), None)
+            if columns['name'] is None:
+                raise ValueError(f"No name column in {path}; expected one of {_COLUMN_ALIASES['name']}")
+            names, rows = [], []
+            for record in reader:
+                name = (record.get(columns['name']) or '').strip()
+                if not name:
+                    continue
+                names.append(name)
+                rows.append([_to_float(record.get(columns[c])) if columns[c] else np.nan
+                             for c in NUTRIENT_COLUMNS])
+        nutrients = np.asarray(rows, dtype=np.float32).reshape(len(rows), len(NUTRIENT_COLUMNS))
+        logging.info(f"Loaded {len(names)} food items")
+        return cls.from_names(names, nutrients)
+
+    # --- compiled format -----------------------------------------------------
+    def _arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            'nutrients': np.ascontiguousarray(self.nutrients, dtype=np.float32),
+            'name_offsets': self.names.offsets,
+            'name_data': self.names.data,
+            'gram_keys': self.index.gram_keys,
+            'posting_offsets': self.index.posting_offsets,
+            'posting_ids': self.index.posting_ids,
+            'gram_counts': self.index.gram_counts,
+        }
+
+    def save(self, path: str):
+        """Write the compiled file atomically, so readers never map a half-written one."""
+        arrays = self._arrays()
+        header = {'columns': list(NUTRIENT_COLUMNS), 'arrays': {}}
+        # Offsets are relative to the end of the header block, which is padded to _ALIGN
+        offset = 0
+        for name, array in arrays.items():
+            header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            offset += -(-array.nbytes // _ALIGN) * _ALIGN
+        header_bytes = json.dumps(header).encode('utf-8')
+        header_size = -(-(len(COMPILED_MAGIC) + 8 + len(header_bytes)) // _ALIGN) * _ALIGN
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(COMPILED_MAGIC)
+            f.write(len(header_bytes).to_bytes(8, 'little'))
+            f.write(header_bytes)
+            f.write(b'\0' * (header_size - f.tell()))
+            for name, array in arrays.items():
+                data = np.ascontiguousarray(array).tobytes()
+                f.write(data)
+                f.write(b'\0' * (-len(data) % _ALIGN))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, path: str) -> 'FoodDatabase':
+        """Memory-map a compiled file; nothing is read until it is searched."""
+        with open(path, 'rb') as f:
+            if f.read(len(COMPILED_MAGIC)) != COMPILED_MAGIC:
+                raise ValueError(f"{path} is not a compiled food database")
+            header_length = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(header_length))
+        if tuple(header['columns']) != NUTRIENT_COLUMNS:
+            raise ValueError(f"{path} has columns {header['columns']}, expected {list(NUTRIENT_COLUMNS)}")
+        base = -(-(len(COMPILED_MAGIC) + 8 + header_length) // _ALIGN) * _ALIGN
+        raw = np.memmap(path, dtype=np.uint8, mode='r')
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            count = int(np.prod(spec['shape'])) if spec['shape'] else 1
+            start = base + spec['offset']
+            arrays[name] = raw[start:start + count * dtype.itemsize].view(dtype).reshape(spec['shape'])
+        index = FoodIndex(arrays['gram_keys'], arrays['posting_offsets'], arrays['posting_ids'],
+                          arrays['gram_counts'])
+        return cls(NameTable(arrays['name_offsets'], arrays['name_data']), arrays['nutrients'], index)
+
+
+def compiled_path(csv_path: str) -> str:
+    return f"{os.path.splitext(csv_path)[0]}.fdb"
+
+
+def compile_database(csv_path: str, out_path: Optional[str] = None) -> str:
+    out_path = out_path or compiled_path(csv_path)
+    FoodDatabase.from_csv(csv_path).save(out_path)
+    return out_path
+
+
+def _to_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the food database CSV into a memory-mappable file")
+    parser.add_argument('csv_path')
+    parser.add_argument('-o', '--output', help="compiled file (default: CSV path with .fdb)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    print(compile_database(args.csv_path, args.output))
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from typing import Any, Callable, Iterable, Optional, Tuple
+
+from PIL import Image
+
+import metrics
+from near_duplicates import dhash
+
+MAX_IMAGE_SIZE = 768
+JPEG_QUALITY = 85
+
+# Marker a producer puts on the queue once per consumer when it runs out of work
+PIPELINE_DONE = object()
+
+
+def _target_size(size, max_size: int):
+    if max(size) <= max_size:
+        return tuple(size)
+    ratio = max_size / max(size)
+    return tuple(max(1, int(dim * ratio)) for dim in size)
+
+
+def _normalized(img: Image.Image, max_size: int) -> Image.Image:
+    new_size = _target_size(img.size, max_size)
+    if img.format == 'JPEG' and new_size != img.size:
+        img.draft('RGB', new_size)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if img.size != new_size:
+        img = img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    return img
+
+
+def _encode(img: Image.Image, quality: int) -> bytes:
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def preprocess_image(image_path, max_size: int = MAX_IMAGE_SIZE, quality: int = JPEG_QUALITY) -> bytes:
+    """Decode, downscale and re-encode an image into the JPEG bytes sent to the API.
+
+    JPEGs are opened in draft mode so libjpeg decodes straight at 1/2, 1/4 or
+    1/8 scale, and other formats go through Image.reduce() before the final
+    LANCZOS pass, so a large photo is never fully decoded at native size.
+    Runs in worker processes, so it must stay a picklable top-level function.
+    """
+    with Image.open(image_path) as img:
+        return _encode(_normalized(img, max_size), quality)
+
+
+def preprocess_image_hashed(image_path, max_size: int = MAX_IMAGE_SIZE,
+                            quality: int = JPEG_QUALITY) -> Tuple[bytes, int]:
+    """preprocess_image plus the dHash of the normalized image, from the same decode."""
+    with Image.open(image_path) as img:
+        img = _normalized(img, max_size)
+        return _encode(img, quality), dhash(img)
+
+
+_executor: Optional[Executor] = None
+_executor_lock = threading.Lock()
+
+
+def get_preprocess_executor() -> Executor:
+    """Shared process pool for image preprocessing.
+
+    DIETGPT_PREPROCESS_WORKERS sets the pool size; 0 falls back to a thread
+    pool for environments that can't fork (PIL releases the GIL while
+    decoding, so threads still keep the event loop free).
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = int(os.environ.get('DIETGPT_PREPROCESS_WORKERS', min(4, os.cpu_count() or 1)))
+            if workers > 0:
+                _executor = ProcessPoolExecutor(max_workers=workers)
+            else:
+                _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='preprocess')
+        return _executor
+
+
+def shutdown_preprocess_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def as_image_source(image):
+    """Something preprocess_image can open in a worker process.
+
+    Paths pass through unchanged; bytes, bytearray and memoryview are wrapped
+    in a BytesIO without touching the disk, and file-like objects (upload
+    streams) are read once into one.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        return image
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return BytesIO(image)
+    if hasattr(image, 'read'):
+        return BytesIO(image.read())
+    raise TypeError(f"Unsupported image input: {type(image).__name__}")
+
+
+async def preprocess_async(image_path, executor: Optional[Executor] = None, hashed: bool = False):
+    """Run preprocess_image (or preprocess_image_hashed when hashed) off the event loop."""
+    loop = asyncio.get_running_loop()
+    function = preprocess_image_hashed if hashed else preprocess_image
+    # Includes time waiting for a free worker, which is what a caller experiences
+    with metrics.span('preprocess'):
+        return await loop.run_in_executor(executor or get_preprocess_executor(), function, image_path)
+
+
+async def preprocess_into_queue(items: Iterable[Any], queue: asyncio.Queue,
+                                image_path: Callable[[Any], str] = lambda item: item,
+                                consumers: int = 1,
+                                max_pending: Optional[int] = None,
+                                executor: Optional[Executor] = None,
+                                hashed: bool = False):
+    """Producer stage: preprocess every item and put (item, jpeg_bytes) on queue.
+
+    With hashed=True the data is (jpeg_bytes, dhash) instead.
+
+    If preprocessing fails the exception is put in place of the bytes so the
+    consumer can record the failure. At most max_pending images are being
+    decoded at once, and a full queue blocks the producer, so a slow network
+    stage holds back preprocessing instead of piling results up in memory.
+    Puts one PIPELINE_DONE per consumer when finished, or when items fails.
+    """
+    executor = executor or get_preprocess_executor()
+    if max_pending is None:
+        max_pending = 2 * getattr(executor, '_max_workers', 2)
+    pending = set()
+
+    async def handle(item):
+        path = image_path(item)
+        try:
+            data = await preprocess_async(path, executor, hashed)
+        except Exception as e:
+            logging.error(f"Error preprocessing {path}: {str(e)}")
+            data = e
+        await queue.put((item, data))
+
+    try:
+        for item in items:
+            if len(pending) >= max_pending:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.add(asyncio.ensure_future(handle(item)))
+        if pending:
+            await asyncio.wait(pending)
+    finally:
+        for task in pending:
+            task.cancel()
+        # Even when items raises, so consumers stop and the caller's
+        # `await producer` re-raises instead of everyone waiting forever
+        for _ in range(consumers):
+            await queue.put(PIPELINE_DONE)
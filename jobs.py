@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+TERMINAL_STATES = ('done', 'failed')
+
+
+class QueueFullError(Exception):
+    """Raised by JobManager.submit when the queue is at its configured depth."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("Too many pending jobs")
+        self.retry_after = retry_after
+
+
+class Job:
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.status = 'queued'
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.events: List[Dict[str, Any]] = []
+        self._changed = threading.Condition()
+
+    def update(self, status: str, **data):
+        with self._changed:
+            self.status = status
+            if status in TERMINAL_STATES:
+                self.finished_at = time.time()
+            self.events.append(dict(data, status=status, job_id=self.id))
+            self._changed.notify_all()
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {'job_id': self.id, 'status': self.status}
+        if self.result is not None:
+            data['result'] = self.result
+        if self.error is not None:
+            data['error'] = self.error
+        return data
+
+    def stream(self, heartbeat: float = 15.0) -> Iterator[str]:
+        """Yield Server-Sent Events for every status change until the job finishes."""
+        sent = 0
+        while True:
+            with self._changed:
+                if sent >= len(self.events):
+                    self._changed.wait(timeout=heartbeat)
+                pending = self.events[sent:]
+            if not pending:
+                yield ": keep-alive\n\n"
+                continue
+            for event in pending:
+                sent += 1
+                yield f"event: {event['status']}\ndata: {json.dumps(event)}\n\n"
+                if event['status'] in TERMINAL_STATES:
+                    return
+
+
+class JobManager:
+    """Bounded worker pool for analysis jobs, running on an EstimatorService loop.
+
+    Web handlers call submit() and return immediately; `workers` coroutines
+    take jobs off the queue, so slow inference no longer ties up a web worker
+    per upload. Beyond `max_queue` waiting jobs submit() raises QueueFullError
+    so the caller can answer 503 with Retry-After instead of queueing forever.
+    Finished jobs are forgotten after `ttl` seconds, checked on every
+    submit() and get() and by a timer on the service loop, so results don't
+    pile up while no new jobs arrive.
+    """
+
+    def __init__(self, service, workers: int = 4, max_queue: int = 32, ttl: float = 600.0):
+        self.service = service
+        self.workers = workers
+        self.max_queue = max_queue
+        self.ttl = ttl
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self.service.run(self._start())
+
+    async def _start(self):
+        self._queue = asyncio.Queue()
+        for _ in range(self.workers):
+            asyncio.create_task(self._worker())
+        asyncio.create_task(self._reaper())
+
+    async def _worker(self):
+        while True:
+            job, factory = await self._queue.get()
+            with self._lock:
+                self._waiting -= 1
+            job.update('running')
+            try:
+                job.result = await factory()
+                job.update('done', result=job.result)
+            except Exception as e:
+                logging.error(f"Job {job.id} failed: {str(e)}")
+                job.error = str(e)
+                job.update('failed', error=job.error)
+
+    async def _reaper(self):
+        while True:
+            await asyncio.sleep(min(self.ttl, 60.0))
+            with self._lock:
+                self._expire()
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def submit(self, factory: Callable[[], Awaitable[Dict[str, Any]]]) -> Job:
+        """Queue factory() to run on the service loop and return its Job right away."""
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                # Rough guess at when a slot frees up: one job per worker ahead of us
+                raise QueueFullError(retry_after=max(1.0, self._waiting / max(1, self.workers)))
+            self._expire()
+            job = Job(uuid.uuid4().hex)
+            self._jobs[job.id] = job
+            self._waiting += 1
+            position = self._waiting
+        job.update('queued', position=position)
+        self.service.loop.call_soon_threadsafe(self._queue.put_nowait, (job, factory))
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    @property
+    def depth(self) -> int:
+        return self._waiting
@@ -0,0 +1,163 @@
+"""In-process timing histograms and counters, rendered in the Prometheus text format.
+
+Hot-path code wraps each stage in span('stage') (or calls observe_stage),
+and bumps the counters below; app.py serves render() on /metrics and
+dietgpt_start.main() logs log_summary() at the end of a run. Everything is
+per process and costs a lock and a few additions per observation.
+"""
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   math.inf)
+
+
+def _label_text(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _number(value: float) -> str:
+    return '+Inf' if value == math.inf else f"{value:g}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        return self._values.get(key, 0.0)
+
+    def items(self) -> List[Tuple[Tuple[str, ...], float]]:
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in self.items():
+            lines.append(f"{self.name}{_label_text(self.label_names, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # key -> [per-bucket counts (not cumulative), sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self) -> Dict[Tuple[str, ...], Tuple[List[int], float, int]]:
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+
+    def quantile(self, q: float, counts: Sequence[int]) -> Optional[float]:
+        """Estimate a quantile from bucket counts, interpolating linearly inside the bucket."""
+        count = sum(counts)
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i]
+                if upper == math.inf:
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-2]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_label_text(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.label_names, key)} {total:.6f}")
+            lines.append(f"{self.name}_count{_label_text(self.label_names, key)} {count}")
+        return lines
+
+
+STAGE_SECONDS = Histogram('dietgpt_stage_seconds', "Time spent in each stage of an estimate", ('stage',))
+ESTIMATES = Counter('dietgpt_estimates_total', "Estimates finished, by outcome", ('outcome',))
+API_REQUESTS = Counter('dietgpt_api_requests_total', "Chat completion attempts, by outcome", ('outcome',))
+RETRIES = Counter('dietgpt_api_retries_total', "Attempts that were retried")
+CACHE_LOOKUPS = Counter('dietgpt_cache_lookups_total', "Estimate lookups by cache tier and result",
+                        ('tier', 'result'))
+TOKENS = Counter('dietgpt_tokens_total', "Tokens reported by the API, by kind", ('kind',))
+HEDGES = Counter('dietgpt_hedged_requests_total', "Requests that were sent a second time after the p95")
+BREAKER_REJECTIONS = Counter('dietgpt_breaker_rejections_total', "Estimates refused by an open circuit breaker")
+SHEETS_CALLS = Counter('dietgpt_sheets_calls_total', "Google Sheets calls, by operation and outcome",
+                       ('operation', 'outcome'))
+
+COUNTERS = (ESTIMATES, API_REQUESTS, RETRIES, CACHE_LOOKUPS, TOKENS, HEDGES, BREAKER_REJECTIONS, SHEETS_CALLS)
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+@contextmanager
+def span(stage: str):
+    """Time the block into dietgpt_stage_seconds{stage=...}; works across awaits too."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def render() -> str:
+    lines = STAGE_SECONDS.render()
+    for counter in COUNTERS:
+        lines.extend(counter.render())
+    return '\n'.join(lines) + '\n'
+
+
+def log_summary():
+    """Log per-stage timings (count, mean, p50, p95) and every non-zero counter."""
+    stages = STAGE_SECONDS.snapshot()
+    if stages:
+        logging.info(f"{'stage':<22}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}")
+        for (stage,), (counts, total, count) in sorted(stages.items()):
+            p50 = STAGE_SECONDS.quantile(0.5, counts)
+            p95 = STAGE_SECONDS.quantile(0.95, counts)
+            logging.info(f"{stage:<22}{count:>8}{total / count:>9.3f}s{p50:>9.3f}s{p95:>9.3f}s")
+    for counter in COUNTERS:
+        for key, value in counter.items():
+            if value:
+                labels = ','.join(f"{name}={label}" for name, label in zip(counter.label_names, key))
+                logging.info(f"{counter.name}{'{' + labels + '}' if labels else ''}: {value:g}")
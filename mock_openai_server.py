@@ -0,0 +1,308 @@
+"""Local stand-in for the parts of the OpenAI API that DietGPT uses.
+
+Serves /v1/chat/completions plus the Files and Batches endpoints, answering
+every request with a canned response in the SYSTEM_PROMPT format. Point
+CalorieEstimator at it with OPENAI_BASE_URL=http://127.0.0.1:8089/v1 (or
+--api-base) to run the pipeline end to end without spending anything.
+
+Chat completions can be made to behave like a busy upstream: latency drawn
+from a fixed/uniform/lognormal distribution, a share of 429s carrying
+Retry-After and x-ratelimit-* headers, and bursts of consecutive 5xx errors.
+GET /_mock/stats returns what the server saw; POST /_mock/reset clears it.
+
+    python mock_openai_server.py --port 8089 --latency lognormal --latency-mean 1.5 --rate-limit 0.05
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+CANNED_RESPONSES = ["""CALORIES: 450
+Carbohydrates: 45g
+Protein: 25g
+Fat: 20g
+Fiber: 8g
+
+Food Items:
+- Greek yogurt (150g)
+- Mixed berries (100g)
+- Granola (30g)
+
+Plant-based Ingredients:
+- Blueberries
+- Strawberries
+- Oats""", """CALORIES: 1235
+Carbohydrates: 150g
+Protein: 60g
+Fat: 45g
+Fiber: 12g
+
+Food Items:
+- Grilled chicken breast (200g)
+- Brown rice (150g)
+- Steamed vegetables (200g)
+- Olive oil (15ml)
+
+Plant-based Ingredients:
+- Brown rice
+- Broccoli
+- Carrots
+- Bell peppers
+- Olive""", """CALORIES: 680
+Carbohydrates: 72g
+Protein: 28g
+Fat: 30g
+Fiber: 6g
+
+Food Items:
+- Margherita pizza (2 slices)
+- Side salad (1 cup)
+
+Plant-based Ingredients:
+- Tomato
+- Basil
+- Lettuce"""]
+CANNED_RESPONSE = CANNED_RESPONSES[0]
+
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}-{uuid.uuid4().hex[:24]}"
+
+
+class MockConfig:
+    """How the mock chat endpoint should behave."""
+
+    def __init__(self, latency: str = 'fixed', latency_mean: float = 0.0, latency_spread: float = 0.0,
+                 rate_limit: float = 0.0, retry_after: float = 1.0, requests_per_minute: int = 5000,
+                 error_burst: float = 0.0, error_burst_length: int = 3, error_status: int = 503,
+                 responses: Optional[List[str]] = None, seed: Optional[int] = None):
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_spread = latency_spread
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.requests_per_minute = requests_per_minute
+        self.error_burst = error_burst
+        self.error_burst_length = error_burst_length
+        self.error_status = error_status
+        self.responses = responses or CANNED_RESPONSES
+        self.random = random.Random(seed)
+
+    def sample_latency(self) -> float:
+        mean, spread = self.latency_mean, self.latency_spread
+        if mean <= 0:
+            return 0.0
+        if self.latency == 'uniform':
+            return self.random.uniform(max(0.0, mean - spread), mean + spread)
+        if self.latency == 'lognormal':
+            # spread is the sigma of the underlying normal; mu keeps the mean at latency_mean
+            mu = math.log(mean) - spread ** 2 / 2
+            return self.random.lognormvariate(mu, spread)
+        return mean
+
+
+def chat_completion(body: Dict[str, Any], content: str = CANNED_RESPONSE) -> Dict[str, Any]:
+    return {
+        'id': _new_id('chatcmpl'),
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'gpt-4o-mini'),
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop',
+        }],
+        'usage': {'prompt_tokens': 300, 'completion_tokens': 60, 'total_tokens': 360},
+    }
+
+
+class MockOpenAI:
+    def __init__(self, config: Optional[MockConfig] = None, batch_delay: float = 0.5):
+        self.config = config or MockConfig()
+        self.batch_delay = batch_delay
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.reset()
+
+    def reset(self):
+        self.stats = {'requests': 0, 'ok': 0, 'rate_limited': 0, 'server_errors': 0}
+        self._burst_left = 0
+        self._window_start = time.monotonic()
+        self._window_requests = 0
+
+    def _ratelimit_headers(self) -> Dict[str, str]:
+        now = time.monotonic()
+        if now - self._window_start >= 60:
+            self._window_start, self._window_requests = now, 0
+        self._window_requests += 1
+        remaining = max(0, self.config.requests_per_minute - self._window_requests)
+        reset = 60 - (now - self._window_start)
+        return {
+            'x-ratelimit-limit-requests': str(self.config.requests_per_minute),
+            'x-ratelimit-remaining-requests': str(remaining),
+            'x-ratelimit-reset-requests': f"{reset:.3f}s",
+        }
+
+    # --- chat ----------------------------------------------------------------
+    async def handle_chat(self, request: web.Request) -> web.Response:
+        config = self.config
+        self.stats['requests'] += 1
+        body = await request.json()
+        headers = self._ratelimit_headers()
+
+        if self._burst_left == 0 and config.random.random() < config.error_burst:
+            self._burst_left = config.error_burst_length
+        if self._burst_left > 0:
+            self._burst_left -= 1
+            self.stats['server_errors'] += 1
+            return web.json_response({'error': {'message': 'The server is overloaded', 'type': 'server_error'}},
+                                     status=config.error_status)
+
+        if headers['x-ratelimit-remaining-requests'] == '0' or config.random.random() < config.rate_limit:
+            self.stats['rate_limited'] += 1
+            headers['Retry-After'] = f"{config.retry_after:g}"
+            return web.json_response(
+                {'error': {'message': 'Rate limit reached for requests', 'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                status=429, headers=headers)
+
+        await asyncio.sleep(config.sample_latency())
+        self.stats['ok'] += 1
+        content = config.random.choice(config.responses)
+        return web.json_response(chat_completion(body, content), headers=headers)
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    async def handle_reset(self, request: web.Request) -> web.Response:
+        self.reset()
+        return web.json_response(self.stats)
+
+    # --- files ---------------------------------------------------------------
+    async def handle_upload(self, request: web.Request) -> web.Response:
+        reader = await request.multipart()
+        purpose, content, filename = None, b'', 'upload.jsonl'
+        async for part in reader:
+            if part.name == 'purpose':
+                purpose = (await part.read()).decode('utf-8')
+            elif part.name == 'file':
+                filename = part.filename or filename
+                content = await part.read()
+        file_id = _new_id('file')
+        self.files[file_id] = content
+        return web.json_response({
+            'id': file_id, 'object': 'file', 'bytes': len(content),
+            'created_at': int(time.time()), 'filename': filename, 'purpose': purpose,
+        })
+
+    async def handle_file_content(self, request: web.Request) -> web.Response:
+        content = self.files.get(request.match_info['file_id'])
+        if content is None:
+            return web.json_response({'error': {'message': 'No such file'}}, status=404)
+        return web.Response(body=content, content_type='application/jsonl')
+
+    # --- batches -------------------------------------------------------------
+    async def handle_create_batch(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if body.get('input_file_id') not in self.files:
+            return web.json_response({'error': {'message': 'No such file'}}, status=400)
+        batch = {
+            'id': _new_id('batch'),
+            'object': 'batch',
+            'endpoint': body.get('endpoint'),
+            'input_file_id': body['input_file_id'],
+            'completion_window': body.get('completion_window', '24h'),
+            'status': 'validating',
+            'output_file_id': None,
+            'error_file_id': None,
+            'created_at': int(time.time()),
+            'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+            'errors': None,
+        }
+        self.batches[batch['id']] = batch
+        asyncio.get_running_loop().create_task(self._run_batch(batch))
+        return web.json_response(batch)
+
+    async def _run_batch(self, batch: Dict[str, Any]):
+        lines = [line for line in self.files[batch['input_file_id']].splitlines() if line.strip()]
+        batch['request_counts']['total'] = len(lines)
+        batch['status'] = 'in_progress'
+        await asyncio.sleep(self.batch_delay)
+        output = []
+        for line in lines:
+            request = json.loads(line)
+            output.append(json.dumps({
+                'id': _new_id('batch_req'),
+                'custom_id': request['custom_id'],
+                'response': {
+                    'status_code': 200,
+                    'request_id': uuid.uuid4().hex,
+                    'body': chat_completion(request.get('body', {}), self.config.random.choice(self.config.responses)),
+                },
+                'error': None,
+            }))
+            batch['request_counts']['completed'] += 1
+        output_id = _new_id('file')
+        self.files[output_id] = ('\n'.join(output) + '\n').encode('utf-8')
+        batch['output_file_id'] = output_id
+        batch['status'] = 'completed'
+        batch['completed_at'] = int(time.time())
+
+    async def handle_get_batch(self, request: web.Request) -> web.Response:
+        batch = self.batches.get(request.match_info['batch_id'])
+        if batch is None:
+            return web.json_response({'error': {'message': 'No such batch'}}, status=404)
+        return web.json_response(batch)
+
+
+def create_app(mock: MockOpenAI = None) -> web.Application:
+    mock = mock or MockOpenAI()
+    app = web.Application(client_max_size=256 * 1024 * 1024)
+    app['mock'] = mock
+    app.router.add_post('/v1/chat/completions', mock.handle_chat)
+    app.router.add_post('/v1/files', mock.handle_upload)
+    app.router.add_get('/v1/files/{file_id}/content', mock.handle_file_content)
+    app.router.add_post('/v1/batches', mock.handle_create_batch)
+    app.router.add_get('/v1/batches/{batch_id}', mock.handle_get_batch)
+    app.router.add_get('/_mock/stats', mock.handle_stats)
+    app.router.add_post('/_mock/reset', mock.handle_reset)
+    return app
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group('mock behaviour')
+    group.add_argument('--latency', choices=['fixed', 'uniform', 'lognormal'], default='fixed',
+                       help="latency distribution of chat completions")
+    group.add_argument('--latency-mean', type=float, default=0.0, help="mean latency in seconds")
+    group.add_argument('--latency-spread', type=float, default=0.0,
+                       help="half-width for uniform, sigma for lognormal")
+    group.add_argument('--rate-limit', type=float, default=0.0, help="share of requests answered with 429")
+    group.add_argument('--retry-after', type=float, default=1.0, help="Retry-After sent with 429s")
+    group.add_argument('--rpm', type=int, default=5000, help="requests per minute before every request is a 429")
+    group.add_argument('--error-burst', type=float, default=0.0,
+                       help="chance that a request starts a burst of 5xx errors")
+    group.add_argument('--error-burst-length', type=int, default=3)
+    group.add_argument('--seed', type=int, default=None)
+
+
+def config_from_args(args) -> MockConfig:
+    return MockConfig(latency=args.latency, latency_mean=args.latency_mean, latency_spread=args.latency_spread,
+                      rate_limit=args.rate_limit, retry_after=args.retry_after, requests_per_minute=args.rpm,
+                      error_burst=args.error_burst, error_burst_length=args.error_burst_length, seed=args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local mock of the OpenAI API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--batch-delay', type=float, default=0.5,
+                        help="seconds a batch stays in_progress before completing")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    mock = MockOpenAI(config_from_args(args), batch_delay=args.batch_delay)
+    web.run_app(create_app(mock), host=args.host, port=args.port)
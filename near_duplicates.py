@@ -0,0 +1,282 @@
+"""Perceptual-hash index of recent analyses, so near-identical photos reuse one estimate.
+
+Re-shares, screenshots and burst shots of the same plate have different
+bytes, so the content-addressed ResultCache misses them. Every image gets a
+64-bit difference hash (dHash) while it is preprocessed, and analyses are
+kept in a BK-tree keyed by that hash: a lookup only visits subtrees whose
+Hamming distance to the query can still be within the threshold.
+
+    python near_duplicates.py DATASET --max-distance 5
+"""
+import argparse
+import asyncio
+import csv
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 8
+# dHashes of the same photo re-encoded/resized differ by a few bits; unrelated meals by ~32
+DEFAULT_MAX_DISTANCE = 5
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+# Keys a lookup adds to a result; never stored back into the index
+_LOOKUP_FIELDS = ('cached', 'near_duplicate_of', 'near_duplicate_distance')
+
+
+def dhash(img: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """Difference hash: one bit per horizontally adjacent pixel pair of a tiny grayscale copy."""
+    small = img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def image_hash(image_path, hash_size: int = HASH_SIZE) -> int:
+    """dHash of an image file; JPEGs are decoded in draft mode at a fraction of their size."""
+    with Image.open(image_path) as img:
+        if img.format == 'JPEG':
+            img.draft('L', (hash_size * 16, hash_size * 16))
+        return dhash(img, hash_size)
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Burkhard-Keller tree over Hamming distance. Nodes are [hash, value, {distance: child}]."""
+
+    def __init__(self):
+        self.root: Optional[list] = None
+        self.size = 0
+
+    def add(self, key: int, value: Any):
+        self.size += 1
+        if self.root is None:
+            self.root = [key, value, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(key, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, value, {}]
+                return
+            node = child
+
+    def find(self, key: int, max_distance: int) -> List[Tuple[int, int, Any]]:
+        """Every (distance, hash, value) within max_distance of key, closest first."""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(key, node[0])
+            if distance <= max_distance:
+                found.append((distance, node[0], node[1]))
+            # Triangle inequality: only children at |d - distance| <= max_distance can match
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda match: match[0])
+        return found
+
+
+class NearDuplicateIndex:
+    """Recent successful analyses by perceptual hash, with single-flight lookups.
+
+    Entries are partitioned by variant (model + prompt + response mode), since
+    an answer is only reusable under the configuration that produced it. The
+    index keeps the max_entries most recent analyses; BK-trees can't delete,
+    so evicted entries are dropped from the trees by rebuilding them once
+    half of their nodes are stale.
+    """
+
+    def __init__(self, max_distance: int = DEFAULT_MAX_DISTANCE, max_entries: int = 4096):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[Dict[str, Any], str]]" = OrderedDict()
+        self._trees: Dict[str, BKTree] = {}
+        self._inflight: Dict[str, List[Tuple[int, str, asyncio.Future]]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _rebuild(self):
+        self._trees = {}
+        for (variant, key) in self._entries:
+            self._trees.setdefault(variant, BKTree()).add(key, None)
+
+    def add(self, image_hash: int, variant: str, result: Dict[str, Any], source: str = ''):
+        """Remember a successful result for image_hash under variant."""
+        result = {k: v for k, v in result.items() if k not in _LOOKUP_FIELDS}
+        with self._lock:
+            entry_key = (variant, image_hash)
+            if entry_key in self._entries:
+                self._entries.move_to_end(entry_key)
+                return
+            self._entries[entry_key] = (result, source)
+            self._trees.setdefault(variant, BKTree()).add(image_hash, None)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if sum(tree.size for tree in self._trees.values()) > 2 * len(self._entries):
+                self._rebuild()
+
+    def _lookup_locked(self, image_hash: int, variant: str) -> Optional[Dict[str, Any]]:
+        tree = self._trees.get(variant)
+        if tree is None:
+            return None
+        for distance, key, _ in tree.find(image_hash, self.max_distance):
+            entry = self._entries.get((variant, key))
+            if entry is not None:
+                self._entries.move_to_end((variant, key))
+                result, source = entry
+                return dict(result, near_duplicate_of=source, near_duplicate_distance=distance)
+        return None
+
+    def lookup(self, image_hash: int, variant: str) -> Optional[Dict[str, Any]]:
+        """The closest stored result within max_distance, tagged with where it came from."""
+        with self._lock:
+            result = self._lookup_locked(image_hash, variant)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+
+    async def get_or_compute(self, image_hash: int, variant: str, source: str,
+                             compute: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Reuse a near-duplicate's result, wait for one being computed, or compute it.
+
+        Near-duplicates that arrive while the first of them is still waiting
+        on the API share that call instead of paying for their own.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            result = self._lookup_locked(image_hash, variant)
+            pending = None
+            if result is None:
+                for key, pending_source, future in self._inflight.get(variant, ()):
+                    distance = hamming(image_hash, key)
+                    if distance <= self.max_distance and future.get_loop() is loop and not future.done():
+                        pending = (future, pending_source, distance)
+                        break
+            if result is not None or pending is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                own = (image_hash, source, loop.create_future())
+                self._inflight.setdefault(variant, []).append(own)
+        if result is not None:
+            return result
+
+        if pending is not None:
+            future, pending_source, distance = pending
+            shared = await asyncio.shield(future)
+            if shared.get('success'):
+                return dict(shared, near_duplicate_of=pending_source, near_duplicate_distance=distance)
+            # The shared call failed; this image gets its own attempt
+            return await compute()
+
+        try:
+            result = await compute()
+        except BaseException:
+            if not own[2].done():
+                own[2].set_result({'success': False})
+            raise
+        else:
+            if result.get('success'):
+                self.add(image_hash, variant, result, source)
+            if not own[2].done():
+                own[2].set_result(result)
+            return result
+        finally:
+            with self._lock:
+                inflight = self._inflight.get(variant, [])
+                if own in inflight:
+                    inflight.remove(own)
+                if not inflight:
+                    self._inflight.pop(variant, None)
+
+
+def get_max_distance() -> int:
+    """DIETGPT_NEAR_DUP_DISTANCE, in bits out of 64; negative disables near-duplicate reuse."""
+    return int(os.environ.get('DIETGPT_NEAR_DUP_DISTANCE', DEFAULT_MAX_DISTANCE))
+
+
+_default_index: Optional[NearDuplicateIndex] = None
+_default_index_lock = threading.Lock()
+
+
+def get_default_index() -> Optional[NearDuplicateIndex]:
+    """Process-wide index shared by every CalorieEstimator; None when disabled."""
+    global _default_index
+    max_distance = get_max_distance()
+    if max_distance < 0:
+        return None
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = NearDuplicateIndex(max_distance=max_distance)
+        return _default_index
+
+
+def find_near_duplicates(paths: Iterable[str], max_distance: int = DEFAULT_MAX_DISTANCE,
+                         workers: Optional[int] = None) -> Dict[str, Tuple[str, int]]:
+    """Map every image that nearly duplicates an earlier one to (that image, distance).
+
+    Hashing runs in a process pool; each image is compared against the ones
+    before it, so the first of a group is kept and the rest are flagged.
+    """
+    paths = list(paths)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(_safe_image_hash, paths, chunksize=32))
+    tree = BKTree()
+    duplicates = {}
+    for path, key in zip(paths, hashes):
+        if key is None:
+            continue
+        matches = tree.find(key, max_distance)
+        if matches:
+            distance, _, original = matches[0]
+            duplicates[path] = (original, distance)
+        else:
+            tree.add(key, path)
+    return duplicates
+
+
+def _safe_image_hash(path: str) -> Optional[int]:
+    try:
+        return image_hash(path)
+    except Exception as e:
+        logging.error(f"Error hashing {path}: {str(e)}")
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flag near-duplicate images in a dataset directory")
+    parser.add_argument('dataset', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                     'DATASET'))
+    parser.add_argument('--max-distance', type=int, default=DEFAULT_MAX_DISTANCE,
+                        help=f"largest Hamming distance (of 64 bits) that counts as a duplicate "
+                             f"(default: {DEFAULT_MAX_DISTANCE})")
+    parser.add_argument('--csv', help="write image,duplicate_of,distance rows to this CSV")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    images = sorted(os.path.join(root, name) for root, _, files in os.walk(args.dataset)
+                    for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+    found = find_near_duplicates(images, args.max_distance)
+    for image, (original, distance) in found.items():
+        print(f"{os.path.relpath(image, args.dataset)} ~ {os.path.relpath(original, args.dataset)} ({distance} bits)")
+    logging.info(f"{len(found)} of {len(images)} images are near-duplicates of an earlier image")
+    if args.csv:
+        with open(args.csv, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['image', 'duplicate_of', 'distance'])
+            for image, (original, distance) in found.items():
+                writer.writerow([os.path.relpath(image, args.dataset), os.path.relpath(original, args.dataset),
+                                 distance])
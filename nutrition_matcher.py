@@ -1,20 +1,188 @@
 # nutrition_matcher.py
 """
-Спрощена версія без підвантаження локальної food‑бази.
-Повертає тільки оцінку LLM, а всі DB‑поля — None / пусті.
+Порівняння оцінки LLM з локальною food‑базою.
+База (CSV з назвою та нутрієнтами на 100 г) компілюється у .fdb‑файл, який
+лише мапиться в пам'ять при першому зверненні — старт нічого не коштує, а
+всі воркери ділять одну копію в page cache. Якщо бази немає, db‑поля
+лишаються None / пустими, як раніше.
 """
 
-from typing import Dict, List, Any
+import asyncio
+import logging
+import os
+import threading
+from typing import Dict, List, Any, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from food_index import FoodDatabase, NUTRIENT_COLUMNS, compiled_path
+from portions import portion_to_grams, piece_grams
+from response_parser import parse_food_item
+
+DEFAULT_FOOD_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'food_database.csv')
+MIN_MATCH_SCORE = 0.5
+
+_food_db: Optional[FoodDatabase] = None
+_food_db_loaded = False
+_food_db_lock = threading.Lock()
+
+
+def _load_food_database() -> Optional[FoodDatabase]:
+    csv_path = os.environ.get('DIETGPT_FOOD_DB', DEFAULT_FOOD_DB_PATH)
+    fdb_path = os.environ.get('DIETGPT_FOOD_DB_COMPILED') or compiled_path(csv_path)
+    csv_exists = os.path.exists(csv_path)
+    if os.path.exists(fdb_path) and (not csv_exists or os.path.getmtime(fdb_path) >= os.path.getmtime(csv_path)):
+        return FoodDatabase.open(fdb_path)
+    if not csv_exists:
+        logging.warning(f"Food database not found at {csv_path}; db_estimate disabled")
+        return None
+    # немає свіжого .fdb: читаємо CSV і компілюємо, щоб наступні старти лише мапили файл
+    db = FoodDatabase.from_csv(csv_path)
+    try:
+        db.save(fdb_path)
+        logging.info(f"Compiled food database to {fdb_path}")
+    except OSError as e:
+        logging.warning(f"Could not write compiled food database {fdb_path}: {str(e)}")
+    return db
+
+
+def get_food_database() -> Optional[FoodDatabase]:
+    """База з DIETGPT_FOOD_DB (або food_database.csv поруч), None якщо її немає."""
+    global _food_db, _food_db_loaded
+    if not _food_db_loaded:
+        with _food_db_lock:
+            if not _food_db_loaded:
+                try:
+                    _food_db = _load_food_database()
+                except Exception as e:
+                    logging.error(f"Error loading food database: {str(e)}")
+                _food_db_loaded = True
+    return _food_db
+
+
+def item_grams(name: str, portion: Optional[str]) -> float:
+    """Вага страви в грамах; без читабельної порції — типова вага однієї штуки."""
+    grams = portion_to_grams(portion, name)
+    return grams if grams is not None else piece_grams(name)
+
+
+def aggregate(db: FoodDatabase, rows: np.ndarray, grams: np.ndarray) -> np.ndarray:
+    """Сума нутрієнтів: gather рядків бази (на 100 г) і dot з вагами."""
+    if not len(rows):
+        return np.zeros(len(NUTRIENT_COLUMNS))
+    return (grams / 100.0) @ np.nan_to_num(np.asarray(db.nutrients[rows], dtype=np.float64))
+
+
+def _match(db: FoodDatabase, text: str, min_score: float) -> Optional[Tuple[int, float, float]]:
+    """(рядок бази, score, грами) для одного рядка з extract_food_items."""
+    item = parse_food_item(text)
+    best = db.index.best(item.name, min_score=min_score)
+    if best is None:
+        return None
+    return best[0], best[1], item_grams(item.name, item.portion)
+
+
+def match_food_items(food_items: List[str], db: FoodDatabase,
+                     min_score: float = MIN_MATCH_SCORE) -> Dict[str, Any]:
+    """Зіставляє кожен рядок із extract_food_items з найкращим записом бази."""
+    matched, unmatched = [], []
+    for text in food_items:
+        found = _match(db, text, min_score)
+        if found is None:
+            unmatched.append(text)
+        else:
+            matched.append((text,) + found)
+    rows = np.array([m[1] for m in matched], dtype=np.int64)
+    grams = np.array([m[3] for m in matched], dtype=np.float64)
+    per_item = np.asarray(db.nutrients[rows], dtype=np.float64) * (grams / 100.0)[:, None]
+    matches = [{
+        'item': text,
+        'match': db.names[row],
+        'score': round(score, 3),
+        'grams': round(weight, 1),
+        **{column: (None if np.isnan(per_item[i, j]) else round(float(per_item[i, j]), 1))
+           for j, column in enumerate(NUTRIENT_COLUMNS)},
+    } for i, (text, row, score, weight) in enumerate(matched)]
+    return {'food_matches': matches, 'unmatched_items': unmatched,
+            'totals': aggregate(db, rows, grams)}
+
+
+def db_estimates_bulk(food_items: pd.Series, db: FoodDatabase,
+                      min_score: float = MIN_MATCH_SCORE) -> pd.DataFrame:
+    """db_estimate для кожного рядка прогону разом.
+
+    food_items — колонка списків (як parse_responses_bulk(...)['food_items']).
+    Кожен унікальний рядок зіставляється один раз, далі один gather по
+    матриці нутрієнтів і сума по рядках прогону через bincount. Повертає
+    db_<нутрієнт> і matched_share з тим самим індексом; рядки без жодного
+    збігу мають NaN.
+    """
+    lists = food_items.tolist()
+    matches: Dict[str, Optional[Tuple[int, float, float]]] = {}
+    owners, rows, grams = [], [], []
+    for position, items in enumerate(lists):
+        for text in items or []:
+            if text not in matches:
+                matches[text] = _match(db, text, min_score)
+            found = matches[text]
+            if found is not None:
+                owners.append(position)
+                rows.append(found[0])
+                grams.append(found[2])
+    owners = np.asarray(owners, dtype=np.int64)
+    weights = np.asarray(grams, dtype=np.float64) / 100.0
+    nutrients = np.nan_to_num(np.asarray(db.nutrients[np.asarray(rows, dtype=np.int64)], dtype=np.float64))
+    totals = {
+        f"db_{column}": np.bincount(owners, weights=nutrients[:, j] * weights, minlength=len(lists))
+        for j, column in enumerate(NUTRIENT_COLUMNS)
+    }
+    item_counts = np.array([len(items or []) for items in lists], dtype=np.float64)
+    matched_counts = np.bincount(owners, minlength=len(lists))
+    result = pd.DataFrame(totals, index=food_items.index)
+    result[matched_counts == 0] = np.nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result['matched_share'] = np.where(item_counts > 0, matched_counts / item_counts, np.nan)
+    return result
+
 
 def enhance_nutrition_estimate(
     llm_estimate: Dict[str, Any],
     food_items: List[str],
 ) -> Dict[str, Any]:
-    """Повертає структуру, сумісну з попередньою, але без порівняння з БД."""
+    """Повертає оцінку LLM разом з оцінкою з бази та впевненістю зіставлення."""
+    db = get_food_database()
+    if db is None or not food_items:
+        return {
+            "llm_estimate": llm_estimate,
+            "db_estimate": None,
+            "food_matches": [],
+            "unmatched_items": food_items,
+            "confidence_score": None,
+        }
+
+    matched = match_food_items(food_items, db)
+    matches = matched['food_matches']
+    db_estimate = None
+    if matches:
+        db_estimate = {column: round(float(value), 1)
+                       for column, value in zip(NUTRIENT_COLUMNS, matched['totals'])}
+    # частка зіставлених страв, зважена якістю збігу
+    confidence = sum(m['score'] for m in matches) / len(food_items)
     return {
-        "llm_estimate": llm_estimate,   # те, що витягнули з LLM
-        "db_estimate": None,            # більше не використовуємо
-        "food_matches": [],             # перелік збігів із БД тепер порожній
-        "unmatched_items": food_items,  # просто повертаємо всі знайдені items
-        "confidence_score": None,       # немає чим рахувати
+        "llm_estimate": llm_estimate,
+        "db_estimate": db_estimate,
+        "food_matches": matches,
+        "unmatched_items": matched['unmatched_items'],
+        "confidence_score": round(confidence, 3),
     }
+
+
+async def enhance_nutrition_estimate_async(
+    llm_estimate: Dict[str, Any],
+    food_items: List[str],
+) -> Dict[str, Any]:
+    """enhance_nutrition_estimate для коду на event loop: перше завантаження бази — у потоці."""
+    if not _food_db_loaded:
+        await asyncio.to_thread(get_food_database)
+    return enhance_nutrition_estimate(llm_estimate, food_items)
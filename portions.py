@@ -0,0 +1,183 @@
+"""Portion sizes as the model writes them ("150g", "15ml", "1 cup", "2 slices") to grams."""
+import re
+from typing import Optional
+
+# Grams per unit for units that are a weight by definition
+_WEIGHT_UNITS = {
+    'g': 1.0, 'gram': 1.0, 'grams': 1.0, 'gr': 1.0,
+    'kg': 1000.0, 'kilogram': 1000.0, 'kilograms': 1000.0,
+    'mg': 0.001,
+    'oz': 28.35, 'ounce': 28.35, 'ounces': 28.35,
+    'lb': 453.6, 'lbs': 453.6, 'pound': 453.6, 'pounds': 453.6,
+    # not a weight, but close enough to one for nuts, berries, chips
+    'handful': 30.0, 'handfuls': 30.0,
+}
+
+# Millilitres per unit for volume units
+_VOLUME_UNITS = {
+    'ml': 1.0, 'milliliter': 1.0, 'milliliters': 1.0, 'millilitre': 1.0, 'millilitres': 1.0,
+    'l': 1000.0, 'liter': 1000.0, 'liters': 1000.0, 'litre': 1000.0, 'litres': 1000.0,
+    'cl': 10.0, 'dl': 100.0,
+    'fl oz': 29.57, 'floz': 29.57,
+    'cup': 240.0, 'cups': 240.0,
+    'tbsp': 15.0, 'tablespoon': 15.0, 'tablespoons': 15.0,
+    'tsp': 5.0, 'teaspoon': 5.0, 'teaspoons': 5.0,
+    'glass': 250.0, 'glasses': 250.0, 'bowl': 350.0, 'bowls': 350.0,
+}
+
+# Counted units; the weight of one comes from _PIECE_GRAMS by food name
+_COUNT_UNITS = {
+    'piece', 'pieces', 'pc', 'pcs', 'slice', 'slices', 'item', 'items', 'whole', 'serving', 'servings',
+    'small', 'medium', 'large', 'unit', 'units', 'portion', 'portions',
+}
+
+# g/ml by keyword (a whole word, plural allowed) in the food name; the
+# earliest entry found wins, water-like otherwise
+_DENSITIES = (
+    ('oil', 0.92), ('butter', 0.91), ('honey', 1.42), ('syrup', 1.33), ('sugar', 0.85),
+    ('flour', 0.53), ('granola', 0.45), ('cereal', 0.35), ('oats', 0.41), ('muesli', 0.45),
+    ('rice', 0.79), ('quinoa', 0.78), ('pasta', 0.6), ('noodle', 0.6), ('bean', 0.75), ('lentil', 0.8),
+    ('salad', 0.25), ('lettuce', 0.2), ('spinach', 0.15), ('greens', 0.2), ('vegetable', 0.55),
+    ('berry', 0.6), ('blueberry', 0.6), ('raspberry', 0.6), ('strawberry', 0.6), ('blackberry', 0.6),
+    ('fruit', 0.6), ('nut', 0.6), ('peanut', 0.6), ('walnut', 0.6), ('almond', 0.6), ('cheese', 0.45),
+    ('yogurt', 1.03), ('yoghurt', 1.03), ('milk', 1.03), ('cream', 1.0), ('sauce', 1.05),
+    ('soup', 1.0), ('juice', 1.04), ('smoothie', 1.05), ('hummus', 1.0), ('dressing', 1.0),
+)
+
+# Grams of one piece/slice/serving by keyword in the food name, matched the same way
+_PIECE_GRAMS = (
+    ('egg', 50.0), ('pizza', 107.0), ('bread', 30.0), ('toast', 30.0), ('bagel', 100.0),
+    ('tortilla', 45.0), ('pancake', 40.0), ('waffle', 75.0), ('muffin', 60.0), ('croissant', 60.0),
+    ('cookie', 15.0), ('biscuit', 15.0), ('cake', 80.0), ('apple', 180.0), ('banana', 118.0),
+    ('orange', 130.0), ('avocado', 150.0), ('tomato', 120.0), ('potato', 170.0), ('carrot', 60.0),
+    ('strawberry', 12.0), ('date', 8.0), ('sushi', 30.0), ('dumpling', 25.0), ('meatball', 30.0),
+    ('sausage', 75.0), ('bacon', 10.0), ('nugget', 18.0), ('wing', 35.0), ('drumstick', 75.0),
+    ('chicken breast', 170.0), ('burger', 220.0), ('sandwich', 200.0), ('taco', 100.0),
+)
+DEFAULT_PIECE_GRAMS = 100.0
+
+_FRACTIONS = {'½': 0.5, '⅓': 1 / 3, '⅔': 2 / 3, '¼': 0.25, '¾': 0.75, '⅛': 0.125}
+_WORD_NUMBERS = {
+    'a': 1.0, 'an': 1.0, 'one': 1.0, 'two': 2.0, 'three': 3.0, 'four': 4.0, 'five': 5.0, 'six': 6.0,
+    'half': 0.5, 'quarter': 0.25, 'couple': 2.0, 'few': 3.0,
+}
+
+# "1,000" / "1,000.5" group thousands; any other comma is a decimal point ("1,5 kg")
+_NUMBER = r'(?:\d+\s+\d+/\d+|\d+/\d+|\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:[.,]\d+)?|[½⅓⅔¼¾⅛])'
+_THOUSANDS_RE = re.compile(r'(?<=\d),(?=\d{3}(?!\d))')
+_UNIT_NAMES = sorted(set(_WEIGHT_UNITS) | set(_VOLUME_UNITS) | _COUNT_UNITS, key=len, reverse=True)
+_PORTION_RE = re.compile(
+    rf'(?P<amount>{_NUMBER}(?:\s*[½⅓⅔¼¾⅛])?)(?:\s*(?:-|–|to)\s*(?P<upper>{_NUMBER}))?'
+    rf'\s*(?P<unit>{"|".join(re.escape(u) for u in _UNIT_NAMES)})?\b',
+    re.IGNORECASE,
+)
+_COUNT_WORD_RE = re.compile(
+    rf'\b(?P<unit>{"|".join(sorted(_COUNT_UNITS, key=len, reverse=True))})\b',
+    re.IGNORECASE,
+)
+_WORD_PORTION_RE = re.compile(
+    rf'\b(?P<amount>{"|".join(_WORD_NUMBERS)})\s+(?:of\s+)?(?:an?\s+)?(?P<unit>{"|".join(re.escape(u) for u in _UNIT_NAMES)})\b',
+    re.IGNORECASE,
+)
+
+
+def _to_number(text: str) -> float:
+    text = _THOUSANDS_RE.sub('', text.strip()).replace(',', '.')
+    total = 0.0
+    for char, value in _FRACTIONS.items():
+        if char in text:
+            total += value
+            text = text.replace(char, '').strip()
+    for part in text.split():
+        if '/' in part:
+            numerator, denominator = part.split('/', 1)
+            total += float(numerator) / float(denominator)
+        elif part:
+            total += float(part)
+    return total
+
+
+def _keyword_regex(table) -> re.Pattern:
+    """One alternation over the table's keywords as whole words, longest first.
+
+    Group k<i> is table entry i. A keyword also matches its plural
+    ('egg' -> 'eggs', 'berry' -> 'berries') but never inside another word,
+    so 'oil' no longer matches "boiled" nor 'egg' "eggplant".
+    """
+    alternatives = []
+    for index, (keyword, _) in sorted(enumerate(table), key=lambda entry: -len(entry[1][0])):
+        if keyword.endswith('y'):
+            pattern = re.escape(keyword[:-1]) + '(?:y|ies)'
+        else:
+            pattern = re.escape(keyword) + '(?:e?s)?'
+        alternatives.append(f'(?P<k{index}>{pattern})')
+    return re.compile(r'\b(?:' + '|'.join(alternatives) + r')\b')
+
+
+_DENSITY_RE = _keyword_regex(_DENSITIES)
+_PIECE_GRAMS_RE = _keyword_regex(_PIECE_GRAMS)
+
+
+def _lookup(table, pattern: re.Pattern, name: str, default: float) -> float:
+    best = None
+    for match in pattern.finditer(name.lower()):
+        index = int(match.lastgroup[1:])
+        if best is None or index < best:
+            best = index
+    return default if best is None else table[best][1]
+
+
+def density(name: str) -> float:
+    """Grams per millilitre for a food name."""
+    return _lookup(_DENSITIES, _DENSITY_RE, name, 1.0)
+
+
+def piece_grams(name: str) -> float:
+    return _lookup(_PIECE_GRAMS, _PIECE_GRAMS_RE, name, DEFAULT_PIECE_GRAMS)
+
+
+def unit_grams(unit: Optional[str], name: str = '') -> Optional[float]:
+    """Grams in one `unit` of the named food; None for an unknown unit."""
+    unit = (unit or '').lower()
+    if unit in _WEIGHT_UNITS:
+        return _WEIGHT_UNITS[unit]
+    if unit in _VOLUME_UNITS:
+        return _VOLUME_UNITS[unit] * density(name)
+    if unit in _COUNT_UNITS or not unit:
+        return piece_grams(name)
+    return None
+
+
+def portion_to_grams(portion: Optional[str], name: str = '') -> Optional[float]:
+    """Weight in grams of a portion such as "150g", "15ml", "1 1/2 cups", "2-3 slices", "one medium".
+
+    Volumes use the density of the food, counted units the typical weight
+    of one piece. Ranges use their midpoint. Returns None when the portion
+    has no amount that can be read, or a number without a unit ("100"),
+    which could as well be grams as pieces.
+    """
+    if not portion:
+        return None
+    match = _PORTION_RE.search(portion)
+    if match:
+        amount = _to_number(match.group('amount'))
+        if match.group('upper'):
+            amount = (amount + _to_number(match.group('upper'))) / 2
+        unit = match.group('unit')
+        if not unit:
+            return None
+        # "fl oz" is one unit even when the regex only saw "oz"
+        if unit and unit.lower() == 'oz' and re.search(r'fl\.?\s*oz', portion, re.IGNORECASE):
+            unit = 'fl oz'
+    else:
+        match = _WORD_PORTION_RE.search(portion)
+        if match:
+            amount, unit = _WORD_NUMBERS[match.group('amount').lower()], match.group('unit')
+        else:
+            # "large", "1 whole" without a number: one piece
+            match = _COUNT_WORD_RE.search(portion)
+            if not match:
+                return None
+            amount, unit = 1.0, match.group('unit')
+    grams = unit_grams(unit, name)
+    return None if grams is None else amount * grams
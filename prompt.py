@@ -76,4 +76,42 @@ Valid response example:
    - Broccoli
    - Carrots
    - Bell peppers
-   - Olive"""
\ No newline at end of file
+   - Olive"""
+
+# Compact structured-output variant: same analysis steps, but the answer is
+# short-keyed JSON constrained by RESPONSE_SCHEMA instead of free text.
+STRUCTURED_SYSTEM_PROMPT = SYSTEM_PROMPT[:SYSTEM_PROMPT.index("Your response MUST follow")] + """Reply with JSON only, using these keys:
+kcal: total calories
+carb, prot, fat, fib: total carbohydrates, protein, fat and fiber in grams
+items: every food item as {"n": name, "p": portion size such as "150g" or "15ml"}
+plants: every plant-based ingredient
+
+Example:
+{"kcal":450,"carb":45,"prot":25,"fat":20,"fib":8,"items":[{"n":"Greek yogurt","p":"150g"},{"n":"Mixed berries","p":"100g"},{"n":"Granola","p":"30g"}],"plants":["Blueberries","Strawberries","Raspberries","Oats","Almonds"]}"""
+
+RESPONSE_SCHEMA = {
+    "name": "meal_estimate",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "kcal": {"type": "number"},
+            "carb": {"type": "number"},
+            "prot": {"type": "number"},
+            "fat": {"type": "number"},
+            "fib": {"type": "number"},
+            "items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"n": {"type": "string"}, "p": {"type": "string"}},
+                    "required": ["n", "p"],
+                    "additionalProperties": False
+                }
+            },
+            "plants": {"type": "array", "items": {"type": "string"}}
+        },
+        "required": ["kcal", "carb", "prot", "fat", "fib", "items", "plants"],
+        "additionalProperties": False
+    }
+}
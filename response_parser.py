@@ -0,0 +1,203 @@
+import json
+import re
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+FoodItem = namedtuple('FoodItem', ['name', 'portion', 'text'])
+
+NUTRIENT_FIELDS = ('calories', 'carbohydrates', 'protein', 'fat', 'fiber')
+
+# How each total is written: label, then separator, number and unit. Both the
+# single-pass and the bulk parser are built from these; macros need their "g"
+_TOTAL_LABELS = {
+    'calories': r'CALORIES',
+    'carbohydrates': r'Carbohydrates',
+    'protein': r'Protein',
+    'fat': r'Fat',
+    'fiber': r'(?i:dietary fiber|fiber|fibre)',
+}
+_TOTAL_UNITS = {'calories': ''}
+_TOTAL_VALUE = r'[:\s]*(?P<{field}_value>\d+(?:\.\d+)?)'
+
+
+def _total_pattern(field: str) -> str:
+    return _TOTAL_LABELS[field] + _TOTAL_VALUE.format(field=field) + _TOTAL_UNITS.get(field, 'g')
+
+
+# One alternation for every total line; match.lastgroup names the field
+_TOTAL_RE = re.compile('|'.join(f'(?P<{field}>{_total_pattern(field)})' for field in NUTRIENT_FIELDS))
+_PORTION_RE = re.compile(r'^(?P<name>.*?)\s*\((?P<portion>[^()]*)\)\s*$')
+_FOOD_HEADER = 'food items:'
+_PLANT_HEADER = 'plant-based ingredients:'
+
+
+class ParsedResponse:
+    """Everything DietGPT reads out of one LLM response."""
+    __slots__ = NUTRIENT_FIELDS + ('food_items', 'plant_items')
+
+    def __init__(self):
+        self.calories: Optional[float] = None
+        self.carbohydrates: Optional[float] = None
+        self.protein: Optional[float] = None
+        self.fat: Optional[float] = None
+        self.fiber: Optional[float] = None
+        self.food_items: List[FoodItem] = []
+        self.plant_items: List[str] = []
+
+    def nutrition(self) -> Dict[str, Optional[float]]:
+        """Totals in the dict shape extract_nutrition has always returned."""
+        return {field: getattr(self, field) for field in NUTRIENT_FIELDS}
+
+    def food_item_texts(self) -> List[str]:
+        return [item.text for item in self.food_items]
+
+    def to_text(self) -> str:
+        """Render in the SYSTEM_PROMPT text format, so consumers of the raw text keep working."""
+        def number(value):
+            return 'N/A' if value is None else f"{value:g}"
+        lines = [
+            f"CALORIES: {number(self.calories)}",
+            f"Carbohydrates: {number(self.carbohydrates)}g",
+            f"Protein: {number(self.protein)}g",
+            f"Fat: {number(self.fat)}g",
+            f"Fiber: {number(self.fiber)}g",
+            "",
+            "Food Items:",
+        ]
+        lines.extend(f"- {item.text}" for item in self.food_items)
+        lines.extend(["", "Plant-based Ingredients:"])
+        lines.extend(f"- {plant}" for plant in self.plant_items)
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return (f"ParsedResponse(calories={self.calories}, food_items={len(self.food_items)}, "
+                f"plant_items={len(self.plant_items)})")
+
+
+def parse_food_item(text: str) -> FoodItem:
+    match = _PORTION_RE.match(text)
+    if match:
+        return FoodItem(match.group('name'), match.group('portion').strip() or None, text)
+    return FoodItem(text, None, text)
+
+
+# Short keys of the structured-output mode (prompt.RESPONSE_SCHEMA)
+_STRUCTURED_KEYS = (('kcal', 'calories'), ('carb', 'carbohydrates'), ('prot', 'protein'),
+                    ('fat', 'fat'), ('fib', 'fiber'))
+
+
+def _number(value) -> Optional[float]:
+    try:
+        return None if value is None else float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_structured(data: Dict) -> ParsedResponse:
+    """Build a ParsedResponse from a decoded structured-output (JSON) answer."""
+    parsed = ParsedResponse()
+    for key, field in _STRUCTURED_KEYS:
+        setattr(parsed, field, _number(data.get(key)))
+    for item in data.get('items') or []:
+        if isinstance(item, dict):
+            name, portion = str(item.get('n', '')).strip(), str(item.get('p', '')).strip() or None
+        else:
+            name, portion = str(item).strip(), None
+        if name:
+            parsed.food_items.append(FoodItem(name, portion, f"{name} ({portion})" if portion else name))
+    parsed.plant_items = [str(p).strip() for p in data.get('plants') or [] if str(p).strip()]
+    return parsed
+
+
+def parse_response(response: str) -> ParsedResponse:
+    """Read an LLM response in a single pass.
+
+    JSON answers from the structured-output mode are decoded without any
+    regex; anything else (or JSON that fails to decode, e.g. a truncated
+    answer) goes through the SYSTEM_PROMPT text scanner. There the first
+    occurrence of each total wins, and "Food Items:" / "Plant-based
+    Ingredients:" open a section whose "- " lines are collected until a
+    blank line or any other text closes it.
+    """
+    parsed = ParsedResponse()
+    if not response:
+        return parsed
+    if response.lstrip().startswith('{'):
+        try:
+            data = json.loads(response)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            return parse_structured(data)
+    section = None
+    for raw_line in response.splitlines():
+        line = raw_line.strip()
+        if not line:
+            # A blank line ends a section, unless it sits between header and first item
+            if section:
+                section = None
+            continue
+        lowered = line.lower()
+        if lowered.startswith(_FOOD_HEADER):
+            section = parsed.food_items
+            continue
+        if lowered.startswith(_PLANT_HEADER):
+            section = parsed.plant_items
+            continue
+        if line[0] == '-' and section is not None:
+            item = line[1:].strip()
+            if item:
+                section.append(parse_food_item(item) if section is parsed.food_items else item)
+            continue
+        section = None
+        for match in _TOTAL_RE.finditer(line):
+            field = match.lastgroup
+            if getattr(parsed, field) is None:
+                setattr(parsed, field, float(match.group(f'{field}_value')))
+    return parsed
+
+
+def extract_food_items(response: str) -> List[str]:
+    """Food item lines (with their portions) from the "Food Items:" section."""
+    return parse_response(response).food_item_texts()
+
+
+def extract_plant_items(response: str) -> List[str]:
+    return parse_response(response).plant_items
+
+
+# --- bulk ------------------------------------------------------------------
+# The same total patterns as the single-pass parser, one per column
+_BULK_PATTERNS = {field: _total_pattern(field) for field in NUTRIENT_FIELDS}
+_BULK_FOOD_SECTION = r'(?im)^[ \t]*Food Items:[ \t]*\n(?:[ \t]*\n)*((?:[ \t]*-[^\n]*(?:\n|$))+)'
+_BULK_PLANT_SECTION = r'(?im)^[ \t]*Plant-based Ingredients:[ \t]*\n(?:[ \t]*\n)*((?:[ \t]*-[^\n]*(?:\n|$))+)'
+_BULK_ITEM = r'(?m)^[ \t]*-[ \t]*(\S[^\n]*?)[ \t]*$'
+
+
+def parse_responses_bulk(responses: pd.Series) -> pd.DataFrame:
+    """Parse a whole column of responses at once with pandas' vectorized str methods.
+
+    Totals use the same patterns as parse_response. Returns one row per
+    input row (same index) with float columns for every total and list
+    columns food_items / plant_items.
+    """
+    text = responses.fillna('').astype(str)
+    columns = {
+        field: pd.to_numeric(text.str.extract(pattern, expand=False), errors='coerce')
+        for field, pattern in _BULK_PATTERNS.items()
+    }
+    for column, pattern in (('food_items', _BULK_FOOD_SECTION), ('plant_items', _BULK_PLANT_SECTION)):
+        sections = text.str.extract(pattern, expand=False).fillna('')
+        columns[column] = sections.str.findall(_BULK_ITEM)
+    frame = pd.DataFrame(columns, index=responses.index)
+    # Raw structured answers are rare here (they are stored rendered as text)
+    for index in text.index[text.str.lstrip().str.startswith('{')]:
+        parsed = parse_response(text[index])
+        for field in NUTRIENT_FIELDS:
+            frame.at[index, field] = np.nan if getattr(parsed, field) is None else getattr(parsed, field)
+        frame.at[index, 'food_items'] = parsed.food_item_texts()
+        frame.at[index, 'plant_items'] = parsed.plant_items
+    return frame
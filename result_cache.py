@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'estimates')
+
+
+def make_cache_key(image_bytes: bytes, model: str, system_prompt: str, variant: str = '') -> str:
+    """Content address for one estimate: normalized JPEG bytes + model + prompt."""
+    digest = hashlib.sha256()
+    for part in (model.encode('utf-8'), system_prompt.encode('utf-8'), variant.encode('utf-8')):
+        # Length-prefix every part so different splits can never collide
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    digest.update(image_bytes)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Two-tier (memory LRU + disk) cache for estimate results with single-flight lookups."""
+
+    def __init__(self, cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                 max_memory_entries: int = 512,
+                 max_disk_bytes: int = 64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._disk_bytes: Optional[int] = None
+        self._evicting = False
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    # --- memory tier ---------------------------------------------------------
+    def _memory_get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+            return value
+
+    def _memory_put(self, key: str, value: Dict[str, Any]):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    # --- disk tier -----------------------------------------------------------
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _disk_get(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+            # Touch the entry so eviction stays least-recently-used
+            os.utime(path, None)
+            return value
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Dropping unreadable cache entry {path}: {str(e)}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def _disk_put(self, key: str, value: Dict[str, Any]):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(value).encode('utf-8')
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not write cache entry {path}: {str(e)}")
+            return
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(data)
+            # One scan at a time; writers arriving meanwhile leave it to that one
+            over_budget = (self._disk_bytes is None or self._disk_bytes > self.max_disk_bytes) and not self._evicting
+            if over_budget:
+                self._evicting = True
+        if over_budget:
+            try:
+                self._evict_disk()
+            finally:
+                with self._lock:
+                    self._evicting = False
+
+    def _evict_disk(self):
+        """Remove least recently used files until the disk tier fits its byte budget."""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        if total > self.max_disk_bytes:
+            entries.sort()
+            # Evict down to 90% so we don't rescan on every subsequent write
+            target = int(self.max_disk_bytes * 0.9)
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+        with self._lock:
+            self._disk_bytes = total
+
+    # --- public API ----------------------------------------------------------
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._memory_get(key)
+        if value is None:
+            value = self._disk_get(key)
+            if value is not None:
+                self._memory_put(key, value)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key: str, value: Dict[str, Any]):
+        self._memory_put(key, value)
+        self._disk_put(key, value)
+
+    async def get_or_compute(self, key: str,
+                             compute: Callable[[], Awaitable[Dict[str, Any]]],
+                             cacheable: Optional[Callable[[Dict[str, Any]], bool]] = None) -> Dict[str, Any]:
+        """Return the cached result for key, or run compute once for all concurrent callers.
+
+        Only successful results (that also pass cacheable, if given) are
+        stored; anything else is handed to every waiter of the in-flight call
+        but the next caller tries again. The disk write runs in a worker
+        thread so it never blocks the event loop.
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return dict(cached, cached=True)
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            pending = self._inflight.get(key)
+            # Futures are bound to their loop, so only coalesce within the same one
+            if pending is not None and pending.get_loop() is loop and not pending.done():
+                owner = False
+            else:
+                pending = loop.create_future()
+                self._inflight[key] = pending
+                owner = True
+
+        if not owner:
+            return dict(await asyncio.shield(pending))
+
+        try:
+            result = await compute()
+        except BaseException as e:
+            if not pending.done():
+                pending.set_exception(e)
+                # Mark retrieved so an unobserved failure doesn't log a warning
+                pending.exception()
+            raise
+        else:
+            store = result.get('success') and (cacheable is None or cacheable(result))
+            if store:
+                self._memory_put(key, result)
+            if not pending.done():
+                pending.set_result(result)
+            if store:
+                await asyncio.to_thread(self._disk_put, key, result)
+            return result
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is pending:
+                    del self._inflight[key]
+
+
+_default_cache: Optional[ResultCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache() -> ResultCache:
+    """Process-wide cache shared by every CalorieEstimator that doesn't bring its own."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResultCache(
+                cache_dir=os.environ.get('DIETGPT_CACHE_DIR', DEFAULT_CACHE_DIR),
+                max_disk_bytes=int(os.environ.get('DIETGPT_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+            )
+        return _default_cache
@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'results.sqlite3')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    row_number INTEGER PRIMARY KEY,
+    username   TEXT NOT NULL,
+    timestamp  TEXT NOT NULL,
+    row_json   TEXT NOT NULL
+);
+DROP INDEX IF EXISTS results_user_time;
+CREATE INDEX IF NOT EXISTS results_user_row ON results (username, row_number);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pending (
+    id        TEXT PRIMARY KEY,
+    username  TEXT NOT NULL,
+    queued_at REAL NOT NULL,
+    sent_at   REAL,
+    row_json  TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pending_user_time ON pending (username, queued_at);
+"""
+
+
+def _json_list(value) -> List[str]:
+    if isinstance(value, list):
+        return value
+    if not value:
+        return []
+    try:
+        decoded = json.loads(value)
+        return decoded if isinstance(decoded, list) else [str(decoded)]
+    except (TypeError, ValueError):
+        return [part.strip() for part in str(value).split(',') if part.strip()]
+
+
+def result_from_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Shape one Results sheet row the way /user-results has always returned it."""
+    return {
+        'timestamp': row.get('Timestamp'),
+        'llm_calories': row.get('LLM_Calories', row.get('Calories')),
+        'db_calories': row.get('DB_Calories'),
+        'fiber': row.get('Fiber'),
+        'food_items': _json_list(row.get('Food_Items')),
+        'plant_items': _json_list(row.get('Plant_Items', row.get('Plant_based_Ingredients'))),
+        'image_url': row.get('Image_URL'),
+    }
+
+
+class ResultsMirror:
+    """Local SQLite copy of the append-only Results sheet, indexed by (Username, sheet row).
+
+    Rows are keyed by their position in the sheet, so the number of rows
+    already mirrored is the high-water mark: sync() asks only for rows after
+    it and appends them. Per-user history is then an index range scan, and
+    only the rows of the requested page are JSON-decoded.
+
+    Reads never wait on the sheet: a background thread syncs at start and
+    whenever a read finds the mirror stale (older than sync_interval, or
+    marked stale after a flush). Rows still queued for the sheet are kept
+    as pending and listed after the synced ones until a sync brings them in.
+    """
+
+    def __init__(self, fetch_rows: Callable[[int], Tuple[List[Dict[str, Any]], int]],
+                 path: str = DEFAULT_DB_PATH, sync_interval: float = 30.0, background: bool = True):
+        """fetch_rows(offset) returns (rows, offset_of_first_row) for the sheet from offset on."""
+        self.fetch_rows = fetch_rows
+        self.path = path
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        # Serializes syncs; held while the sheet is fetched, which reads never wait for
+        self._sync_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._last_sync = 0.0
+        self._stale = True
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._run, name='results-mirror', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+        with self._lock:
+            self._conn.close()
+
+    def _run(self):
+        while not self._closed:
+            try:
+                self.sync()
+            except Exception as e:
+                # Serve what we have; the next stale read tries again
+                logging.error(f"Error syncing results mirror: {str(e)}")
+            self._wake.wait()
+            self._wake.clear()
+
+    @property
+    def high_water(self) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'high_water'").fetchone()
+        return int(row[0]) if row else 0
+
+    def mark_stale(self):
+        """Make the next read start a sync, e.g. right after rows were appended to the sheet."""
+        self._stale = True
+
+    def request_sync(self):
+        """Wake the background sync if the mirror is stale; never blocks."""
+        if self._stale or time.monotonic() - self._last_sync >= self.sync_interval:
+            self._wake.set()
+
+    def add_pending(self, row_id: str, row: Dict[str, Any]):
+        """Show a row queued for the sheet before it gets there."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pending (id, username, queued_at, row_json) VALUES (?, ?, ?, ?)",
+                (row_id, str(row.get('Username', '')), time.time(), json.dumps(row)))
+
+    def mark_sent(self, row_ids: List[str]):
+        """Rows the sheet accepted; the sync this starts replaces them with the sheet's copies."""
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE pending SET sent_at = ? WHERE id = ?",
+                                   [(time.time(), row_id) for row_id in row_ids])
+        self.mark_stale()
+        self._wake.set()
+
+    def sync(self) -> int:
+        """Pull rows past the high-water mark; returns how many were added."""
+        with self._sync_lock:
+            started = time.time()
+            high_water = self.high_water
+            rows, start = self.fetch_rows(high_water)
+            with self._lock, self._conn:
+                if start + len(rows) < high_water:
+                    # The sheet shrank (rows deleted by hand): rebuild from scratch
+                    logging.warning(f"Results sheet has {start + len(rows)} rows, mirror had {high_water}; rebuilding")
+                    self._conn.execute("DELETE FROM results")
+                    high_water = 0
+                new_rows = rows[max(0, high_water - start):]
+                first = max(high_water, start)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO results (row_number, username, timestamp, row_json) VALUES (?, ?, ?, ?)",
+                    [(first + i, str(row.get('Username', '')), str(row.get('Timestamp', '')), json.dumps(row))
+                     for i, row in enumerate(new_rows)])
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('high_water', ?)",
+                                   (str(first + len(new_rows)),))
+                # Sent before this fetch started, so the fetched rows include them
+                self._conn.execute("DELETE FROM pending WHERE sent_at IS NOT NULL AND sent_at <= ?", (started,))
+            self._last_sync = time.monotonic()
+            self._stale = False
+            return len(new_rows)
+
+    def count(self, username: str) -> int:
+        with self._lock:
+            synced = self._conn.execute("SELECT COUNT(*) FROM results WHERE username = ?", (username,)).fetchone()[0]
+            pending = self._conn.execute("SELECT COUNT(*) FROM pending WHERE username = ?", (username,)).fetchone()[0]
+        return synced + pending
+
+    def user_results(self, username: str, limit: Optional[int] = None, offset: int = 0) -> List[Dict[str, Any]]:
+        """One page of a user's results, in sheet order, followed by rows still queued for the sheet."""
+        self.request_sync()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT row_json FROM results WHERE username = ? "
+                "ORDER BY row_number LIMIT ? OFFSET ?",
+                (username, -1 if limit is None else limit, offset)).fetchall()
+            if limit is None or len(rows) < limit:
+                synced = self._conn.execute("SELECT COUNT(*) FROM results WHERE username = ?",
+                                            (username,)).fetchone()[0]
+                rows += self._conn.execute(
+                    "SELECT row_json FROM pending WHERE username = ? "
+                    "ORDER BY queued_at LIMIT ? OFFSET ?",
+                    (username, -1 if limit is None else limit - len(rows), max(0, offset - synced))).fetchall()
+        return [result_from_row(json.loads(row_json)) for (row_json,) in rows]
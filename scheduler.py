@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional
+
+from image_pipeline import PIPELINE_DONE
+
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_SCALE = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Parse OpenAI reset durations such as '1s', '6m0s' or '20ms' into seconds."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_SCALE[unit] for number, unit in parts)
+
+
+def parse_retry_after(headers: Mapping[str, str], default: float) -> float:
+    for name in ('retry-after-ms', 'Retry-After'):
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            seconds = float(value)
+        except ValueError:
+            continue
+        return seconds / 1000.0 if name == 'retry-after-ms' else seconds
+    return default
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on concurrent API requests, driven by rate-limit feedback.
+
+    Every success grows the limit by about one slot per round of requests;
+    a 429 halves it (at most once per cooldown, so a burst of 429s from the
+    same round counts once) and pauses all callers until Retry-After has
+    passed. The x-ratelimit-remaining-* / x-ratelimit-reset-* headers cap
+    the limit before the account runs dry, so we rarely see the 429 at all.
+    """
+
+    def __init__(self, initial: int = 3, min_limit: int = 1, max_limit: int = 16,
+                 decrease_cooldown: float = 2.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.decrease_cooldown = decrease_cooldown
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._last_decrease = 0.0
+        self._condition: Optional[asyncio.Condition] = None
+
+    def _get_condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self):
+        condition = self._get_condition()
+        async with condition:
+            while True:
+                delay = self.paused_until - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(condition.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                await condition.wait()
+
+    async def release(self):
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.release()
+
+    def on_success(self, headers: Mapping[str, str]):
+        # Additive increase: +1 slot once a full window of requests has succeeded
+        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        self._apply_headers(headers)
+
+    def on_rate_limited(self, retry_after: float, headers: Optional[Mapping[str, str]] = None):
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + retry_after)
+        if now - self._last_decrease >= self.decrease_cooldown:
+            self._last_decrease = now
+            self.limit = max(self.min_limit, self.limit / 2)
+            logging.info(f"Rate limited, concurrency reduced to {int(self.limit)}, pausing {retry_after:.1f}s")
+        if headers:
+            self._apply_headers(headers)
+
+    def _apply_headers(self, headers: Mapping[str, str]):
+        for kind in ('requests', 'tokens'):
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            if remaining is None:
+                continue
+            try:
+                remaining = int(float(remaining))
+            except ValueError:
+                continue
+            reset = parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+            if kind == 'requests' and remaining < self.limit:
+                # Never keep more requests in flight than the window has left
+                self.limit = float(max(self.min_limit, remaining))
+            if remaining <= 0 and reset:
+                self.paused_until = max(self.paused_until, time.monotonic() + reset)
+
+
+class LatencyTracker:
+    """Sliding window of recent request latencies, for picking a hedging delay."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """The q-quantile of the window, or None until min_samples have been seen."""
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    """Per-endpoint breaker: reject work at once while the upstream keeps failing.
+
+    Opens after failure_threshold consecutive retryable failures, or at the
+    first failure that affects the whole endpoint (bad key, retired model,
+    TLS trust). While open every call is refused without touching the
+    network; after reset_timeout one probe is let through, and its outcome
+    closes or re-opens the breaker. Callers that would rather wait than fail
+    (dataset runs) sleep for retry_in() and try again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.reason = ''
+        # Opened by a failure every request would hit (bad key, retired model)
+        self.endpoint_wide = False
+        self._probe_started: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def rejects(self) -> bool:
+        """True while calls would be refused; unlike allow(), never claims the probe."""
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            now = time.monotonic()
+            return (now - self.opened_at < self.reset_timeout
+                    or (self._probe_started is not None and now - self._probe_started < self.reset_timeout))
+
+    def retry_in(self) -> float:
+        """Seconds until rejects() could turn False: the cooldown, or the running probe's timeout."""
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            now = time.monotonic()
+            remaining = self.reset_timeout - (now - self.opened_at)
+            if self._probe_started is not None:
+                remaining = max(remaining, self.reset_timeout - (now - self._probe_started))
+            return max(0.0, remaining)
+
+    def allow(self) -> bool:
+        """True if a call may go out now (always when closed; one probe at a time once cooled down)."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            # A probe that never reported back (cancelled) doesn't block the next one forever
+            if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+                return False
+            self._probe_started = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logging.info(f"Circuit for {self.name} closed again")
+            self.failures = 0
+            self.opened_at = None
+            self._probe_started = None
+            self.reason = ''
+            self.endpoint_wide = False
+
+    def record_failure(self, reason: str, endpoint_wide: bool = False):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is None and not endpoint_wide and self.failures < self.failure_threshold:
+                return
+            if self.opened_at is None:
+                logging.error(f"Circuit for {self.name} opened for {self.reset_timeout:g}s: {reason}")
+            self.opened_at = time.monotonic()
+            self._probe_started = None
+            self.reason = reason
+            self.endpoint_wide = endpoint_wide
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(endpoint: str) -> CircuitBreaker:
+    """The process-wide breaker for endpoint (DIETGPT_BREAKER_FAILURES / DIETGPT_BREAKER_RESET)."""
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = _breakers[endpoint] = CircuitBreaker(
+                endpoint,
+                failure_threshold=int(os.environ.get('DIETGPT_BREAKER_FAILURES', 5)),
+                reset_timeout=float(os.environ.get('DIETGPT_BREAKER_RESET', 30.0)))
+        return breaker
+
+
+async def consume_queue(queue: asyncio.Queue, handle: Callable[[Any], Awaitable[None]], workers: int):
+    """Run workers that pull items off queue until each sees PIPELINE_DONE.
+
+    There are no batch barriers: a worker picks up the next item as soon as
+    its previous one finishes, and the limiter inside handle decides how
+    many of them actually talk to the API at once.
+    """
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is PIPELINE_DONE:
+                return
+            await handle(item)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Mapping, Optional
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'rate_limit.sqlite3')
+# Starting limits until the API reports the real ones in x-ratelimit-limit-*
+DEFAULT_RPM = 500
+DEFAULT_TPM = 200000
+# A full bucket holds this many seconds' worth of budget, so bursts stay short
+BURST_SECONDS = 10.0
+KINDS = ('requests', 'tokens')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    name       TEXT PRIMARY KEY,
+    level      REAL NOT NULL,
+    updated    REAL NOT NULL,
+    per_minute REAL NOT NULL
+);
+"""
+
+
+class SharedRateLimiter:
+    """Requests-per-minute and tokens-per-minute token buckets shared by every process on the host.
+
+    Bucket levels live in a small SQLite file, and every reservation is one
+    BEGIN IMMEDIATE transaction, so Flask workers, Streamlit and an
+    evaluation run all draw from the same budget. Reservations may take a
+    bucket below zero; the caller then sleeps until the refill covers it,
+    which queues callers in order instead of letting them all retry at
+    once. Limits passed in (or set through DIETGPT_RPM / DIETGPT_TPM) are
+    fixed; otherwise they follow the x-ratelimit-limit-* headers, and what
+    one process learns is used by all of them.
+
+    A transaction can wait up to 10s for another process's lock, so from
+    async code every one runs on this limiter's own worker thread (one,
+    which keeps them in call order) and the event loop never blocks on it.
+    """
+
+    def __init__(self, scope: str, rpm: Optional[float] = None, tpm: Optional[float] = None,
+                 path: str = DEFAULT_DB_PATH):
+        self.scope = scope
+        self.path = path
+        self.fixed = {'requests': rpm is not None, 'tokens': tpm is not None}
+        self.per_minute = {
+            'requests': float(DEFAULT_RPM if rpm is None else rpm),
+            'tokens': float(DEFAULT_TPM if tpm is None else tpm),
+        }
+        self.waited = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rate-limit')
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # Losing the last few updates in a crash only means a slightly fuller bucket
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._conn.close()
+
+    def _name(self, kind: str) -> str:
+        return f"{self.scope}|{kind}"
+
+    def _update(self, change):
+        """Run change(levels, now) in one write transaction over both buckets.
+
+        levels maps kind -> [level, per_minute] refilled up to now; change
+        edits it in place and returns a value, or None to write nothing.
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                levels = {}
+                for kind in KINDS:
+                    row = self._conn.execute('SELECT level, updated, per_minute FROM buckets WHERE name = ?',
+                                             (self._name(kind),)).fetchone()
+                    per_minute = self.per_minute[kind] if self.fixed[kind] or row is None else row[2]
+                    capacity = per_minute / 60.0 * BURST_SECONDS
+                    if row is None:
+                        level = capacity
+                    else:
+                        level = min(capacity, row[0] + max(0.0, now - row[1]) * per_minute / 60.0)
+                    levels[kind] = [level, per_minute]
+                result = change(levels, now)
+                if result is None:
+                    self._conn.execute('ROLLBACK')
+                    return None
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO buckets (name, level, updated, per_minute) VALUES (?, ?, ?, ?)',
+                    [(self._name(kind), level, now, per_minute) for kind, (level, per_minute) in levels.items()])
+                self._conn.execute('COMMIT')
+                return result
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def reserve(self, tokens: float, max_wait: Optional[float] = None) -> Optional[float]:
+        """Take one request and `tokens` tokens; returns the seconds to wait before sending.
+
+        Returns None, and takes nothing, if the wait would exceed max_wait.
+        """
+        costs = {'requests': 1.0, 'tokens': float(tokens)}
+
+        def take(levels, now):
+            wait = 0.0
+            for kind, cost in costs.items():
+                level, per_minute = levels[kind]
+                if per_minute <= 0:
+                    continue  # unlimited
+                if level - cost < 0:
+                    wait = max(wait, (cost - level) / (per_minute / 60.0))
+            if max_wait is not None and wait > max_wait:
+                return None
+            for kind, cost in costs.items():
+                if levels[kind][1] > 0:
+                    levels[kind][0] -= cost
+            return wait
+
+        return self._update(take)
+
+    def _in_background(self, change):
+        """Queue an _update on the worker thread without waiting for it."""
+        def run():
+            try:
+                self._update(change)
+            except Exception as e:
+                logging.error(f"Error updating shared rate limits for {self.scope}: {str(e)}")
+
+        self._executor.submit(run)
+
+    async def acquire(self, tokens: float, max_wait: Optional[float] = None) -> bool:
+        """Wait for budget for one request of about `tokens` tokens; False if not within max_wait."""
+        wait = await asyncio.get_running_loop().run_in_executor(self._executor, self.reserve, tokens, max_wait)
+        if wait is None:
+            return False
+        if wait > 0:
+            self.waited += wait
+            await asyncio.sleep(wait)
+        return True
+
+    def settle(self, token_delta: float):
+        """Correct the token bucket once a response reports how many tokens it really used."""
+        if token_delta:
+            def adjust(levels, now):
+                levels['tokens'][0] -= token_delta
+                return True
+
+            self._in_background(adjust)
+
+    def on_rate_limited(self, retry_after: float):
+        """A 429 got through anyway: empty the request bucket so every process waits retry_after."""
+        def drain(levels, now):
+            level, per_minute = levels['requests']
+            levels['requests'][0] = min(level, -retry_after * per_minute / 60.0)
+            return True
+
+        self._in_background(drain)
+
+    def apply_headers(self, headers: Mapping[str, str]):
+        """Adopt the account's real limits from x-ratelimit-limit-* unless they were fixed."""
+        learned: Dict[str, float] = {}
+        for kind in KINDS:
+            value = headers.get(f'x-ratelimit-limit-{kind}')
+            if self.fixed[kind] or value is None:
+                continue
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+            if value > 0 and value != self.per_minute[kind]:
+                learned[kind] = value
+        if not learned:
+            return
+
+        def store(levels, now):
+            for kind, value in learned.items():
+                levels[kind][1] = value
+            return True
+
+        self.per_minute.update(learned)
+        self._in_background(store)
+        logging.info(f"Shared rate limits for {self.scope}: "
+                     f"{self.per_minute['requests']:g} RPM, {self.per_minute['tokens']:g} TPM")
+
+
+def _env_limit(name: str) -> Optional[float]:
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+
+_limiters: Dict[str, SharedRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_shared_rate_limiter(scope: str) -> Optional[SharedRateLimiter]:
+    """Process-wide limiter for scope (API base + model); None if DIETGPT_RATE_LIMIT=0.
+
+    DIETGPT_RPM / DIETGPT_TPM fix the limits (0 means unlimited) and
+    DIETGPT_RATE_LIMIT_DB moves the shared file.
+    """
+    if os.environ.get('DIETGPT_RATE_LIMIT', '1') == '0':
+        return None
+    with _limiters_lock:
+        limiter = _limiters.get(scope)
+        if limiter is None:
+            limiter = _limiters[scope] = SharedRateLimiter(
+                scope, rpm=_env_limit('DIETGPT_RPM'), tpm=_env_limit('DIETGPT_TPM'),
+                path=os.environ.get('DIETGPT_RATE_LIMIT_DB', DEFAULT_DB_PATH))
+        return limiter
@@ -0,0 +1,209 @@
+import atexit
+import glob
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from checkpoint import ResultJournal
+
+try:
+    import fcntl
+except ImportError:  # Windows: spools of other processes are never adopted
+    fcntl = None
+
+DEFAULT_SPOOL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'sheets_spool.jsonl')
+
+
+class WriteBehindQueue:
+    """Durable write-behind queue for rows bound for a spreadsheet.
+
+    put() appends the row to an fsynced JSONL spool and returns at once; a
+    background thread sends pending rows in batches of up to `batch_size`
+    through send_rows(rows), which raises on failure. Failed batches stay
+    queued and are retried with exponential backoff, and rows still in the
+    spool when the process dies are sent after the next start. Delivery is
+    at-least-once: a batch whose response was lost is sent again.
+
+    Every queue writes its own spool next to spool_path
+    (sheets_spool.<id>.jsonl) and holds an exclusive lock on it while it
+    runs, so processes sharing a directory never truncate or resend each
+    other's rows. A new queue adopts the spools whose owner has exited.
+    """
+
+    def __init__(self, send_rows: Callable[[List[Dict[str, Any]]], None],
+                 spool_path: str = DEFAULT_SPOOL_PATH, batch_size: int = 50,
+                 flush_interval: float = 2.0, max_backoff: float = 60.0,
+                 on_flushed: Optional[Callable[[List[str]], None]] = None):
+        self.send_rows = send_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.on_flushed = on_flushed
+        root, ext = os.path.splitext(spool_path)
+        self.spool_path = spool_path
+        self.spool = ResultJournal(f"{root}.{uuid.uuid4().hex}{ext}")
+        self.spool.open()
+        self._lock_file = open(self.spool.path, 'rb')
+        _try_lock(self._lock_file)
+        self._pending: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self._changed = threading.Condition()
+        self._closed = False
+        self._flush_requested = False
+        self._failures = 0
+        self._retry_at = 0.0
+        self._replay()
+        self._thread = threading.Thread(target=self._run, name='sheets-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _replay(self):
+        """Take over the unacknowledged rows of every spool whose owner is gone."""
+        root, ext = os.path.splitext(self.spool_path)
+        # The bare spool_path is where spools lived before they were per queue
+        for path in [self.spool_path] + sorted(glob.glob(f"{glob.escape(root)}.*{ext}")):
+            if path != self.spool.path:
+                self._adopt(path)
+        if self._pending:
+            logging.info(f"Resending {len(self._pending)} spooled rows from {os.path.dirname(self.spool.path) or '.'}")
+
+    def _adopt(self, path: str):
+        try:
+            lock_file = open(path, 'rb')
+        except OSError:
+            return
+        with lock_file:
+            # Locked: the owning queue is still running. Unlinked: another
+            # queue adopted it while we waited to open it
+            if not _try_lock(lock_file) or os.fstat(lock_file.fileno()).st_nlink == 0:
+                return
+            rows: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+            for record in ResultJournal(path).records():
+                if 'ack' in record:
+                    for row_id in record['ack']:
+                        rows.pop(row_id, None)
+                elif 'id' in record:
+                    rows[record['id']] = record['row']
+            # Copy into our own spool before the orphan goes away
+            for row_id, row in rows.items():
+                self.spool.append({'id': row_id, 'row': row})
+                self._pending[row_id] = row
+            os.remove(path)
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def put(self, row: Dict[str, Any], row_id: Optional[str] = None) -> str:
+        row_id = row_id or uuid.uuid4().hex
+        with self._changed:
+            self.spool.append({'id': row_id, 'row': row})
+            self._pending[row_id] = row
+            self._changed.notify_all()
+        return row_id
+
+    def _next_batch(self) -> List[str]:
+        """Wait for a full batch, the flush interval or close(); returns the row ids to send."""
+        with self._changed:
+            deadline = None
+            while not self._closed:
+                backoff = self._retry_at - time.monotonic()
+                if backoff > 0:
+                    self._changed.wait(timeout=backoff)
+                    continue
+                if len(self._pending) >= self.batch_size or (self._pending and self._flush_requested):
+                    break
+                if self._pending:
+                    deadline = deadline or time.monotonic() + self.flush_interval
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(timeout=remaining)
+                else:
+                    deadline = None
+                    self._changed.wait()
+            return list(self._pending)[:self.batch_size]
+
+    def _run(self):
+        while True:
+            row_ids = self._next_batch()
+            if not row_ids:
+                if self._closed:
+                    return
+                continue
+            if not self._flush(row_ids) and self._closed:
+                return
+
+    def _flush(self, row_ids: List[str]) -> bool:
+        rows = [self._pending[row_id] for row_id in row_ids]
+        try:
+            self.send_rows(rows)
+        except Exception as e:
+            self._failures += 1
+            delay = min(self.max_backoff, 2 ** (self._failures - 1))
+            logging.error(f"Error flushing {len(rows)} rows to Google Sheets "
+                          f"(attempt {self._failures}, retrying in {delay}s): {str(e)}")
+            self._retry_at = time.monotonic() + delay
+            return False
+        self._failures = 0
+        with self._changed:
+            self.spool.append({'ack': row_ids})
+            for row_id in row_ids:
+                self._pending.pop(row_id, None)
+            if not self._pending:
+                self._flush_requested = False
+                self._truncate_spool()
+            self._changed.notify_all()
+        if self.on_flushed:
+            self.on_flushed(row_ids)
+        return True
+
+    def _truncate_spool(self):
+        # Everything this queue wrote is acknowledged; start its spool over.
+        # The spool is ours alone, so no other process loses rows here
+        self.spool.close()
+        open(self.spool.path, 'w').close()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Block until every queued row is sent (or timeout); returns True when drained."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            # Skip the flush interval: send what we have now
+            self._flush_requested = True
+            self._changed.notify_all()
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(timeout=remaining)
+        return True
+
+    def close(self, timeout: float = 10.0):
+        """Try to drain for up to timeout seconds; whatever is left stays in the spool."""
+        if self._closed:
+            return
+        self.flush(timeout)
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+        self._thread.join(timeout=1.0)
+        self.spool.close()
+        with self._changed:
+            if not self._pending:
+                os.remove(self.spool.path)
+        # Anything still pending is adopted by the next queue to start
+        self._lock_file.close()
+
+
+def _try_lock(lock_file) -> bool:
+    """Take an exclusive, non-blocking lock on lock_file; False if another process holds it."""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
@@ -1,40 +1,128 @@
 import requests
 import json
+import logging
+import os
+import threading
+import time
+import uuid
 from datetime import datetime
 import re
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+from results_mirror import DEFAULT_DB_PATH, ResultsMirror
+from sheet_writer import DEFAULT_SPOOL_PATH, WriteBehindQueue
+
 SCRIPT_URL = "https://script.google.com/macros/s/AKfycbzTYZsWua8jcshxso13O8CoIhgevSkPKmyDrWLqTvo3NwAUIDJFyuNuhFbZXbuas8YD/exec"
 
+# (connect, read) seconds; Apps Script is slow to answer but quick to accept
+DEFAULT_TIMEOUT = (5, 30)
+USERS_CACHE_TTL = float(os.environ.get('DIETGPT_USERS_CACHE_TTL', 60))
+
+
+class ScriptRejectedError(RuntimeError):
+    """The script answered but refused the payload: an error object or an HTML error page."""
+
+
+def create_session(pool_size: int = 10, retry_reads: bool = True) -> requests.Session:
+    """Keep-alive session with a connection pool and, if retry_reads, retries for GETs.
+
+    Only reads may go through a retrying session: the script also takes
+    writes as GETs (action=write), and retrying one after a 5xx that came
+    back once the row was written would add it twice.
+    """
+    session = requests.Session()
+    if retry_reads:
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET']))
+    else:
+        retry = Retry(total=0, read=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 class SheetsManager:
-    def __init__(self):
-        pass
+    """Thin client for the Apps Script endpoint behind the Users/Results sheets.
+
+    All calls share one pooled session, so page loads reuse the TLS
+    connection, and get_users() is served from memory for `users_ttl`
+    seconds; add_user() invalidates it. Results are written behind through a
+    durable spool and appended in batches. User history is read from a local,
+    incrementally synced ResultsMirror instead of the whole Results sheet;
+    it syncs in the background and lists queued rows as soon as they are stored.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, users_ttl: float = USERS_CACHE_TTL):
+        self.timeout = timeout
+        self.users_ttl = users_ttl
+        self.session = create_session()
+        self.write_session = create_session(pool_size=2, retry_reads=False)
+        self._users = None
+        self._users_fetched_at = 0.0
+        self._users_lock = threading.Lock()
+        self.results = ResultsMirror(self.fetch_results,
+                                     path=os.environ.get('DIETGPT_RESULTS_DB', DEFAULT_DB_PATH),
+                                     sync_interval=float(os.environ.get('DIETGPT_RESULTS_SYNC_INTERVAL', 30)))
+        self._bulk_append = True
+        self.writer = WriteBehindQueue(self.append_results,
+                                       spool_path=os.environ.get('DIETGPT_SHEETS_SPOOL', DEFAULT_SPOOL_PATH),
+                                       on_flushed=self.results.mark_sent)
+
+    def _call(self, operation, method, write=False, **kwargs):
+        """One Apps Script request, timed as the sheets_<operation> stage.
+
+        Writes (write=True) use a session that never retries on its own.
+        """
+        session = self.write_session if write else self.session
+        try:
+            with metrics.span(f'sheets_{operation}'):
+                response = session.request(method, SCRIPT_URL, timeout=self.timeout, **kwargs)
+        except Exception:
+            metrics.SHEETS_CALLS.inc(operation=operation, outcome='error')
+            raise
+        metrics.SHEETS_CALLS.inc(operation=operation, outcome='ok' if response.ok else 'error')
+        return response
+
+    def invalidate_users(self):
+        with self._users_lock:
+            self._users = None
 
     def get_users(self):
         """Get list of all users from the spreadsheet"""
-        try:
-            response = requests.get(SCRIPT_URL, params={
-                'path': 'Users',
-                'action': 'read'
-            })
-            data = response.json()
-            if 'data' in data:
-                return [user['Users'] for user in data['data'] if user['Users']]
-            return []
-        except Exception as e:
-            print(f"Error getting users: {str(e)}")
-            return []
+        with self._users_lock:
+            if self._users is not None and time.monotonic() - self._users_fetched_at < self.users_ttl:
+                return list(self._users)
+            try:
+                response = self._call('get_users', 'GET', params={
+                    'path': 'Users',
+                    'action': 'read'
+                })
+                data = response.json()
+                users = [user['Users'] for user in data['data'] if user['Users']] if 'data' in data else []
+            except Exception as e:
+                logging.error(f"Error getting users: {str(e)}")
+                # A stale list beats an empty dropdown; errors are never cached
+                return list(self._users) if self._users is not None else []
+            self._users = users
+            self._users_fetched_at = time.monotonic()
+            return list(users)
 
     def add_user(self, username):
         """Add a new user to the spreadsheet"""
         try:
-            response = requests.get(SCRIPT_URL, params={
+            response = self._call('add_user', 'GET', write=True, params={
                 'path': 'Users',
                 'action': 'write',
                 'Users': username
             })
+            self.invalidate_users()
             return response.text
         except Exception as e:
-            print(f"Error adding user: {str(e)}")
+            logging.error(f"Error adding user: {str(e)}")
             return "Error adding user"
 
     def store_analysis_result(self, username, result):
@@ -47,8 +135,7 @@ class SheetsManager:
             # Get the original filename from the result
             original_filename = result.get('original_filename', '')
 
-            # Debugging print for original_filename
-            print(f"DEBUG: Original filename received: {original_filename}")
+            logging.debug("Original filename received: %s", original_filename)
 
             # Ensure all required fields are present
             llm_estimate = result.get('llm_estimate', {})
@@ -65,53 +152,77 @@ class SheetsManager:
                 'Image_URL': original_filename # Use the original filename here
             }
             
-            payload = {
-                'path': 'Results',
-                'rowData': row_data
-            }
-            
-            print("Sending to Google Sheets:", json.dumps(payload, indent=2))
-            response = requests.post(SCRIPT_URL, json=payload)
-            
-            if response.status_code != 200:
-                print(f"Error response from Google Sheets: {response.text}")
-                return f"Error: {response.text}"
-                
-            response_data = response.json()
-            if 'error' in response_data:
-                print(f"Error from Google Sheets: {response_data['error']}")
-                return f"Error: {response_data['error']}"
-                
-            return response.text
+            # Listed in the user's history right away, before the sheet has it
+            row_id = uuid.uuid4().hex
+            self.results.add_pending(row_id, row_data)
+            self.writer.put(row_data, row_id)
+            return json.dumps({'status': 'queued', 'id': row_id})
         except Exception as e:
-            print(f"Error storing result: {str(e)}")
+            logging.error(f"Error storing result: {str(e)}")
             return f"Error storing result: {str(e)}"
 
-    def get_user_results(self, username):
-        """Get all analysis results for a specific user"""
+    def _post_results(self, payload):
+        """POST to the Results sheet; ScriptRejectedError if the script refuses the payload.
+
+        Non-200 statuses raise RuntimeError and network failures the
+        requests exception, both worth retrying as they are.
+        """
+        response = self._call('append_results', 'POST', write=True, json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
         try:
-            response = requests.get(SCRIPT_URL, params={
-                'path': 'Results',
-                'action': 'read'
-            })
-            data = response.json()
-            if 'data' in data:
-                # Filter results for the specific user
-                user_results = [
-                    {
-                        'timestamp': row['Timestamp'],
-                        'llm_calories': row['LLM_Calories'],
-                        'db_calories': row['DB_Calories'],
-                        'fiber': row['Fiber'],  # New field
-                        'food_items': json.loads(row['Food_Items']),
-                        'plant_items': json.loads(row['Plant_Items']),  # New field
-                        'image_url': row['Image_URL']
-                    }
-                    for row in data['data']
-                    if row['Username'] == username
-                ]
-                return user_results
-            return []
+            response_data = response.json()
+        except ValueError:
+            # Apps Script reports an exception in the script as a 200 HTML page
+            raise ScriptRejectedError(f"Non-JSON response: {response.text[:200]}")
+        if 'error' in response_data:
+            raise ScriptRejectedError(response_data['error'])
+        return response_data
+
+    def append_results(self, rows):
+        """Append rows to the Results sheet, in one request when the script takes a 'rows' list.
+
+        Raises on failure so the write-behind queue keeps the rows and retries.
+        """
+        if self._bulk_append and len(rows) > 1:
+            try:
+                self._post_results({'path': 'Results', 'rows': rows})
+                return
+            except ScriptRejectedError as e:
+                bulk_error = e
+            # Transient failures propagated above and keep bulk mode. The script
+            # refused 'rows': if a single row goes through, it only knows
+            # rowData, so append one by one from now on
+            self._post_results({'path': 'Results', 'rowData': rows[0]})
+            logging.warning(f"Bulk append rejected, falling back to single rows: {str(bulk_error)}")
+            self._bulk_append = False
+            rows = rows[1:]
+        for row_data in rows:
+            self._post_results({'path': 'Results', 'rowData': row_data})
+
+    def fetch_results(self, offset=0):
+        """Rows of the Results sheet from `offset` on, as (rows, offset of the first row).
+
+        The offset is passed to the script; a script that ignores it returns
+        the whole sheet (without echoing an offset), which the mirror handles.
+        """
+        response = self._call('fetch_results', 'GET', params={
+            'path': 'Results',
+            'action': 'read',
+            'offset': offset
+        })
+        data = response.json()
+        if 'error' in data:
+            raise RuntimeError(data['error'])
+        return data.get('data', []), int(data.get('offset', 0))
+
+    def get_user_results(self, username, limit=None, offset=0):
+        """Get a user's analysis results, in sheet order, from the local mirror"""
+        try:
+            return self.results.user_results(username, limit=limit, offset=offset)
         except Exception as e:
-            print(f"Error getting user results: {str(e)}")
-            return [] 
+            logging.error(f"Error getting user results: {str(e)}")
+            return []
+
+    def count_user_results(self, username):
+        return self.results.count(username)
@@ -1,13 +1,15 @@
 # streamlit_app.py  (новий головний файл)
 
+import hashlib
+
 import streamlit as st
-import asyncio
-from dietgpt_start import CalorieEstimator, extract_nutrition
-from nutrition_matcher import enhance_nutrition_estimate
+from estimator_service import EstimatorService
+from response_parser import parse_response
+from nutrition_matcher import enhance_nutrition_estimate_async
 from sheets_manager import SheetsManager
-import os
-import re
-import tempfile
+
+# скільки останніх аналізів тримаємо в session_state
+MAX_CACHED_ANALYSES = 10
 
 
 # --- ініціалізація -----------------------------------------------------------
@@ -15,78 +17,88 @@ api_key = st.secrets["OPENAI_API_KEY"]
 if not api_key:
     st.stop()  # покаже повідомлення «API key not found»
 
-sheets = SheetsManager()
+@st.cache_resource
+def get_sheets():
+    # один клієнт на процес: пул з'єднань і кеш користувачів переживають rerun
+    return SheetsManager()
+
+@st.cache_resource
+def get_estimator_service():
+    # один estimator з keep-alive сесією на фоновому event loop для всіх rerun-ів
+    return EstimatorService(api_key=api_key)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_users():
+    return get_sheets().get_users()
+
+sheets = get_sheets()
 
 # --- функції -----------------------------------------------------------------
-def extract_food_items(response: str):
-    food_section = re.search(r"Food Items:\s*((?:- [^\n]+\n?)+)", response)
-    if not food_section:
-        return []
-    return re.findall(r"- ([^\n]+)", food_section.group(1))
-
-async def analyze(path):
-    async with CalorieEstimator(api_key=api_key) as est:
-        res = await est.estimate_calories(path)
-        if not res["success"]:
-            return res
-        
-        nutri = extract_nutrition(res["response"])
-        food  = extract_food_items(res["response"])
-        enhanced = enhance_nutrition_estimate(nutri, food)
-        details = res["response"]
-
-        # Extract plant_items and calculate unique plant count here
-        plant_items = []
-        raw_plant_section_text = "No plant section found."
-        
-        # Updated regex to be more robust in capturing the entire block
-        plant_section = re.search(r'Plant-based Ingredients:\s*(.*?)(?=\n\n|\Z)', details, re.DOTALL)
-        
-        if plant_section:
-            raw_plant_section_text = plant_section.group(1).strip()
-            
-            # Split by lines, filter lines starting with '-', remove '-' and strip whitespace
-            processed_items = []
-            for line in raw_plant_section_text.split('\n'):
-                stripped_line = line.strip()
-                if stripped_line.startswith('-'):
-                    item = stripped_line[1:].strip()
-                    if item:
-                        processed_items.append(item)
-            plant_items = processed_items
-
-        num_unique_plants = len(set(plant_items))
-
-        return {
-            "success": True,
-            "llm_estimate": enhanced["llm_estimate"],
-            "db_estimate": enhanced["db_estimate"],
-            "food_items": food,
-            "food_matches": enhanced["food_matches"],
-            "unmatched_items": enhanced["unmatched_items"],
-            "confidence_score": enhanced["confidence_score"],
-            "details": details,
-            "image_url": f"/uploads/{os.path.basename(path)}",
-            "plant_items": plant_items, # Include plant_items in the result
-            "Number_of_unique_plants_this_meal": num_unique_plants, # Include unique count
-            "raw_plant_section_text": raw_plant_section_text # Include raw text for debugging
-        }
+async def analyze(image_data: bytes, filename: str):
+    est = get_estimator_service().estimator
+    # файл не пишемо на диск: декодуємо прямо з пам'яті
+    res = await est.estimate_image(image_data, filename)
+    if not res["success"]:
+        return res
+
+    details = res["response"]
+    # один прохід по відповіді: підсумки, страви з порціями та рослини
+    parsed = parse_response(details)
+    nutri = parsed.nutrition()
+    food  = parsed.food_item_texts()
+    enhanced = await enhance_nutrition_estimate_async(nutri, food)
+
+    plant_items = parsed.plant_items
+    raw_plant_section_text = "\n".join(f"- {p}" for p in plant_items) or "No plant section found."
+
+    num_unique_plants = len(set(plant_items))
+
+    return {
+        "success": True,
+        "llm_estimate": enhanced["llm_estimate"],
+        "db_estimate": enhanced["db_estimate"],
+        "food_items": food,
+        "food_matches": enhanced["food_matches"],
+        "unmatched_items": enhanced["unmatched_items"],
+        "confidence_score": enhanced["confidence_score"],
+        "details": details,
+        "image_url": filename,
+        "plant_items": plant_items, # Include plant_items in the result
+        "Number_of_unique_plants_this_meal": num_unique_plants, # Include unique count
+        "raw_plant_section_text": raw_plant_section_text # Include raw text for debugging
+    }
+
+def get_analysis(image_data: bytes, filename: str):
+    """Один виклик LLM на завантаження: результат живе в session_state під digest файлу."""
+    digest = hashlib.sha256(image_data).hexdigest()
+    analyses = st.session_state.setdefault("analyses", {})
+    if digest not in analyses:
+        with st.status("Analyzing your food image...", expanded=True):
+            result = get_estimator_service().run(analyze(image_data, filename))
+        if not result["success"]:
+            # помилку не кешуємо, щоб наступний rerun спробував ще раз
+            return digest, result
+        analyses[digest] = result
+        while len(analyses) > MAX_CACHED_ANALYSES:
+            analyses.pop(next(iter(analyses)))
+    return digest, analyses[digest]
 
 # --- Streamlit UI ------------------------------------------------------------
 st.title("Elyside Food AI 🍽️")
 
-user = st.selectbox("Select User", ["-- new --"] + sheets.get_users(), key="user_select")
+user = st.selectbox("Select User", ["-- new --"] + get_users(), key="user_select")
 new_user_input = None
 
 if user == "-- new --":
     new_user_input = st.text_input("New username", key="new_username_input")
     if st.button("Add User", key="add_user_button") and new_user_input:
         # Check if user already exists (optional, but good practice)
-        if new_user_input in sheets.get_users():
+        if new_user_input in get_users():
             st.warning("User already exists.")
         else:
             try:
                 sheets.add_user(new_user_input)
+                get_users.clear()
                 st.success(f"User '{new_user_input}' added. Please select them from the dropdown.")
                 # Rerun to update the selectbox with the new user
                 st.experimental_rerun()
@@ -98,20 +110,15 @@ uploaded = st.file_uploader("Upload Food Image", type=["jpg", "jpeg", "png", "we
 
 # Only proceed if a user is selected (either existing or newly added and confirmed)
 if uploaded and user and user != "-- new --":
-    # тимчасово зберігаємо файл
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-        tmp.write(uploaded.read())
-        tmp_path = tmp.name
-
-    with st.status("Analyzing your food image...", expanded=True):
-        result = asyncio.run(analyze(tmp_path))
+    image_data = uploaded.getvalue()
+    digest, result = get_analysis(image_data, uploaded.name)
 
     if result["success"]:
         st.success("Done!")
-        
+
         # Display the uploaded image
-        st.image(tmp_path, caption=uploaded.name, use_container_width=True)
-        
+        st.image(image_data, caption=uploaded.name, use_container_width=True)
+
         st.subheader("Analysis Results")
         llm_estimate = result["llm_estimate"]
         st.write(f"Calories: **{llm_estimate.get('calories', 'N/A')}** kcal")
@@ -119,7 +126,7 @@ if uploaded and user and user != "-- new --":
         st.write(f"Carbs: **{llm_estimate.get('carbohydrates', 'N/A')}** g")
         st.write(f"Fat: **{llm_estimate.get('fat', 'N/A')}** g")
         st.write(f"Fiber: **{llm_estimate.get('fiber', 'N/A')}** g")
-        
+
         # Display the raw LLM response details for debugging
         with st.expander("Raw LLM Response Details (for debugging)"):
             st.text_area("Full LLM Response", result.get('details', 'No details available.'), height=300)
@@ -129,21 +136,25 @@ if uploaded and user and user != "-- new --":
         # Display number of unique plants
         num_unique_plants = result.get("Number_of_unique_plants_this_meal", "N/A")
         st.write(f"Number of unique plants in this meal: **{num_unique_plants}**")
-        
+
         # Display plant-based ingredients list
         plant_items = result.get("plant_items", [])
         if plant_items:
             st.subheader("Plant-based Ingredients")
             for item in plant_items:
                 st.write(f"- {item}")
-        
-        if st.button("Submit to Google Sheets"):
+
+        submitted = st.session_state.setdefault("submitted", set())
+        submit_key = (user, digest)
+        if submit_key in submitted:
+            st.info("Already submitted to Google Sheets.")
+        elif st.button("Submit to Google Sheets"):
             try:
                 # Pass the original filename to store_analysis_result
-                result['original_filename'] = uploaded.name
-                sheets.store_analysis_result(user, result)
+                sheets.store_analysis_result(user, dict(result, original_filename=uploaded.name))
+                submitted.add(submit_key)
                 st.toast("Data submitted successfully ", icon="✅")
             except Exception as e:
                 st.error(f"Error submitting data: {str(e)}")
     else:
-        st.error(result.get("error", "Unknown error"))
+        st.error(result.get("error") or result.get("response", "Unknown error"))
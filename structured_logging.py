@@ -0,0 +1,181 @@
+"""Off-thread logging: a QueueHandler on the root logger, a listener thread doing the I/O.
+
+Callers (including code running on the event loop) only enqueue records.
+The listener writes them as JSON lines to a size-rotated file and, in the
+old plain-text format, to the terminal. Per-request payloads (LLM answers,
+results sent to the frontend) go through log_payload(), which samples them
+so they cannot flood either output.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+DEFAULT_LOG_FILE = 'diet_gpt.log'
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+# Fraction of per-request payloads written; failures are always written
+DEFAULT_SAMPLE_RATE = 0.01
+# Longest string kept from a payload field
+MAX_PAYLOAD_CHARS = 4000
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.handlers.QueueHandler] = None
+_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, logger, msg, exc and any extra= fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key not in entry:
+                entry[key] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Enqueue a copy with the message merged and the traceback already rendered.
+
+    Unlike the stock prepare(), the traceback is kept in exc_text rather
+    than folded into msg, so the JSON file gets it as its own field.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = logging.Formatter().formatException(record.exc_info)
+        record = logging.makeLogRecord(vars(record))
+        record.msg = message
+        record.message = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        record.stack_info = None
+        return record
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def configure_logging(log_file: Optional[str] = None, level: Optional[str] = None,
+                      max_bytes: Optional[int] = None, backups: Optional[int] = None,
+                      console: bool = True):
+    """Route the root logger through a queue to a rotating JSON file and the terminal.
+
+    Safe to call more than once; only the first call configures anything.
+    DIETGPT_LOG_FILE, DIETGPT_LOG_LEVEL, DIETGPT_LOG_MAX_BYTES and
+    DIETGPT_LOG_BACKUPS override the defaults (an empty DIETGPT_LOG_FILE
+    logs to the terminal only).
+    """
+    global _listener, _queue_handler
+    with _lock:
+        if _listener is not None:
+            return
+        if log_file is None:
+            log_file = os.environ.get('DIETGPT_LOG_FILE', DEFAULT_LOG_FILE)
+        level = level or os.environ.get('DIETGPT_LOG_LEVEL', 'INFO')
+        handlers: List[logging.Handler] = []
+        if log_file:
+            file_handler = logging.handlers.RotatingFileHandler(
+                log_file, encoding='utf-8',
+                maxBytes=max_bytes if max_bytes is not None else _env_int('DIETGPT_LOG_MAX_BYTES', DEFAULT_MAX_BYTES),
+                backupCount=backups if backups is not None else _env_int('DIETGPT_LOG_BACKUPS', DEFAULT_BACKUPS))
+            file_handler.setFormatter(JsonFormatter())
+            handlers.append(file_handler)
+        if console:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+            handlers.append(stream_handler)
+
+        _queue_handler = _QueueHandler(queue.SimpleQueue())
+        root = logging.getLogger()
+        root.setLevel(level.upper())
+        root.addHandler(_queue_handler)
+        _listener = logging.handlers.QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write out everything still queued and stop the listener thread."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+            _listener = None
+
+
+def _after_fork_in_child():
+    # The listener thread does not survive fork: a child (e.g. a preprocessing
+    # worker) writes through the handlers directly instead of a dead queue
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    root = logging.getLogger()
+    root.removeHandler(_queue_handler)
+    for handler in _listener.handlers:
+        root.addHandler(handler)
+    _listener = None
+    _queue_handler = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def get_sample_rate() -> float:
+    return float(os.environ.get('DIETGPT_LOG_SAMPLE_RATE', DEFAULT_SAMPLE_RATE))
+
+
+def _clip(value: Any) -> Any:
+    if isinstance(value, str) and len(value) > MAX_PAYLOAD_CHARS:
+        return value[:MAX_PAYLOAD_CHARS] + f"... [{len(value) - MAX_PAYLOAD_CHARS} more chars]"
+    if isinstance(value, dict):
+        return {key: _clip(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_clip(item) for item in value]
+    return value
+
+
+def log_payload(event: str, payload: Any, always: bool = False, logger: str = 'dietgpt.payload', **fields):
+    """Log a per-request payload for a sample of requests.
+
+    Written for a DIETGPT_LOG_SAMPLE_RATE fraction of calls (default 1%),
+    every call when the payload logger is at DEBUG, and whenever always is
+    set (e.g. for failures). The payload and fields travel as structured
+    fields of the JSON record; the terminal only shows the event name.
+    """
+    payload_logger = logging.getLogger(logger)
+    if not payload_logger.isEnabledFor(logging.INFO):
+        return
+    if not (always or payload_logger.isEnabledFor(logging.DEBUG) or random.random() < get_sample_rate()):
+        return
+    payload_logger.info(event, extra={'event': event, 'payload': _clip(payload), **fields})
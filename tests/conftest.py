@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The modules live flat at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep test runs off the shared log file, rate-limit database and process pool
+os.environ.setdefault('DIETGPT_LOG_FILE', '')
+os.environ.setdefault('DIETGPT_RATE_LIMIT', '0')
+os.environ.setdefault('DIETGPT_PREPROCESS_WORKERS', '0')
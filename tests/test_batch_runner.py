@@ -0,0 +1,101 @@
+import asyncio
+import json
+import os
+
+import numpy as np
+import pytest
+from aiohttp import web
+from PIL import Image
+
+import mock_openai_server
+from batch_runner import BatchRunner
+from checkpoint import ResultJournal
+from dietgpt_start import CalorieEstimator, build_result_record
+from near_duplicates import NearDuplicateIndex
+from result_cache import ResultCache
+
+
+class ExpiringMock(mock_openai_server.MockOpenAI):
+    """Lets the first batch expire with its last `drop` requests unanswered."""
+
+    def __init__(self, drop: int):
+        super().__init__(batch_delay=0.05)
+        self.drop = drop
+        self.submitted = []
+
+    async def _run_batch(self, batch):
+        lines = bytes(self.files[batch['input_file_id']]).decode('utf-8').splitlines()
+        # Preprocessing finishes in any order, so compare sorted ids
+        self.submitted.append(sorted(json.loads(line)['custom_id'] for line in lines))
+        expire = len(self.submitted) == 1 and self.drop
+        if expire:
+            self.files[batch['input_file_id']] = '\n'.join(lines[:-self.drop]).encode('utf-8')
+        await super()._run_batch(batch)
+        if expire:
+            batch['status'] = 'expired'
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    """Four distinct meals and a shrunken copy of the first one."""
+    rng = np.random.default_rng(0)
+    rows = []
+    for i in range(4):
+        path = tmp_path / f'meal{i}.jpg'
+        Image.fromarray(rng.integers(0, 255, (64, 64, 3), dtype=np.uint8)).resize((256, 256)).save(path)
+        rows.append((str(path), path.name, {'calories': 500.0 + i}))
+    copy = tmp_path / 'meal0_small.jpg'
+    Image.open(tmp_path / 'meal0.jpg').resize((200, 200)).save(copy)
+    rows.append((str(copy), copy.name, {'calories': 500.0}))
+    return rows
+
+
+def run_batches(tmp_path, mock, rows, work_dir='batch'):
+    async def main():
+        server = web.AppRunner(mock_openai_server.create_app(mock))
+        await server.setup()
+        await web.TCPSite(server, '127.0.0.1', 0).start()
+        port = server.addresses[0][1]
+        try:
+            async with CalorieEstimator(api_key='sk-test', api_base=f'http://127.0.0.1:{port}/v1',
+                                        cache=ResultCache(str(tmp_path / 'cache')),
+                                        near_duplicates=NearDuplicateIndex(max_distance=5)) as estimator:
+                runner = BatchRunner(estimator, str(tmp_path / work_dir), poll_interval=0.05)
+                with ResultJournal(str(tmp_path / f'{work_dir}.jsonl'), fsync=False) as journal:
+                    await runner.run(iter(rows), journal, build_result_record)
+        finally:
+            await server.cleanup()
+        return list(ResultJournal(str(tmp_path / f'{work_dir}.jsonl')).records())
+
+    return asyncio.run(main())
+
+
+def test_near_duplicates_wait_for_their_original(tmp_path, dataset):
+    mock = ExpiringMock(drop=0)
+    records = run_batches(tmp_path, mock, dataset)
+    assert mock.submitted == [['meal0.jpg', 'meal1.jpg', 'meal2.jpg', 'meal3.jpg']]
+    assert all(r['success'] for r in records)
+    follower = next(r for r in records if r['img_path'] == 'meal0_small.jpg')
+    assert follower['near_duplicate_of'] == 'meal0.jpg'
+    assert follower['actual_calories'] == 500.0
+
+
+def test_unanswered_requests_are_resubmitted(tmp_path, dataset):
+    mock = ExpiringMock(drop=2)
+    records = run_batches(tmp_path, mock, dataset)
+    assert len(mock.submitted) == 2
+    unanswered = {r['img_path'] for r in records if not r['success']}
+    # The near-duplicate copy fails and succeeds along with meal0
+    assert sorted(unanswered - {'meal0_small.jpg'}) == mock.submitted[1]
+    assert len(mock.submitted[1]) == 2
+    assert {r['img_path'] for r in records if r['success']} == {row[1] for row in dataset}
+
+
+def test_cached_results_skip_the_batch(tmp_path, dataset):
+    originals = dataset[:4]
+    run_batches(tmp_path, ExpiringMock(drop=0), originals)
+    mock = ExpiringMock(drop=0)
+    records = run_batches(tmp_path, mock, originals, work_dir='again')
+    assert mock.submitted == []
+    assert len(records) == len(originals) and all(r['success'] for r in records)
+    assert not os.path.exists(tmp_path / 'again' / 'batch_input_0_000.jsonl')
@@ -0,0 +1,46 @@
+import csv
+
+from checkpoint import RESULT_FIELDS, ResultJournal, latest_journal
+
+
+def test_append_and_completed(tmp_path):
+    path = str(tmp_path / 'estimation_openai_1.jsonl')
+    with ResultJournal(path, fsync=False) as journal:
+        journal.append({'img_path': 'a.jpg', 'success': True, 'estimated_calories': 500})
+        journal.append({'img_path': 'b.jpg', 'success': False})
+    assert [r['img_path'] for r in ResultJournal(path).records()] == ['a.jpg', 'b.jpg']
+    assert ResultJournal(path).completed() == {'a.jpg'}
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    path = tmp_path / 'estimation_openai_1.jsonl'
+    path.write_text('{"img_path": "a.jpg", "success": true}\n{"img_path": "b.j', encoding='utf-8')
+    assert ResultJournal(str(path)).completed() == {'a.jpg'}
+
+
+def test_missing_journal_is_empty(tmp_path):
+    assert ResultJournal(str(tmp_path / 'none.jsonl')).completed() == set()
+
+
+def test_compact_keeps_first_success_per_image(tmp_path):
+    journal = ResultJournal(str(tmp_path / 'estimation_openai_1.jsonl'), fsync=False)
+    journal.append({'img_path': 'a.jpg', 'success': False})
+    journal.append({'img_path': 'a.jpg', 'success': True, 'estimated_calories': 500, 'actual_carbs': 40})
+    journal.append({'img_path': 'b.jpg', 'success': True, 'estimated_calories': 300, 'extra': 'dropped'})
+    journal.append({'img_path': 'a.jpg', 'success': True, 'estimated_calories': 999})
+    journal.close()
+    csv_path = str(tmp_path / 'run.csv')
+    assert journal.compact(csv_path) == 2
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        rows = list(reader)
+    assert reader.fieldnames == RESULT_FIELDS
+    assert [(r['img_path'], r['estimated_calories'], r['actual_carbs']) for r in rows] == [
+        ('a.jpg', '500', '40'), ('b.jpg', '300', '')]
+
+
+def test_latest_journal(tmp_path):
+    assert latest_journal(str(tmp_path)) is None
+    for stamp in ('20240101_120000', '20240301_080000', '20240201_235959'):
+        (tmp_path / f'estimation_openai_{stamp}.jsonl').write_text('', encoding='utf-8')
+    assert latest_journal(str(tmp_path)).endswith('estimation_openai_20240301_080000.jsonl')
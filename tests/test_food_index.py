@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from food_index import NUTRIENT_COLUMNS, FoodDatabase, compile_database, normalize_name
+
+NAMES = ['Chicken breast, grilled', 'Brown rice, cooked', 'White rice, cooked', 'Olive oil',
+         'Crème brûlée', 'Apple, raw']
+
+
+@pytest.fixture
+def db():
+    nutrients = np.arange(len(NAMES) * len(NUTRIENT_COLUMNS), dtype=np.float32).reshape(len(NAMES), -1)
+    return FoodDatabase.from_names(NAMES, nutrients)
+
+
+def test_normalize_name():
+    assert normalize_name('  Crème   Brûlée! ') == 'creme brulee'
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('grilled chicken breast', 'Chicken breast, grilled'),
+    ('brown rice', 'Brown rice, cooked'),
+    ('creme brulee', 'Crème brûlée'),
+    ('apples', 'Apple, raw'),
+])
+def test_best_match(db, query, expected):
+    row, score = db.index.best(query)
+    assert db.names[row] == expected
+    assert 0 < score <= 1
+
+
+def test_min_score_and_empty_query(db):
+    assert db.index.best('zzzz qqqq', min_score=0.5) is None
+    assert db.index.search('!!!') == []
+
+
+def test_search_orders_by_score(db):
+    scores = [score for _, score in db.index.search('rice cooked', limit=3)]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_compiled_file_round_trip(db, tmp_path):
+    path = str(tmp_path / 'food.fdb')
+    db.save(path)
+    mapped = FoodDatabase.open(path)
+    assert list(mapped.names) == NAMES
+    np.testing.assert_array_equal(mapped.nutrients, db.nutrients)
+    for query in ('olive oil', 'white rice', 'chicken'):
+        assert mapped.index.search(query) == db.index.search(query)
+
+
+def test_open_rejects_other_files(tmp_path):
+    path = tmp_path / 'not.fdb'
+    path.write_bytes(b'hello world, not a database')
+    with pytest.raises(ValueError):
+        FoodDatabase.open(str(path))
+
+
+def test_from_csv_accepts_column_aliases(tmp_path):
+    csv_path = tmp_path / 'food.csv'
+    csv_path.write_text('Food,kcal,Carbs,protein_g\nBanana,89,22.8,1.1\n,1,1,1\nOats,389,,16.9\n',
+                        encoding='utf-8')
+    db = FoodDatabase.open(compile_database(str(csv_path)))
+    assert list(db.names) == ['Banana', 'Oats']
+    np.testing.assert_allclose(db.nutrients[0, :3], [89, 22.8, 1.1], rtol=1e-6)
+    assert np.isnan(db.nutrients[1, 1])
+    assert np.isnan(db.nutrients[:, NUTRIENT_COLUMNS.index('fat')]).all()
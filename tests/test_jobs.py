@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from jobs import JobManager, QueueFullError
+
+
+class LoopService:
+    """The part of EstimatorService a JobManager uses: a loop on its own thread."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(5)
+
+
+def wait_for(job, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while job.status not in ('done', 'failed') and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return job
+
+
+def test_job_runs_to_done():
+    manager = JobManager(LoopService(), workers=2)
+
+    async def work():
+        return {'calories': 500}
+
+    job = wait_for(manager.submit(work))
+    assert job.to_dict() == {'job_id': job.id, 'status': 'done', 'result': {'calories': 500}}
+    assert [event['status'] for event in job.events] == ['queued', 'running', 'done']
+    assert manager.get(job.id) is job
+
+
+def test_failed_job_keeps_its_error():
+    manager = JobManager(LoopService(), workers=1)
+
+    async def work():
+        raise RuntimeError('model unavailable')
+
+    job = wait_for(manager.submit(work))
+    assert job.status == 'failed'
+    assert job.error == 'model unavailable'
+    assert list(job.stream())[-1].startswith('event: failed\n')
+
+
+def test_full_queue_is_refused():
+    manager = JobManager(LoopService(), workers=1, max_queue=2)
+    release = threading.Event()
+
+    async def block():
+        await asyncio.get_running_loop().run_in_executor(None, release.wait)
+        return {}
+
+    jobs = [manager.submit(block)]
+    # Let the worker take the first job off the queue
+    while jobs[0].status != 'running':
+        time.sleep(0.01)
+    jobs += [manager.submit(block), manager.submit(block)]
+    with pytest.raises(QueueFullError) as error:
+        manager.submit(block)
+    assert error.value.retry_after >= 1.0
+    release.set()
+    assert all(wait_for(job).status == 'done' for job in jobs)
+
+
+def test_finished_jobs_expire_without_new_submissions():
+    manager = JobManager(LoopService(), workers=1, ttl=0.1)
+
+    async def work():
+        return {}
+
+    job = wait_for(manager.submit(work))
+    time.sleep(0.2)
+    assert manager.get(job.id) is None
+
+    other = wait_for(manager.submit(work))
+    # The reaper runs every min(ttl, 60) seconds, without any lookups
+    time.sleep(0.5)
+    assert other.id not in manager._jobs
@@ -0,0 +1,37 @@
+import pytest
+
+from portions import density, piece_grams, portion_to_grams
+
+
+@pytest.mark.parametrize('portion, name, grams', [
+    ('150g', '', 150.0),
+    ('1.5 kg', '', 1500.0),
+    ('1,5 kg', '', 1500.0),
+    ('1,000 ml', 'water', 1000.0),
+    ('12,000g', '', 12000.0),
+    ('2-3 slices', 'bread', 75.0),
+    ('2 large', 'eggs', 100.0),
+    ('one medium', 'apple', 180.0),
+])
+def test_portion_to_grams(portion, name, grams):
+    assert portion_to_grams(portion, name) == pytest.approx(grams)
+
+
+def test_half_a_cup_is_half_of_a_cup():
+    cup = portion_to_grams('a cup', 'rice')
+    assert portion_to_grams('half a cup', 'rice') == pytest.approx(cup / 2)
+    assert portion_to_grams('half of a cup', 'rice') == pytest.approx(cup / 2)
+    assert portion_to_grams('a quarter cup', 'rice') == pytest.approx(cup / 4)
+
+
+@pytest.mark.parametrize('portion', ['100', '2', '', None, 'some'])
+def test_unreadable_portion_is_none(portion):
+    assert portion_to_grams(portion, 'eggs') is None
+
+
+def test_keywords_match_whole_words():
+    assert density('olive oil') == 0.92
+    assert density('boiled potatoes') == 1.0
+    assert piece_grams('eggs') == 50.0
+    assert piece_grams('eggplant') == piece_grams('pineapple') == 100.0
+    assert density('blueberries') == 0.6
@@ -0,0 +1,80 @@
+import json
+
+import pandas as pd
+import pytest
+
+from response_parser import parse_food_item, parse_response, parse_responses_bulk
+
+TEXT_RESPONSE = """CALORIES: 650
+Carbohydrates: 72g
+Protein: 28.5g
+Fat: 30g
+Dietary fiber: 6g
+
+Food Items:
+- Margherita pizza (2 slices)
+- Side salad
+
+Plant-based Ingredients:
+- Tomato
+- Basil
+"""
+
+
+def test_text_response():
+    parsed = parse_response(TEXT_RESPONSE)
+    assert parsed.nutrition() == {'calories': 650.0, 'carbohydrates': 72.0, 'protein': 28.5,
+                                  'fat': 30.0, 'fiber': 6.0}
+    assert parsed.food_item_texts() == ['Margherita pizza (2 slices)', 'Side salad']
+    assert parsed.food_items[0].name == 'Margherita pizza'
+    assert parsed.food_items[0].portion == '2 slices'
+    assert parsed.plant_items == ['Tomato', 'Basil']
+
+
+def test_first_total_wins_and_sections_close():
+    parsed = parse_response("CALORIES: 500\nFood Items:\n- Rice (1 cup)\nNote: CALORIES: 900\n- stray")
+    assert parsed.calories == 500.0
+    assert parsed.food_item_texts() == ['Rice (1 cup)']
+
+
+def test_structured_response():
+    parsed = parse_response(json.dumps({'kcal': 420, 'carb': 50, 'prot': 20, 'fat': 12, 'fib': 4,
+                                        'items': [{'n': 'Oatmeal', 'p': '1 bowl'}, 'Banana'],
+                                        'plants': ['Oats', ' ']}))
+    assert parsed.calories == 420.0
+    assert parsed.food_item_texts() == ['Oatmeal (1 bowl)', 'Banana']
+    assert parsed.plant_items == ['Oats']
+
+
+def test_truncated_structured_response_has_no_totals():
+    assert parse_response('{"kcal": 420, "carb": 5').calories is None
+    assert parse_response('').calories is None
+
+
+def test_to_text_round_trip():
+    parsed = parse_response(TEXT_RESPONSE)
+    again = parse_response(parsed.to_text())
+    assert again.nutrition() == parsed.nutrition()
+    assert again.food_item_texts() == parsed.food_item_texts()
+    assert again.plant_items == parsed.plant_items
+
+
+def test_parse_food_item_without_portion():
+    assert parse_food_item('Apple') == ('Apple', None, 'Apple')
+
+
+@pytest.mark.parametrize('response', [
+    TEXT_RESPONSE,
+    "CALORIES: 300\nProtein: 10 g\nFood Items:\n\n- Soup (1 bowl)\n",
+    json.dumps({'kcal': 250, 'items': ['Toast']}),
+    "I can't tell what this is.",
+    None,
+])
+def test_bulk_matches_single_pass(response):
+    frame = parse_responses_bulk(pd.Series([response]))
+    parsed = parse_response(response)
+    for field, value in parsed.nutrition().items():
+        bulk = frame.at[0, field]
+        assert (pd.isna(bulk) and value is None) or bulk == value
+    assert frame.at[0, 'food_items'] == parsed.food_item_texts()
+    assert frame.at[0, 'plant_items'] == parsed.plant_items
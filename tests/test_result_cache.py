@@ -0,0 +1,94 @@
+import asyncio
+import os
+
+import pytest
+
+from result_cache import ResultCache, make_cache_key
+
+GOOD = {'response': 'CALORIES: 500', 'success': True}
+
+
+def has_calories(result):
+    return 'CALORIES' in result['response']
+
+
+def test_cache_key_separates_parts():
+    assert make_cache_key(b'img', 'model', 'ab', 'c') != make_cache_key(b'img', 'model', 'a', 'bc')
+    assert make_cache_key(b'img', 'model', 'prompt') == make_cache_key(b'img', 'model', 'prompt')
+
+
+def test_concurrent_callers_share_one_compute(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return dict(GOOD)
+
+    async def main():
+        return await asyncio.gather(*[cache.get_or_compute('k' * 64, compute) for _ in range(5)])
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(r['response'] == GOOD['response'] for r in results)
+    assert asyncio.run(cache.get_or_compute('k' * 64, compute))['cached'] is True
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('result', [
+    {'response': 'Rate limited', 'success': False},
+    {'response': 'I cannot tell what this is', 'success': True},
+])
+def test_uncacheable_results_are_recomputed(tmp_path, result):
+    cache = ResultCache(str(tmp_path))
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return dict(result)
+
+    for _ in range(2):
+        asyncio.run(cache.get_or_compute('k' * 64, compute, has_calories))
+    assert len(calls) == 2
+    assert cache.get('k' * 64) is None
+
+
+def test_failure_reaches_waiters_and_next_caller_retries(tmp_path):
+    cache = ResultCache(str(tmp_path))
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('boom')
+
+    async def main():
+        return await asyncio.gather(*[cache.get_or_compute('k' * 64, fail) for _ in range(3)],
+                                    return_exceptions=True)
+
+    assert all(isinstance(r, RuntimeError) for r in asyncio.run(main()))
+
+    async def succeed():
+        return dict(GOOD)
+
+    assert asyncio.run(cache.get_or_compute('k' * 64, succeed))['success'] is True
+
+
+def test_disk_tier_survives_a_new_instance(tmp_path):
+    key = 'ab' * 32
+
+    async def compute():
+        return dict(GOOD)
+
+    asyncio.run(ResultCache(str(tmp_path)).get_or_compute(key, compute))
+    assert ResultCache(str(tmp_path)).get(key) == GOOD
+
+
+def test_disk_tier_stays_within_budget(tmp_path):
+    cache = ResultCache(str(tmp_path), max_disk_bytes=400)
+    for i in range(20):
+        cache.put(f"{i:02d}" * 32, dict(GOOD))
+    total = sum(os.path.getsize(os.path.join(root, name))
+                for root, _, files in os.walk(tmp_path) for name in files)
+    assert 0 < total <= 400
+    # The memory tier still has every entry
+    assert cache.get('19' * 32) == GOOD